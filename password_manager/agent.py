@@ -0,0 +1,408 @@
+"""
+Unlock agent: keeps one unlocked vault resident and serves it to other
+processes over a Unix domain socket
+
+Run it with `python -m password_manager.agent`. It asks for the master
+password once; clients then talk to it with AgentClient instead of
+opening the vault and deriving the key themselves.
+
+Protocol: every message is a 4 byte big-endian length followed by that
+many bytes of compact JSON. A request is an object with an "op" and its
+arguments, e.g. {"op": "get", "website": "example.com"}; the reply is
+{"ok": true, "result": ...} or {"ok": false, "error": "..."}. A connection
+can carry any number of requests.
+"""
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+import time
+from .config.settings import Settings
+
+HEADER = struct.Struct('>I')
+MAX_MESSAGE = 16 * 1024 * 1024
+
+
+class AgentError(RuntimeError):
+    pass
+
+
+def socket_path():
+    """
+    The agent_socket setting, or agent.sock in a private per-user
+    directory under XDG_RUNTIME_DIR or the temp directory
+    """
+    path = Settings().get("agent_socket")
+    if path:
+        return path
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(base, f'password_manager-{os.getuid()}', 'agent.sock')
+
+
+def check_private_directory(directory):
+    """
+    Refuse a socket directory that another user owns or can enter: they
+    could swap the socket for their own and read every request
+    """
+    try:
+        st = os.lstat(directory)
+    except OSError as e:
+        raise AgentError(f"Cannot use {directory}: {e}")
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() \
+            or st.st_mode & 0o077:
+        raise AgentError(f"{directory} must be a directory owned by the current "
+                         f"user with mode 0700")
+
+
+def send_message(sock, message):
+    data = json.dumps(message, separators=(',', ':')).encode()
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def recv_message(sock):
+    """
+    Read one message; None if the peer closed the connection
+    """
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    size, = HEADER.unpack(header)
+    if size > MAX_MESSAGE:
+        raise AgentError(f"Message of {size} bytes exceeds the limit")
+    data = _recv_exactly(sock, size)
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        agent = self.server.agent
+        if not agent.peer_allowed(self.request):
+            return
+        while True:
+            try:
+                request = recv_message(self.request)
+            except (AgentError, ValueError, OSError):
+                return
+            if request is None:
+                return
+            try:
+                send_message(self.request, agent.dispatch(request))
+            except OSError:
+                return
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class Agent:
+    """
+    Serves a PasswordManager over a socket that only its owner can open.
+
+    Requests from different connections are handled on their own threads
+    but run one at a time against the vault. After idle_timeout seconds
+    without a request the vault is locked; an "unlock" request reopens it.
+    Expired cached plaintexts are wiped every few seconds either way.
+    While the agent runs, other processes should go through it rather
+    than write the vault themselves.
+    """
+
+    def __init__(self, password_manager, path=None, idle_timeout=None):
+        self.pm = password_manager
+        self.path = path or socket_path()
+        if idle_timeout is None:
+            idle_timeout = Settings().get("auto_lock_timeout", 300)
+        self.idle_timeout = idle_timeout
+        self.server = None
+        self._lock = threading.Lock()
+        self._last_request = time.monotonic()
+        self._stopped = threading.Event()
+        self.operations = {
+            'ping': self.ping,
+            'unlock': self.unlock,
+            'lock': self.lock,
+            'get': self.get,
+            'get_many': self.get_many,
+            'list': self.list,
+            'find': self.find,
+            'match': self.match,
+            'add': self.add,
+            'update': self.update,
+            'delete': self.delete,
+            'stop': self.stop,
+        }
+
+    def _bind(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            check_private_directory(directory)
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                # Left behind by an agent that did not shut down cleanly
+                os.remove(self.path)
+            else:
+                raise AgentError(f"An agent is already listening on {self.path}")
+            finally:
+                probe.close()
+        # Create the socket with mode 0600 from the start, not chmod it later
+        umask = os.umask(0o177)
+        try:
+            self.server = _Server(self.path, _Handler)
+        finally:
+            os.umask(umask)
+        self.server.agent = self
+
+    def peer_allowed(self, sock):
+        """
+        Where the platform reports it, only accept connections from
+        processes of the same user
+        """
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                      struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', credentials)
+        return uid == os.getuid()
+
+    def serve_forever(self):
+        self._bind()
+        threading.Thread(target=self._housekeeping, daemon=True).start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self._stopped.set()
+            self.server.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.pm.close()
+
+    def _housekeeping(self):
+        while not self._stopped.wait(min(self.idle_timeout or 5, 5)):
+            with self._lock:
+                self.pm.cache.expire()
+                idle = time.monotonic() - self._last_request
+                if self.idle_timeout and self.pm.is_unlocked and idle >= self.idle_timeout:
+                    self.pm.flush()
+                    self.pm.lock()
+
+    def dispatch(self, request):
+        if not isinstance(request, dict) or request.get('op') not in self.operations:
+            return {'ok': False, 'error': "Unknown operation"}
+        operation = self.operations[request['op']]
+        args = {key: value for key, value in request.items() if key != 'op'}
+        with self._lock:
+            self._last_request = time.monotonic()
+            try:
+                if operation not in (self.ping, self.unlock, self.stop) \
+                        and not self.pm.is_unlocked:
+                    raise AgentError("Vault is locked")
+                return {'ok': True, 'result': operation(**args)}
+            except Exception as e:
+                return {'ok': False, 'error': str(e) or type(e).__name__}
+
+    def ping(self):
+        return {'unlocked': self.pm.is_unlocked, 'pid': os.getpid()}
+
+    def unlock(self, master_password):
+        self.pm.unlock(master_password)
+        return True
+
+    def lock(self):
+        self.pm.flush()
+        self.pm.lock()
+        return True
+
+    def get(self, website, track_access=True):
+        return self.pm.get_password(website, track_access)
+
+    def get_many(self, websites, fields=None):
+        return self.pm.get_passwords(websites, fields=fields)
+
+    def list(self, sort_by=None, reverse=False):
+        return self.pm.list_websites(sort_by, reverse)
+
+    def find(self, username=None, email=None, url=None, domain=None):
+        return self.pm.find_websites(username, email, url, domain)
+
+    def match(self, url, same_site=False):
+        return self.pm.match_url(url, same_site)
+
+    def add(self, website, username, password, url='', email='', additional_info=''):
+        return self.pm.add_password(website, username, password, url, email,
+                                    additional_info)
+
+    def update(self, old_website, new_website, username, password, url='', email='',
+               additional_info=''):
+        return self.pm.update_entry_full(old_website, new_website, username, password,
+                                         url, email, additional_info)
+
+    def delete(self, website):
+        return self.pm.delete_password(website)
+
+    def stop(self):
+        # shutdown() waits for serve_forever to return, so it cannot run on
+        # this handler thread while holding up the reply
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+        return True
+
+
+class AgentClient:
+    """
+    Talks to a running Agent. The connection is opened on the first
+    request and reused for the following ones.
+    """
+
+    def __init__(self, path=None, timeout=10):
+        self.path = path or socket_path()
+        self.timeout = timeout
+        self.sock = None
+
+    def connect(self):
+        if self.sock is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                check_private_directory(directory)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError as e:
+                sock.close()
+                raise AgentError(f"No agent listening on {self.path}: {e}")
+            self.sock = sock
+        return self.sock
+
+    def request(self, op, **args):
+        """
+        Send one request and return its result; raises AgentError with the
+        agent's message if it failed
+        """
+        sock = self.connect()
+        try:
+            send_message(sock, dict(args, op=op))
+            reply = recv_message(sock)
+        except OSError:
+            self.close()
+            raise
+        if reply is None:
+            self.close()
+            raise AgentError("Agent closed the connection")
+        if not reply['ok']:
+            raise AgentError(reply['error'])
+        return reply['result']
+
+    def is_running(self):
+        try:
+            self.request('ping')
+            return True
+        except (AgentError, OSError):
+            return False
+
+    def unlock(self, master_password):
+        return self.request('unlock', master_password=master_password)
+
+    def lock(self):
+        return self.request('lock')
+
+    def get_password(self, website, track_access=True):
+        return self.request('get', website=website, track_access=track_access)
+
+    def get_passwords(self, websites, fields=None):
+        return self.request('get_many', websites=list(websites), fields=fields)
+
+    def list_websites(self, sort_by=None, reverse=False):
+        return self.request('list', sort_by=sort_by, reverse=reverse)
+
+    def find_websites(self, username=None, email=None, url=None, domain=None):
+        return self.request('find', username=username, email=email, url=url,
+                            domain=domain)
+
+    def match_url(self, url, same_site=False):
+        return self.request('match', url=url, same_site=same_site)
+
+    def add_password(self, website, username, password, url='', email='',
+                     additional_info=''):
+        return self.request('add', website=website, username=username,
+                            password=password, url=url, email=email,
+                            additional_info=additional_info)
+
+    def update_entry_full(self, old_website, new_website, username, password, url,
+                          email, additional_info):
+        return self.request('update', old_website=old_website, new_website=new_website,
+                            username=username, password=password, url=url, email=email,
+                            additional_info=additional_info)
+
+    def delete_password(self, website):
+        return self.request('delete', website=website)
+
+    def stop(self):
+        return self.request('stop')
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    import argparse
+    import getpass
+    from .core.database import VaultLockedError
+    from .core.password_manager import PasswordManager
+    from .core.session import InvalidPasswordError
+
+    parser = argparse.ArgumentParser(
+        prog='python -m password_manager.agent',
+        description='Unlock the vault once and serve it over a Unix socket')
+    parser.add_argument('--socket', help='socket path (default: %(default)s)',
+                        default=socket_path())
+    parser.add_argument('--idle-timeout', type=int, default=None,
+                        help='lock after this many idle seconds, 0 for never '
+                             '(default: the auto_lock_timeout setting)')
+    args = parser.parse_args()
+
+    try:
+        pm = PasswordManager()
+    except VaultLockedError as e:
+        raise SystemExit(str(e))
+    try:
+        pm.unlock(getpass.getpass('Master password: '))
+    except InvalidPasswordError:
+        pm.close()
+        raise SystemExit('Invalid master password')
+    agent = Agent(pm, args.socket, args.idle_timeout)
+    print(f'Agent listening on {agent.path}', flush=True)
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
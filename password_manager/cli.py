@@ -0,0 +1,256 @@
+"""
+Command line interface for the Password Manager
+
+Usage: python -m password_manager.cli [--json] COMMAND ...
+
+Only the modules a command needs are imported, and never the GUI, so a
+lookup starts quickly and works without a display. When an unlock agent
+(python -m password_manager.agent) is running, commands go through it
+instead of opening the vault; a locked agent is unlocked first. With --json every result
+is printed as one JSON object per line.
+"""
+import argparse
+import getpass
+import json
+import sys
+from .agent import AgentClient, AgentError
+
+ENTRY_FIELDS = ('username', 'url', 'email', 'additional_info')
+
+
+class CommandError(Exception):
+    pass
+
+
+def open_vault():
+    """
+    An unlocked vault: the running agent if there is one, otherwise a
+    PasswordManager unlocked with the master password
+    """
+    client = AgentClient()
+    try:
+        unlocked = client.request('ping')['unlocked']
+    except (AgentError, OSError):
+        client.close()
+    else:
+        # The agent holds the vault in memory and would overwrite changes
+        # made behind its back, so a locked agent is unlocked, not bypassed
+        if not unlocked:
+            try:
+                client.unlock(getpass.getpass('Master password: '))
+            except AgentError as e:
+                client.close()
+                raise CommandError(str(e))
+        return client
+
+    from .core.database import VaultLockedError
+    from .core.password_manager import PasswordManager
+    from .core.session import InvalidPasswordError
+    try:
+        pm = PasswordManager()
+    except VaultLockedError as e:
+        raise CommandError(str(e))
+    try:
+        pm.unlock(getpass.getpass('Master password: '))
+    except InvalidPasswordError:
+        pm.close()
+        raise CommandError("Invalid master password")
+    return pm
+
+
+def read_secret(args):
+    if args.generate:
+        from .utils.password_generator import generate_password
+        return generate_password(args.length)
+    if args.password is not None:
+        return args.password
+    password = getpass.getpass('Password: ')
+    if not password:
+        raise CommandError("Password must not be empty")
+    return password
+
+
+def output(args, record, text):
+    if args.json:
+        print(json.dumps(record, separators=(',', ':')))
+    elif text is not None:
+        print(text)
+
+
+def cmd_get(args, vault):
+    entries = vault.get_passwords(args.websites) if len(args.websites) > 1 else {
+        website: vault.get_password(website, False) for website in args.websites}
+    missing = [website for website in args.websites if not entries.get(website)]
+    for website in args.websites:
+        entry = entries.get(website)
+        if not entry:
+            continue
+        if entry.get('decryption_error'):
+            print(f"Error: cannot decrypt the entry for {website}", file=sys.stderr)
+            continue
+        if args.json:
+            output(args, dict(entry, website=website), None)
+        else:
+            print(entry.get(args.field, ''))
+    if missing:
+        raise CommandError(f"No entry for {', '.join(missing)}")
+
+
+def cmd_list(args, vault):
+    filters = {name: getattr(args, name) for name in ('username', 'email', 'url', 'domain')}
+    if args.match is not None:
+        websites = vault.match_url(args.match, args.same_site)
+    elif any(value is not None for value in filters.values()):
+        websites = vault.find_websites(**filters)
+    else:
+        websites = vault.list_websites(args.sort, args.reverse)
+    for website in websites:
+        output(args, {'website': website}, website)
+
+
+def cmd_add(args, vault):
+    password = read_secret(args)
+    if not vault.add_password(args.website, args.username or '', password,
+                              args.url or '', args.email or '', args.notes or ''):
+        raise CommandError(f"An entry for {args.website} already exists")
+    output(args, {'website': args.website, 'added': True}, f"Added {args.website}")
+
+
+def cmd_update(args, vault):
+    entry = vault.get_password(args.website, False)
+    if not entry:
+        raise CommandError(f"No entry for {args.website}")
+    if entry.get('decryption_error'):
+        raise CommandError(f"Cannot decrypt the entry for {args.website}")
+    # Fields that are not given keep their current value
+    password = entry['password']
+    if args.generate or args.password is not None:
+        password = read_secret(args)
+    values = {
+        'username': args.username,
+        'url': args.url,
+        'email': args.email,
+        'additional_info': args.notes,
+    }
+    values = {field: entry.get(field, '') if value is None else value
+              for field, value in values.items()}
+    new_website = args.rename or args.website
+    if not vault.update_entry_full(args.website, new_website, values['username'], password,
+                                   values['url'], values['email'],
+                                   values['additional_info']):
+        raise CommandError(f"Could not update {args.website}")
+    output(args, {'website': new_website, 'updated': True}, f"Updated {new_website}")
+
+
+def cmd_delete(args, vault):
+    if not vault.delete_password(args.website):
+        raise CommandError(f"No entry for {args.website}")
+    output(args, {'website': args.website, 'deleted': True}, f"Deleted {args.website}")
+
+
+def cmd_generate(args):
+    from .utils.password_generator import generate_password
+    for _ in range(args.count):
+        password = generate_password(args.length)
+        output(args, {'password': password}, password)
+
+
+def cmd_export(args):
+    # The backup holds ciphertext only, so no unlock is needed
+    from .core.database import VaultLockedError, open_database
+    try:
+        db = open_database()
+    except VaultLockedError as e:
+        raise CommandError(str(e))
+    try:
+        db.export_backup(args.path)
+    finally:
+        db.close()
+    output(args, {'path': args.path, 'exported': True}, f"Exported to {args.path}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m password_manager.cli',
+                                     description='Password Manager command line')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON lines')
+    # --json is also accepted after the command; SUPPRESS keeps the
+    # subcommand from resetting a --json given before it
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--json', action='store_true', default=argparse.SUPPRESS,
+                        help='print results as JSON lines')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    get = commands.add_parser('get', parents=[common],
+                              help='print the password of one or more entries')
+    get.add_argument('websites', nargs='+', metavar='website')
+    get.add_argument('--field', default='password',
+                     choices=('password',) + ENTRY_FIELDS,
+                     help='field to print instead of the password')
+    get.set_defaults(func=cmd_get)
+
+    ls = commands.add_parser('list', parents=[common], help='list websites')
+    ls.add_argument('--sort', choices=('created_at', 'updated_at', 'last_accessed'))
+    ls.add_argument('--reverse', action='store_true')
+    for name in ('username', 'email', 'url', 'domain'):
+        ls.add_argument(f'--{name}', help=f'only entries with this {name}')
+    ls.add_argument('--match', metavar='URL',
+                    help='entries for the host of URL, best match first')
+    ls.add_argument('--same-site', action='store_true',
+                    help='with --match, also list other hosts of the same site')
+    ls.set_defaults(func=cmd_list)
+
+    for name, func, help_text in (('add', cmd_add, 'add an entry'),
+                                  ('update', cmd_update, 'change fields of an entry')):
+        command = commands.add_parser(name, parents=[common], help=help_text)
+        command.add_argument('website')
+        command.add_argument('--username')
+        command.add_argument('--password',
+                             help='the password (asked for if neither this nor '
+                                  '--generate is given when adding)')
+        command.add_argument('--generate', action='store_true',
+                             help='use a newly generated password')
+        command.add_argument('--length', type=int, default=16)
+        command.add_argument('--url')
+        command.add_argument('--email')
+        command.add_argument('--notes')
+        if name == 'update':
+            command.add_argument('--rename', metavar='WEBSITE')
+        command.set_defaults(func=func)
+
+    delete = commands.add_parser('delete', parents=[common], help='delete an entry')
+    delete.add_argument('website')
+    delete.set_defaults(func=cmd_delete)
+
+    generate = commands.add_parser('generate', parents=[common],
+                                   help='generate passwords')
+    generate.add_argument('--length', type=int, default=16)
+    generate.add_argument('--count', type=int, default=1)
+    generate.set_defaults(func=cmd_generate, local=True)
+
+    export = commands.add_parser('export', parents=[common], help='write an encrypted backup')
+    export.add_argument('path')
+    export.set_defaults(func=cmd_export, local=True)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    vault = None
+    try:
+        if getattr(args, 'local', False):
+            args.func(args)
+        else:
+            vault = open_vault()
+            args.func(args, vault)
+    except (CommandError, AgentError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if vault is not None:
+            vault.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
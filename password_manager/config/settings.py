@@ -10,7 +10,6 @@ class Settings:
         self.config_file = "config.json"
         self.default_settings = {
             "database_path": "passwords.json",
-            "encryption_key": None,
             "theme": "light",
             "auto_lock_timeout": 300,  # 5 minutes
             "clipboard_timeout": 30,   # 30 seconds
@@ -0,0 +1,426 @@
+"""
+Memory-mapped binary vault format
+
+Layout (all integers little endian):
+
+    header   magic "PMVAULT\\0", u16 version, u16 reserved, u32 entry count
+    table    one slot per entry, sorted by UTF-8 website key:
+             u64 key offset, u32 key length, u64 record offset
+    data     for each entry the key bytes followed by a u32 length
+             prefixed record (the JSON encoded entry with its encrypted
+             password)
+
+Lookups binary search the offset table in the mapped file and slice the
+record without reading anything else, so opening a vault costs the same
+no matter how many entries it holds.
+
+The vault header (KDF parameters and other vault-wide values) is kept
+as JSON in a "<db_file>.meta" file next to the vault.
+
+Run "python -m password_manager.core.binary_vault import|export" to
+convert between this format and the JSON database.
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from .database import (load_json_vault, new_entry, read_backup, sort_websites,
+                       timestamp, write_backup, write_json_atomic)
+from .index import SecondaryIndex
+from ..config.settings import Settings
+
+
+MAGIC = b'PMVAULT\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sHHI')
+SLOT = struct.Struct('<QIQ')
+LENGTH = struct.Struct('<I')
+
+
+def encode_entry(entry):
+    return json.dumps(entry, separators=(',', ':')).encode()
+
+
+def decode_entry(record):
+    # Decode straight from the mapped slice without an intermediate copy
+    return json.loads(str(record, 'utf-8'))
+
+
+def _write(path, pairs):
+    """
+    Write (key bytes, record bytes) pairs, which must already be sorted by
+    key, as a binary vault and fsync it
+    """
+    table_size = len(pairs) * SLOT.size
+    position = HEADER.size + table_size
+    table = bytearray()
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(pairs)))
+        f.seek(position)
+        for key, body in pairs:
+            table += SLOT.pack(position, len(key), position + len(key))
+            f.write(key)
+            f.write(LENGTH.pack(len(body)))
+            f.write(body)
+            position += len(key) + LENGTH.size + len(body)
+        f.seek(HEADER.size)
+        f.write(table)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_vault(path, data):
+    """
+    Atomically write a {website: entry} dict as a binary vault
+    """
+    tmp_file = path + '.tmp'
+    _write(tmp_file, sorted((website.encode(), encode_entry(entry))
+                            for website, entry in data.items()))
+    os.replace(tmp_file, path)
+
+
+def read_vault(path):
+    """
+    Read a binary vault back into a {website: entry} dict
+    """
+    with open(path, 'rb') as f:
+        vault = _MappedVault(f)
+        try:
+            return {vault.key(i).decode(): decode_entry(vault.record(i))
+                    for i in range(vault.count)}
+        finally:
+            vault.close()
+
+
+class _MappedVault:
+    """
+    Read-only view of a binary vault file through mmap
+    """
+
+    def __init__(self, f):
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        magic, version, _, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("Not a binary password vault")
+        if version != VERSION:
+            self.close()
+            raise ValueError(f"Unsupported vault version {version}")
+
+    def _slot(self, i):
+        return SLOT.unpack_from(self.mm, HEADER.size + i * SLOT.size)
+
+    def key(self, i):
+        key_offset, key_length, _ = self._slot(i)
+        return self.mm[key_offset:key_offset + key_length]
+
+    def record(self, i):
+        """
+        Zero-copy slice of record i
+        """
+        record_offset = self._slot(i)[2]
+        (length,) = LENGTH.unpack_from(self.mm, record_offset)
+        start = record_offset + LENGTH.size
+        return self.view[start:start + length]
+
+    def find(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.key(low) == key:
+            return low
+        return -1
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+
+
+class BinaryVaultDatabase:
+    """
+    Database backed by the binary vault format. Changes are collected in
+    an overlay and written out as a new file on commit; unchanged records
+    are copied straight from the mapped file without being parsed.
+    """
+
+    def __init__(self):
+        self.settings = Settings()
+        self.db_file = self.settings.get("binary_database_path", "passwords.pmv")
+        self.meta_file = self.db_file + '.meta'
+        # The VaultLock taken by open_database, released on close
+        self.vault_lock = None
+        self._changes = {}
+        self._pending = None
+        self._meta_dirty = False
+        # Lookup index over every record, built on the first find_by_*
+        # call and then kept in step with each change
+        self._lookup = None
+        self.meta = {}
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file, 'r') as f:
+                self.meta = json.load(f)
+        if not os.path.exists(self.db_file):
+            json_file = self.settings.get("database_path", "passwords.json")
+            data = {}
+            if os.path.exists(json_file):
+                document = load_json_vault(json_file)
+                data = document['entries']
+                self.meta = document['meta']
+                write_json_atomic(self.meta_file, self.meta)
+            write_vault(self.db_file, data)
+        self._open()
+
+    def _open(self):
+        self._fh = open(self.db_file, 'rb')
+        self._vault = _MappedVault(self._fh)
+
+    def _close_file(self):
+        self._vault.close()
+        self._fh.close()
+
+    def _base_entry(self, website):
+        index = self._vault.find(website.encode())
+        if index < 0:
+            return None
+        return decode_entry(self._vault.record(index))
+
+    def _exists(self, website):
+        if website in self._changes:
+            return self._changes[website] is not None
+        return self._vault.find(website.encode()) >= 0
+
+    def _set(self, website, entry):
+        """
+        Record a new entry for website, or None to delete it, in the
+        overlay
+        """
+        if self._lookup is not None:
+            old_entry = self.get_entry(website)
+            if old_entry is not None:
+                self._lookup.remove(website, old_entry)
+            if entry is not None:
+                self._lookup.add(website, entry)
+        self._changes[website] = entry
+
+    def get_meta(self, key, default=None):
+        return self.meta.get(key, default)
+
+    def set_meta(self, key, value):
+        """
+        Store a value in the vault header file. Inside a transaction the
+        header is written once when the block exits.
+        """
+        self.meta[key] = value
+        if self._pending is not None:
+            self._meta_dirty = True
+            return
+        write_json_atomic(self.meta_file, self.meta)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Defer the file rewrite until the block exits; if an exception
+        escapes the pending changes are discarded
+        """
+        if self._pending is not None:
+            yield self
+            return
+        saved_changes = dict(self._changes)
+        saved_meta = dict(self.meta)
+        self._pending = True
+        try:
+            yield self
+        except BaseException:
+            self._changes = saved_changes
+            self.meta = saved_meta
+            self._lookup = None
+            raise
+        finally:
+            self._pending = None
+            meta_dirty, self._meta_dirty = self._meta_dirty, False
+        self._commit()
+        if meta_dirty:
+            write_json_atomic(self.meta_file, self.meta)
+
+    def _commit(self):
+        if self._pending is not None or not self._changes:
+            return
+        pairs = []
+        for i in range(self._vault.count):
+            key = bytes(self._vault.key(i))
+            if key.decode() not in self._changes:
+                pairs.append((key, self._vault.record(i)))
+        for website, entry in self._changes.items():
+            if entry is not None:
+                pairs.append((website.encode(), encode_entry(entry)))
+        pairs.sort(key=lambda pair: pair[0])
+        tmp_file = self.db_file + '.tmp'
+        _write(tmp_file, pairs)
+        del pairs
+        # The mapping has to be released before the file can be replaced
+        # on Windows
+        self._close_file()
+        os.replace(tmp_file, self.db_file)
+        self._changes = {}
+        self._open()
+
+    def add_entry(self, website, username, encrypted_password, url='', email='', additional_info=''):
+        if self._exists(website):
+            return False
+        self._set(website, new_entry(username, encrypted_password, url, email, additional_info))
+        self._commit()
+        return True
+
+    def get_entry(self, website):
+        if website in self._changes:
+            entry = self._changes[website]
+            return dict(entry) if entry is not None else None
+        return self._base_entry(website)
+
+    def update_entry(self, website, encrypted_password):
+        entry = self.get_entry(website)
+        if entry is None:
+            return False
+        entry['password'] = encrypted_password
+        entry['updated_at'] = timestamp()
+        self._set(website, entry)
+        self._commit()
+        return True
+
+    def delete_entry(self, website):
+        if not self._exists(website):
+            return False
+        self._set(website, None)
+        self._commit()
+        return True
+
+    def list_websites(self, sort_by=None, reverse=False):
+        if sort_by is not None:
+            # Timestamps live inside the records, so this parses every entry
+            return sort_websites(
+                ((website, self.get_entry(website)) for website in self.list_websites()),
+                sort_by, reverse)
+        websites = [bytes(self._vault.key(i)).decode()
+                    for i in range(self._vault.count)]
+        if not self._changes:
+            return websites
+        websites = [w for w in websites if w not in self._changes]
+        websites += [w for w, entry in self._changes.items() if entry is not None]
+        return sorted(websites)
+
+    def update_entry_full(self, old_website, new_website, username, encrypted_password, url, email, additional_info):
+        previous = self.get_entry(old_website)
+        if previous is None:
+            return False
+        if old_website != new_website:
+            if self._exists(new_website):
+                return False  # Don't overwrite existing
+            self._set(old_website, None)
+        self._set(new_website, new_entry(username, encrypted_password, url, email,
+                                         additional_info, previous=previous))
+        self._commit()
+        return True
+
+    def touch_entries(self, access_times):
+        """
+        Record last_accessed times with a single file rewrite
+        """
+        with self.transaction():
+            for website, accessed in access_times.items():
+                entry = self.get_entry(website)
+                if entry is not None:
+                    entry['last_accessed'] = accessed
+                    self._set(website, entry)
+
+    def find_by_username(self, username):
+        return list(self._lookup_index().find('username', username))
+
+    def find_by_email(self, email):
+        return list(self._lookup_index().find('email', email))
+
+    def find_by_host(self, host):
+        return list(self._lookup_index().find('host', host))
+
+    def find_by_domain(self, domain):
+        return list(self._lookup_index().find('domain', domain))
+
+    def _lookup_index(self):
+        # The file format has no secondary indexes, so the first lookup
+        # parses every record once
+        if self._lookup is None:
+            self._lookup = SecondaryIndex(
+                {website: self.get_entry(website) for website in self.list_websites()})
+        return self._lookup
+
+    def export_backup(self, path):
+        """
+        Write all entries to path in the JSON database format
+        """
+        data = {website: self.get_entry(website)
+                for website in self.list_websites()}
+        write_backup(path, data, self.meta)
+
+    def import_backup(self, path):
+        """
+        Replace all entries with the contents of a JSON backup file. The
+        vault header is only replaced if the backup carries one.
+        """
+        document = read_backup(path)
+        self._close_file()
+        write_vault(self.db_file, document['entries'])
+        self._changes = {}
+        self._lookup = None
+        self._open()
+        if document['meta']:
+            self.meta = document['meta']
+            write_json_atomic(self.meta_file, self.meta)
+
+    def flush(self, timeout=None):
+        # Every commit is already durable
+        return True
+
+    def close(self):
+        self._close_file()
+        if self.vault_lock is not None:
+            self.vault_lock.release()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m password_manager.core.binary_vault',
+        description='Convert between the JSON database and the binary vault format')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser(
+        'import', help='build a binary vault from a JSON database')
+    import_parser.add_argument('source', help='JSON database file')
+    import_parser.add_argument('target', help='binary vault file to write')
+    export_parser = subparsers.add_parser(
+        'export', help='write a binary vault out as a JSON database')
+    export_parser.add_argument('source', help='binary vault file')
+    export_parser.add_argument('target', help='JSON database file to write')
+    args = parser.parse_args(argv)
+
+    if args.command == 'import':
+        document = load_json_vault(args.source)
+        data = document['entries']
+        write_vault(args.target, data)
+        write_json_atomic(args.target + '.meta', document['meta'])
+    else:
+        data = read_vault(args.source)
+        meta = {}
+        if os.path.exists(args.source + '.meta'):
+            with open(args.source + '.meta', 'r') as f:
+                meta = json.load(f)
+        write_backup(args.target, data, meta)
+    print(f"Wrote {len(data)} entries to {args.target}")
+
+
+if __name__ == "__main__":
+    main()
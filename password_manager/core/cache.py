@@ -0,0 +1,90 @@
+"""
+Short-lived cache of decrypted secrets
+"""
+import time
+from collections import OrderedDict
+
+
+class SecretCache:
+    """
+    LRU cache of decrypted passwords keyed by website.
+
+    Each item remembers the ciphertext it was decrypted from and is only
+    returned while the stored ciphertext is unchanged, so a stale
+    plaintext is never served even if the vault changes behind the cache.
+    Items expire after ttl seconds, and the least recently used ones are
+    evicted once max_items or max_bytes is exceeded. Expired items are
+    wiped whenever the cache is used and by expire(), which long-running
+    callers should also call on a timer. Plaintexts are held in bytearrays
+    that invalidate() and clear() overwrite; copies handed out to callers
+    are outside its reach.
+    """
+
+    def __init__(self, ttl=60, max_items=256, max_bytes=64 * 1024):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        # Expiry times in the order items were put, which with a single
+        # ttl is also the order they expire in
+        self._expires = OrderedDict()
+        self._bytes = 0
+
+    def get(self, website, token):
+        self.expire()
+        item = self._items.get(website)
+        if item is None:
+            return None
+        cached_token, plaintext = item
+        if cached_token != token:
+            self.invalidate(website)
+            return None
+        self._items.move_to_end(website)
+        return plaintext.decode()
+
+    def put(self, website, token, plaintext):
+        self.expire()
+        if self.ttl <= 0 or self.max_items <= 0:
+            return
+        self.invalidate(website)
+        value = bytearray(plaintext.encode())
+        if len(value) > self.max_bytes:
+            return
+        self._items[website] = (token, value)
+        self._expires[website] = time.monotonic() + self.ttl
+        self._bytes += len(value)
+        while len(self._items) > self.max_items or self._bytes > self.max_bytes:
+            self.invalidate(next(iter(self._items)))
+
+    def expire(self):
+        """
+        Wipe every item whose ttl has run out
+        """
+        now = time.monotonic()
+        while self._expires:
+            website, expires = next(iter(self._expires.items()))
+            if expires >= now:
+                break
+            self.invalidate(website)
+
+    def invalidate(self, website):
+        item = self._items.pop(website, None)
+        self._expires.pop(website, None)
+        if item is not None:
+            self._bytes -= len(item[1])
+            _wipe(item[1])
+
+    def clear(self):
+        for item in self._items.values():
+            _wipe(item[1])
+        self._items.clear()
+        self._expires.clear()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+
+def _wipe(value):
+    for i in range(len(value)):
+        value[i] = 0
@@ -3,57 +3,210 @@ Database functionality for storing password entries
 """
 import json
 import os
+import shutil
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from . import migrations
+from .index import SecondaryIndex
+from .journal import Journal
+from .writer import BackgroundWriter
 from ..config.settings import Settings
 
 
+TIMESTAMP_FIELDS = ('created_at', 'updated_at', 'last_accessed')
+
+
 class Database:
     def __init__(self):
         self.settings = Settings()
         self.db_file = self.settings.get("database_path", "passwords.json")
+        # The VaultLock taken by open_database, released on close
+        self.vault_lock = None
+        self.journal = None
+        if self.settings.get("journal_mode", False):
+            self.journal = Journal(
+                self.db_file + '.journal',
+                compact_bytes=self.settings.get(
+                    "journal_compact_bytes", 1024 * 1024),
+                compact_ratio=self.settings.get("journal_compact_ratio", 0.5))
+        self._pending = None
+        self._meta_dirty = False
+        self.meta = {}
         self.data = self.load_database()
+        self.index = SecondaryIndex(self.data)
+        # Snapshot writes happen on a background thread; journal appends are
+        # already small and stay synchronous
+        self.writer = None
+        if self.settings.get("background_writes", True) and not self.journal:
+            self.writer = BackgroundWriter(
+                self._write_snapshot,
+                delay=self.settings.get("write_delay_ms", 0) / 1000)
 
     def load_database(self):
-        if os.path.exists(self.db_file):
+        document = self.read_document(self.db_file)
+        if migrations.schema_version(document) < migrations.SCHEMA_VERSION:
+            document = self._migrate(document)
+        self.meta = document['meta']
+        data = document['entries']
+        # Replay a journal even when journal_mode is off: it may hold the
+        # only copy of recent changes
+        journal = self.journal or Journal(self.db_file + '.journal')
+        if journal.size():
+            journal.replay(data)
+            if not self.journal:
+                # Fold it into the snapshot so it is never replayed over a
+                # newer one later
+                write_json_atomic(self.db_file, migrations.new_document(data, self.meta))
+                journal.reset()
+        return data
+
+    def _migrate(self, document):
+        """
+        Upgrade an older database file once: keep a copy of the original
+        next to it, then write the converted document in its place so later
+        loads can skip the conversion
+        """
+        version = migrations.schema_version(document)
+        shutil.copy2(self.db_file, f"{self.db_file}.v{version}.bak")
+        document = migrations.upgrade(document)
+        write_json_atomic(self.db_file, document)
+        return document
+
+    @staticmethod
+    def read_document(path):
+        if os.path.exists(path):
             try:
-                with open(self.db_file, 'r') as f:
-                    data = json.load(f)
-
-                    # Handle legacy format with "passwords" array
-                    if "passwords" in data and isinstance(data["passwords"], list):
-                        # Convert array format to dict format
-                        converted_data = {}
-                        for entry in data["passwords"]:
-                            if "website" in entry:
-                                website = entry["website"]
-                                converted_data[website] = {
-                                    'username': entry.get('username', ''),
-                                    'password': entry.get('password', ''),
-                                    'url': entry.get('url', ''),
-                                    'email': entry.get('email', ''),
-                                    'additional_info': entry.get('additional_info', '')
-                                }
-                        return converted_data
-
-                    return data
+                with open(path, 'r') as f:
+                    return json.load(f)
             except json.JSONDecodeError:
-                return {}
-        return {}
+                pass
+        return migrations.new_document()
+
+    @staticmethod
+    def read_file(path):
+        """
+        Return the entries of a database or backup file of any schema version
+        """
+        return read_backup(path)['entries']
+
+    def _document(self):
+        # Entries are never modified in place, so shallow copies are a
+        # consistent snapshot for the writer thread
+        return migrations.new_document(dict(self.data), dict(self.meta))
 
     def save_database(self):
-        with open(self.db_file, 'w') as f:
-            json.dump(self.data, f, indent=4)
+        if self.writer:
+            self.writer.notify(self._document())
+            return
+        self._write_snapshot(self._document())
+        if self.journal:
+            self.journal.reset()
+
+    def _write_snapshot(self, document):
+        write_json_atomic(self.db_file, document)
+
+    def get_meta(self, key, default=None):
+        return self.meta.get(key, default)
+
+    def set_meta(self, key, value):
+        """
+        Store a value in the vault header alongside the entries
+        """
+        self.meta[key] = value
+        if self._pending is not None:
+            self._meta_dirty = True
+            return
+        self.save_database()
+
+    def flush(self, timeout=None):
+        """
+        Block until every change made so far is written to disk
+        """
+        if self.writer:
+            return self.writer.flush(timeout)
+        return True
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        if self.vault_lock is not None:
+            self.vault_lock.release()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Defer persistence until the block exits and then write once.
+        If an exception escapes, the in-memory data is rolled back and
+        nothing is written. Nested blocks join the outermost one.
+        """
+        if self._pending is not None:
+            yield self
+            return
+        saved_data = dict(self.data)
+        saved_meta = dict(self.meta)
+        self._pending = []
+        try:
+            yield self
+        except BaseException:
+            self.data = saved_data
+            self.meta = saved_meta
+            self.index.rebuild(self.data)
+            raise
+        finally:
+            records, self._pending = self._pending, None
+            meta_dirty, self._meta_dirty = self._meta_dirty, False
+        if meta_dirty:
+            self.save_database()
+        elif records:
+            self._persist(records)
+
+    def _commit(self, *records):
+        """
+        Persist a mutation, or queue it while a transaction is open
+        """
+        if self._pending is not None:
+            self._pending.extend(records)
+            return
+        self._persist(records)
+
+    def _persist(self, records):
+        """
+        Append records to the journal when journaling is enabled,
+        otherwise rewrite the whole file
+        """
+        if not self.journal:
+            self.save_database()
+            return
+        self.journal.append(records)
+        snapshot_size = 0
+        if os.path.exists(self.db_file):
+            snapshot_size = os.path.getsize(self.db_file)
+        if self.journal.needs_compaction(snapshot_size):
+            self.save_database()
+
+    def _put(self, website, entry):
+        # Entries are replaced rather than modified in place so a
+        # transaction can roll back with a shallow copy of self.data
+        old_entry = self.data.get(website)
+        if old_entry is not None:
+            self.index.remove(website, old_entry)
+        self.data[website] = entry
+        self.index.add(website, entry)
+
+    def _remove(self, website):
+        self.index.remove(website, self.data.pop(website))
 
     def add_entry(self, website, username, encrypted_password, url='', email='', additional_info=''):
         if website in self.data:
             return False
-        self.data[website] = {
-            'username': username,
-            'password': encrypted_password,
-            'url': url,
-            'email': email,
-            'additional_info': additional_info
-        }
-        self.save_database()
+        self._put(website, new_entry(username, encrypted_password, url, email, additional_info))
+        self._commit(Journal.put(website, self.data[website]))
         return True
 
     def get_entry(self, website):
@@ -62,34 +215,240 @@ class Database:
     def update_entry(self, website, encrypted_password):
         if website not in self.data:
             return False
-        self.data[website]['password'] = encrypted_password
-        self.save_database()
+        self._put(website, dict(self.data[website], password=encrypted_password,
+                                updated_at=timestamp()))
+        self._commit(Journal.put(website, self.data[website]))
         return True
 
     def delete_entry(self, website):
         if website not in self.data:
             return False
-        del self.data[website]
-        self.save_database()
+        self._remove(website)
+        self._commit(Journal.delete(website))
         return True
 
-    def list_websites(self):
-        return list(self.data.keys())
+    def list_websites(self, sort_by=None, reverse=False):
+        if sort_by is None:
+            return list(self.data.keys())
+        return sort_websites(self.data.items(), sort_by, reverse)
 
     def update_entry_full(self, old_website, new_website, username, encrypted_password, url, email, additional_info):
         if old_website not in self.data:
             return False
         # If website name is changed, move the entry
+        previous = self.data[old_website]
         if old_website != new_website:
             if new_website in self.data:
                 return False  # Don't overwrite existing
-            self.data[new_website] = self.data.pop(old_website)
-        self.data[new_website] = {
-            'username': username,
-            'password': encrypted_password,
-            'url': url,
-            'email': email,
-            'additional_info': additional_info
-        }
-        self.save_database()
+            self._remove(old_website)
+        self._put(new_website, new_entry(username, encrypted_password, url, email,
+                                         additional_info, previous=previous))
+        records = [Journal.put(new_website, self.data[new_website])]
+        if old_website != new_website:
+            records.insert(0, Journal.delete(old_website))
+        self._commit(*records)
         return True
+
+    def touch_entries(self, access_times):
+        """
+        Record last_accessed times for many entries with a single write
+        """
+        with self.transaction():
+            for website, accessed in access_times.items():
+                if website in self.data:
+                    self._put(website, dict(self.data[website], last_accessed=accessed))
+                    self._commit(Journal.put(website, self.data[website]))
+
+    def find_by_username(self, username):
+        return list(self.index.find('username', username))
+
+    def find_by_email(self, email):
+        return list(self.index.find('email', email))
+
+    def find_by_host(self, host):
+        return list(self.index.find('host', host))
+
+    def find_by_domain(self, domain):
+        """
+        Websites whose URL is on domain or any of its subdomains
+        """
+        return list(self.index.find('domain', domain))
+
+    def export_backup(self, path):
+        """
+        Write the current data, including any journaled changes, to path
+        """
+        write_backup(path, self.data, self.meta)
+
+    def import_backup(self, path):
+        """
+        Replace the database with the contents of a backup file. The vault
+        header is only replaced if the backup carries one.
+        """
+        document = read_backup(path)
+        self.data = document['entries']
+        if document['meta']:
+            self.meta = document['meta']
+        self.index.rebuild(self.data)
+        self.save_database()
+
+
+def timestamp():
+    """
+    Current UTC time as an ISO 8601 string, which sorts chronologically
+    """
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+
+
+def new_entry(username, encrypted_password, url='', email='', additional_info='', previous=None):
+    """
+    Build an entry, keeping created_at and last_accessed of the entry it
+    replaces
+    """
+    now = timestamp()
+    previous = previous or {}
+    return {
+        'username': username,
+        'password': encrypted_password,
+        'url': url,
+        'email': email,
+        'additional_info': additional_info,
+        'created_at': previous.get('created_at') or now,
+        'updated_at': now,
+        'last_accessed': previous.get('last_accessed', '')
+    }
+
+
+def sort_websites(items, sort_by, reverse=False):
+    """
+    Order (website, entry) pairs by a timestamp field. Entries written
+    before timestamps existed sort as the oldest.
+    """
+    if sort_by not in TIMESTAMP_FIELDS:
+        raise ValueError(f"Cannot sort by {sort_by!r}")
+    return [website for website, entry in sorted(
+        items, key=lambda item: item[1].get(sort_by) or '', reverse=reverse)]
+
+
+def write_json_atomic(path, data, indent=4):
+    """
+    Write data as JSON to a temporary file and swap it in, so a crash
+    mid-write never leaves a truncated file behind
+    """
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        # Make the rename itself durable
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)),
+                         os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def read_backup(path):
+    """
+    Read a database or backup file of any schema version as a current
+    document with "meta" and "entries"
+    """
+    return migrations.upgrade(Database.read_document(path))
+
+
+def write_backup(path, entries, meta):
+    """
+    Write entries and the vault header to path in the JSON database format
+    """
+    with open(path, 'w') as f:
+        json.dump(migrations.new_document(entries, meta), f, indent=4)
+
+
+def load_json_vault(path):
+    """
+    Read a JSON database file, including any records still in its journal,
+    as a current document. Other backends use this to take over an
+    existing JSON vault together with its header.
+    """
+    document = read_backup(path)
+    Journal(path + '.journal').replay(document['entries'])
+    return document
+
+
+class VaultLockedError(RuntimeError):
+    pass
+
+
+class VaultLock:
+    """
+    Exclusive lock on a file next to the vault, held while a process has
+    the vault open. Every backend keeps the vault in memory and writes it
+    back, so a second writer would silently undo the first one's changes.
+    Acquiring fails straight away instead of waiting; the lock goes away
+    with the process even if it is never released.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        f = open(self.path, 'a+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            raise VaultLockedError(
+                "The vault is already open in another process: the application, "
+                "the unlock agent or the API server")
+        self._file = f
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is None:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+
+
+def open_database():
+    """
+    Create the storage backend selected by the "storage_backend" setting.
+    Raises VaultLockedError while another process has the vault open.
+    """
+    settings = Settings()
+    # Every backend takes over the JSON vault, so they share its lock
+    lock = VaultLock(settings.get("database_path", "passwords.json") + '.lock')
+    lock.acquire()
+    try:
+        db = _create_backend(settings.get("storage_backend", "json"))
+    except BaseException:
+        lock.release()
+        raise
+    db.vault_lock = lock
+    return db
+
+
+def _create_backend(backend):
+    if backend == "sqlite":
+        from .sqlite_database import SQLiteDatabase
+        return SQLiteDatabase()
+    if backend == "indexed":
+        from .indexed_database import IndexedDatabase
+        return IndexedDatabase()
+    if backend == "binary":
+        from .binary_vault import BinaryVaultDatabase
+        return BinaryVaultDatabase()
+    if backend == "sharded":
+        from .sharded_database import ShardedDatabase
+        return ShardedDatabase()
+    return Database()
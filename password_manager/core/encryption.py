@@ -1,39 +1,338 @@
 """
 Encryption functionality for secure password storage
 """
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 import base64
+import binascii
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 import os
 
 
+PBKDF2 = 'pbkdf2-sha256'
+SCRYPT = 'scrypt'
+KDF_ALGORITHMS = (PBKDF2, SCRYPT)
+
+# Parameters used by vaults created before they were stored in the vault
+# header
+LEGACY_KDF = {
+    'algorithm': PBKDF2,
+    'salt': base64.b64encode(b'password_manager_salt').decode(),
+    'iterations': 100000
+}
+
+MIN_PBKDF2_ITERATIONS = 100000
+MIN_SCRYPT_N = 2 ** 14
+# 256 MiB of memory with r=8
+MAX_SCRYPT_N = 2 ** 18
+
+# Entry record formats
+RECORD_VERSION = b'\x02'
+SEALED_VERSION = b'\x03'
+FERNET_VERSION = b'\x80'
+RECORD_KEY_INFO = b'password_manager record key v2'
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+# Fields of a sealed record, in directory order
+SEALED_FIELDS = ('password', 'username', 'url', 'email', 'additional_info')
+RECORD_ID_SIZE = 8
+DIRECTORY_ENTRY = struct.Struct('<BI')
+
+# Batches at least this large are split into chunks of this size and
+# processed on a thread pool; the cryptography primitives release the GIL
+PARALLEL_CHUNK = 256
+
+
+def _kdf(params):
+    salt = base64.b64decode(params['salt'])
+    if params['algorithm'] == PBKDF2:
+        return PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            iterations=params['iterations'],
+        )
+    if params['algorithm'] == SCRYPT:
+        return Scrypt(salt=salt, length=32, n=params['n'], r=params['r'], p=params['p'])
+    raise ValueError(f"Unsupported key derivation function {params['algorithm']!r}")
+
+
+def derive_key(master_password, params=None):
+    """
+    Derive the vault key from the master password with the KDF parameters
+    stored in the vault header (LEGACY_KDF if there are none)
+    """
+    kdf = _kdf(params or LEGACY_KDF)
+    return base64.urlsafe_b64encode(kdf.derive(master_password.encode()))
+
+
+def new_kdf_params(algorithm=PBKDF2, iterations=MIN_PBKDF2_ITERATIONS,
+                   n=MIN_SCRYPT_N, r=8, p=1):
+    """
+    KDF parameters with a fresh random salt
+    """
+    params = {'algorithm': algorithm, 'salt': base64.b64encode(os.urandom(16)).decode()}
+    if algorithm == PBKDF2:
+        params['iterations'] = iterations
+    elif algorithm == SCRYPT:
+        params.update(n=n, r=r, p=p)
+    else:
+        raise ValueError(f"Unsupported key derivation function {algorithm!r}")
+    return params
+
+
+def _time_derivation(params):
+    # Best of three, so a one-off stall does not skew the estimate
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        _kdf(params).derive(b'calibration')
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibrate_kdf(algorithm=PBKDF2, target_ms=300):
+    """
+    Benchmark algorithm on this machine and return new parameters whose
+    derivation takes about target_ms. The cost never drops below the
+    minimums above, so slow machines get slower unlocks rather than
+    weaker keys.
+    """
+    target = target_ms / 1000
+    if algorithm == PBKDF2:
+        probe = 10000
+        elapsed = _time_derivation(new_kdf_params(PBKDF2, iterations=probe))
+        iterations = int(probe * target / elapsed) // 1000 * 1000
+        return new_kdf_params(PBKDF2, iterations=max(iterations, MIN_PBKDF2_ITERATIONS))
+    if algorithm == SCRYPT:
+        # scrypt cost grows linearly with n, which must be a power of two
+        n = MIN_SCRYPT_N
+        elapsed = _time_derivation(new_kdf_params(SCRYPT, n=n))
+        while n < MAX_SCRYPT_N and elapsed * 2 <= target:
+            n *= 2
+            elapsed *= 2
+        return new_kdf_params(SCRYPT, n=n)
+    raise ValueError(f"Unsupported key derivation function {algorithm!r}")
+
+
+def describe_kdf(params):
+    if params['algorithm'] == PBKDF2:
+        return f"PBKDF2-SHA256, {params['iterations']:,} iterations"
+    return f"scrypt, N={params['n']:,}, r={params['r']}, p={params['p']}"
+
+
+def generate_key():
+    """
+    Random data key for envelope encryption
+    """
+    return Fernet.generate_key()
+
+
+def wrap_key(wrapping_key, key):
+    """
+    Encrypt the data key under the key derived from the master password
+    """
+    return Fernet(bytes(wrapping_key)).encrypt(bytes(key)).decode()
+
+
+def unwrap_key(wrapping_key, wrapped_key):
+    return Fernet(bytes(wrapping_key)).decrypt(wrapped_key.encode())
+
+
+def is_sealed(token):
+    """
+    Whether an entry's password token is a whole-record sealed record
+    """
+    try:
+        return base64.urlsafe_b64decode(token[:4])[:1] == SEALED_VERSION
+    except (binascii.Error, ValueError):
+        return False
+
+
+def _decode(token):
+    try:
+        return base64.urlsafe_b64decode(token + b'=' * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        raise InvalidToken
+
+
+def _field_aad(record_id, number):
+    return SEALED_VERSION + record_id + bytes([number])
+
+
 class Encryption:
+    """
+    Encrypts entry passwords with the vault data key.
+
+    New records use a compact AEAD format: a version byte (RECORD_VERSION),
+    a 12 byte nonce and the AES-256-GCM ciphertext with its tag, base64url
+    encoded without padding. The AES key is derived from the data key with
+    HKDF. Fernet tokens written by earlier versions are still decrypted and
+    are replaced by the new format whenever their entry is written again.
+    """
+
     def __init__(self):
         self.key = None
         self.fernet = None
+        self.aead = None
 
-    def initialize(self, master_password):
-        # Generate a key from the master password
-        salt = b'password_manager_salt'  # In production, use a secure random salt
-        kdf = PBKDF2HMAC(
+    def initialize(self, master_password, kdf_params=None):
+        self.set_key(derive_key(master_password, kdf_params))
+
+    def set_key(self, key):
+        """
+        Use an already derived key, e.g. the one held by a KeySession
+        """
+        self.key = bytes(key)
+        self.fernet = Fernet(self.key)
+        self.aead = AESGCM(HKDF(
             algorithm=hashes.SHA256(),
             length=32,
-            salt=salt,
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(master_password.encode()))
-        self.key = key
-        self.fernet = Fernet(key)
+            salt=None,
+            info=RECORD_KEY_INFO,
+        ).derive(base64.urlsafe_b64decode(self.key)))
 
-    def encrypt(self, data):
-        if not self.fernet:
-            raise ValueError("Encryption not initialized")
-        return self.fernet.encrypt(data.encode()).decode()
+    def clear(self):
+        self.key = None
+        self.fernet = None
+        self.aead = None
 
-    def decrypt(self, encrypted_data):
+    def _check(self):
         if not self.fernet:
             raise ValueError("Encryption not initialized")
-        return self.fernet.decrypt(encrypted_data.encode()).decode()
 
+    def encrypt_bytes(self, data):
+        """
+        Encrypt bytes into a record token (bytes)
+        """
+        self._check()
+        nonce = os.urandom(NONCE_SIZE)
+        record = RECORD_VERSION + nonce + self.aead.encrypt(nonce, data, RECORD_VERSION)
+        return base64.urlsafe_b64encode(record).rstrip(b'=')
+
+    def decrypt_bytes(self, token):
+        """
+        Decrypt a record token or a legacy Fernet token. For a sealed
+        record this is its password field. Raises InvalidToken if it was
+        not produced with this key.
+        """
+        self._check()
+        record = _decode(token)
+        if record[:1] == FERNET_VERSION:
+            return self.fernet.decrypt(token)
+        if record[:1] == SEALED_VERSION:
+            return self._open(record, ('password',)).get('password', '').encode()
+        if record[:1] != RECORD_VERSION or len(record) < 1 + NONCE_SIZE + TAG_SIZE:
+            raise InvalidToken
+        try:
+            return self.aead.decrypt(record[1:1 + NONCE_SIZE], record[1 + NONCE_SIZE:],
+                                     RECORD_VERSION)
+        except InvalidTag:
+            raise InvalidToken
+
+    def seal(self, fields):
+        """
+        Encrypt a dict of SEALED_FIELDS strings into one sealed record.
+
+        The record starts with SEALED_VERSION, a random record id and a
+        directory of (field number, segment length) pairs, followed by one
+        AES-GCM segment per non-empty field. Each segment is bound to the
+        record id and its field number, so a field can be decrypted on its
+        own but not moved to another record or field.
+        """
+        self._check()
+        record_id = os.urandom(RECORD_ID_SIZE)
+        directory = bytearray()
+        segments = bytearray()
+        count = 0
+        for number, name in enumerate(SEALED_FIELDS):
+            value = fields.get(name) or ''
+            if not value:
+                continue
+            nonce = os.urandom(NONCE_SIZE)
+            segment = nonce + self.aead.encrypt(
+                nonce, value.encode(), _field_aad(record_id, number))
+            directory += DIRECTORY_ENTRY.pack(number, len(segment))
+            segments += segment
+            count += 1
+        record = SEALED_VERSION + record_id + bytes([count]) + directory + segments
+        return base64.urlsafe_b64encode(record).rstrip(b'=').decode()
+
+    def unseal(self, token, names=SEALED_FIELDS):
+        """
+        Decrypt only the named fields of a sealed record. Fields missing
+        from the record are returned as empty strings.
+        """
+        self._check()
+        record = _decode(token.encode())
+        if record[:1] != SEALED_VERSION:
+            raise InvalidToken
+        return self._open(record, names)
+
+    def _open(self, record, names):
+        wanted = {SEALED_FIELDS.index(name) for name in names}
+        record_id = record[1:1 + RECORD_ID_SIZE]
+        fields = {name: '' for name in names}
+        try:
+            count = record[1 + RECORD_ID_SIZE]
+            position = 2 + RECORD_ID_SIZE + count * DIRECTORY_ENTRY.size
+            for i in range(count):
+                number, length = DIRECTORY_ENTRY.unpack_from(
+                    record, 2 + RECORD_ID_SIZE + i * DIRECTORY_ENTRY.size)
+                if number in wanted:
+                    segment = record[position:position + length]
+                    fields[SEALED_FIELDS[number]] = self.aead.decrypt(
+                        segment[:NONCE_SIZE], segment[NONCE_SIZE:],
+                        _field_aad(record_id, number)).decode()
+                position += length
+        except (InvalidTag, IndexError, ValueError, struct.error):
+            raise InvalidToken
+        return fields
 
+    def _map(self, func, items, workers=None):
+        items = list(items)
+        if len(items) < 2 * PARALLEL_CHUNK or workers == 1 or os.cpu_count() == 1:
+            return [func(item) for item in items]
+        chunks = [items[i:i + PARALLEL_CHUNK]
+                  for i in range(0, len(items), PARALLEL_CHUNK)]
+        with ThreadPoolExecutor(workers) as executor:
+            results = executor.map(lambda chunk: [func(item) for item in chunk], chunks)
+            return [result for chunk in results for result in chunk]
+
+    def encrypt_many(self, items, workers=None):
+        """
+        Encrypt an iterable of bytes with one cipher, returning a list of
+        token bytes in the same order
+        """
+        self._check()
+        return self._map(self.encrypt_bytes, items, workers)
+
+    def decrypt_many(self, tokens, workers=None):
+        """
+        Decrypt an iterable of token bytes, returning a list of plaintext
+        bytes in the same order. Tokens that fail to decrypt give None
+        instead of aborting the whole batch.
+        """
+        self._check()
+
+        def decrypt(token):
+            try:
+                return self.decrypt_bytes(token)
+            except InvalidToken:
+                return None
+        return self._map(decrypt, tokens, workers)
+
+    def encrypt(self, data):
+        return self.encrypt_bytes(data.encode()).decode()
+
+    def decrypt(self, encrypted_data):
+        return self.decrypt_bytes(encrypted_data.encode()).decode()
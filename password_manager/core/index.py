@@ -0,0 +1,60 @@
+"""
+In-memory secondary indexes over database entries
+"""
+from ..utils.url_utils import url_host
+
+
+class SecondaryIndex:
+    """
+    Maps username, email, URL host and parent domains to the websites that
+    use them. Entries are added and removed incrementally as the database
+    changes, so lookups never have to walk every entry. An entry may carry
+    its normalized host as "url_host" instead of a "url".
+    """
+
+    FIELDS = ('username', 'email', 'host', 'domain')
+
+    def __init__(self, data=None):
+        self.rebuild(data or {})
+
+    def rebuild(self, data):
+        self._maps = {field: {} for field in self.FIELDS}
+        for website, entry in data.items():
+            self.add(website, entry)
+
+    @staticmethod
+    def _keys(entry):
+        host = entry['url_host'] if 'url_host' in entry else url_host(entry.get('url', ''))
+        keys = {
+            'username': [entry.get('username', '')],
+            'email': [entry.get('email', '')],
+            'host': [host],
+            'domain': []
+        }
+        # Register the host under every parent domain with at least two
+        # labels so "*.example.com" queries are a single lookup
+        labels = host.split('.')
+        for i in range(len(labels) - 1):
+            keys['domain'].append('.'.join(labels[i:]))
+        return keys
+
+    def add(self, website, entry):
+        for field, values in self._keys(entry).items():
+            for value in values:
+                if value:
+                    self._maps[field].setdefault(value, set()).add(website)
+
+    def remove(self, website, entry):
+        for field, values in self._keys(entry).items():
+            for value in values:
+                websites = self._maps[field].get(value)
+                if websites is None:
+                    continue
+                websites.discard(website)
+                if not websites:
+                    del self._maps[field][value]
+
+    def find(self, field, value):
+        if field in ('host', 'domain'):
+            value = url_host(value)
+        return set(self._maps[field].get(value, ()))
@@ -0,0 +1,298 @@
+"""
+Index-only vault loading with on-demand record fetch
+"""
+import json
+import os
+from contextlib import contextmanager
+from .database import (load_json_vault, new_entry, read_backup, sort_websites,
+                       timestamp, write_backup)
+from .index import SecondaryIndex
+from ..config.settings import Settings
+from ..utils.url_utils import url_host
+
+
+class IndexedDatabase:
+    """
+    Vault split into a compact index and an append-only record file.
+
+    The index (db_file) maps each website to the offset and length of its
+    record plus a little metadata, and is the only thing read at startup.
+    Record bodies live in a separate data file and are parsed only when
+    get_entry asks for them. Updates append a new record and rewrite the
+    index; superseded records are reclaimed by compaction, which writes a
+    new data file generation before switching the index over to it.
+    """
+
+    def __init__(self):
+        self.settings = Settings()
+        self.db_file = self.settings.get(
+            "indexed_database_path", "passwords.vault")
+        # The VaultLock taken by open_database, released on close
+        self.vault_lock = None
+        self.compact_ratio = self.settings.get("vault_compact_ratio", 1.0)
+        self._pending = None
+        self.index = self._load_index()
+        # Lookups by username, email and host, built from the metadata in
+        # the index so no record body is read
+        self.lookup = SecondaryIndex(self._index_metadata())
+        self._fh = open(self._data_path(), 'a+b')
+        json_file = self.settings.get("database_path", "passwords.json")
+        if not os.path.exists(self.db_file):
+            if os.path.exists(json_file):
+                document = load_json_vault(json_file)
+                self.index['meta'] = document['meta']
+                self._import_data(document['entries'])
+            else:
+                self._write_index()
+
+    def _load_index(self):
+        if os.path.exists(self.db_file):
+            with open(self.db_file, 'r') as f:
+                index = json.load(f)
+            # Index files written before the vault header existed
+            index.setdefault('meta', {})
+            return index
+        return {'generation': 1, 'entries': {}, 'meta': {}}
+
+    def _index_metadata(self):
+        return {website: slot[2] for website, slot in self.index['entries'].items()}
+
+    def _data_path(self, generation=None):
+        if generation is None:
+            generation = self.index['generation']
+        return f"{self.db_file}.data.{generation}"
+
+    def _write_index(self):
+        tmp_file = self.db_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.index, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.db_file)
+
+    def _append_record(self, entry):
+        body = json.dumps(entry, separators=(',', ':')).encode()
+        self._fh.seek(0, os.SEEK_END)
+        offset = self._fh.tell()
+        self._fh.write(body)
+        return offset, len(body)
+
+    def _read_record(self, slot):
+        offset, length = slot[0], slot[1]
+        self._fh.seek(offset)
+        return json.loads(self._fh.read(length))
+
+    @staticmethod
+    def _metadata(entry):
+        return {
+            'username': entry.get('username', ''),
+            'email': entry.get('email', ''),
+            'url_host': url_host(entry.get('url', '')),
+            'created_at': entry.get('created_at', ''),
+            'updated_at': entry.get('updated_at', ''),
+            'last_accessed': entry.get('last_accessed', '')
+        }
+
+    def _put(self, website, entry):
+        offset, length = self._append_record(entry)
+        old_slot = self.index['entries'].get(website)
+        if old_slot is not None:
+            self.lookup.remove(website, old_slot[2])
+        self.index['entries'][website] = [offset, length, self._metadata(entry)]
+        self.lookup.add(website, self.index['entries'][website][2])
+
+    def _remove(self, website):
+        self.lookup.remove(website, self.index['entries'].pop(website)[2])
+
+    def get_meta(self, key, default=None):
+        return self.index['meta'].get(key, default)
+
+    def set_meta(self, key, value):
+        """
+        Store a value in the vault header, which is kept in the index file
+        """
+        self.index['meta'][key] = value
+        self._commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Defer the index rewrite until the block exits. If an exception
+        escapes the previous index is restored; records already appended
+        become garbage for the next compaction.
+        """
+        if self._pending is not None:
+            yield self
+            return
+        saved_index = {'generation': self.index['generation'],
+                       'entries': dict(self.index['entries']),
+                       'meta': dict(self.index['meta'])}
+        self._pending = False
+        try:
+            yield self
+        except BaseException:
+            self.index = saved_index
+            self.lookup.rebuild(self._index_metadata())
+            raise
+        finally:
+            dirty, self._pending = self._pending, None
+        if dirty:
+            self._persist()
+
+    def _commit(self):
+        if self._pending is not None:
+            self._pending = True
+            return
+        self._persist()
+
+    def _persist(self):
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        # Anything in the data file that the index no longer points at is
+        # garbage: superseded records and records from rolled back batches
+        live_bytes = sum(slot[1] for slot in self.index['entries'].values())
+        dead_bytes = self._fh.seek(0, os.SEEK_END) - live_bytes
+        if dead_bytes > max(live_bytes * self.compact_ratio, 64 * 1024):
+            self.compact()
+        else:
+            self._write_index()
+
+    def compact(self):
+        """
+        Copy live records into a new data file generation and switch the
+        index to it. A crash at any point leaves a consistent vault.
+        """
+        old_path = self._data_path()
+        generation = self.index['generation'] + 1
+        entries = {}
+        with open(self._data_path(generation), 'wb') as out:
+            for website, slot in self.index['entries'].items():
+                self._fh.seek(slot[0])
+                body = self._fh.read(slot[1])
+                entries[website] = [out.tell(), len(body), slot[2]]
+                out.write(body)
+            out.flush()
+            os.fsync(out.fileno())
+        self._fh.close()
+        self.index = {'generation': generation, 'entries': entries,
+                      'meta': self.index['meta']}
+        self._write_index()
+        self._fh = open(self._data_path(), 'a+b')
+        os.remove(old_path)
+
+    def _import_data(self, data):
+        with self.transaction():
+            for website, entry in data.items():
+                if website in self.index['entries']:
+                    self._remove(website)
+                self._put(website, entry)
+            self._commit()
+
+    def add_entry(self, website, username, encrypted_password, url='', email='', additional_info=''):
+        if website in self.index['entries']:
+            return False
+        self._put(website, new_entry(username, encrypted_password, url, email, additional_info))
+        self._commit()
+        return True
+
+    def get_entry(self, website):
+        slot = self.index['entries'].get(website)
+        if slot is None:
+            return None
+        entry = self._read_record(slot)
+        # Access times are only kept in the index so recording them never
+        # appends a record body
+        if slot[2].get('last_accessed'):
+            entry['last_accessed'] = slot[2]['last_accessed']
+        return entry
+
+    def update_entry(self, website, encrypted_password):
+        entry = self.get_entry(website)
+        if entry is None:
+            return False
+        entry['password'] = encrypted_password
+        entry['updated_at'] = timestamp()
+        self._put(website, entry)
+        self._commit()
+        return True
+
+    def delete_entry(self, website):
+        if website not in self.index['entries']:
+            return False
+        self._remove(website)
+        self._commit()
+        return True
+
+    def list_websites(self, sort_by=None, reverse=False):
+        if sort_by is not None:
+            return sort_websites(
+                ((website, slot[2]) for website, slot in self.index['entries'].items()),
+                sort_by, reverse)
+        return list(self.index['entries'].keys())
+
+    def update_entry_full(self, old_website, new_website, username, encrypted_password, url, email, additional_info):
+        previous = self.get_entry(old_website)
+        if previous is None:
+            return False
+        if old_website != new_website:
+            if new_website in self.index['entries']:
+                return False  # Don't overwrite existing
+            self._remove(old_website)
+        self._put(new_website, new_entry(username, encrypted_password, url, email,
+                                         additional_info, previous=previous))
+        self._commit()
+        return True
+
+    def touch_entries(self, access_times):
+        """
+        Record last_accessed times with a single index rewrite
+        """
+        entries = self.index['entries']
+        with self.transaction():
+            for website, accessed in access_times.items():
+                slot = entries.get(website)
+                if slot is not None:
+                    entries[website] = [slot[0], slot[1], dict(slot[2], last_accessed=accessed)]
+            self._commit()
+
+    def find_by_username(self, username):
+        return list(self.lookup.find('username', username))
+
+    def find_by_email(self, email):
+        return list(self.lookup.find('email', email))
+
+    def find_by_host(self, host):
+        return list(self.lookup.find('host', host))
+
+    def find_by_domain(self, domain):
+        return list(self.lookup.find('domain', domain))
+
+    def export_backup(self, path):
+        """
+        Write all entries to path in the JSON database format
+        """
+        data = {website: self.get_entry(website)
+                for website in self.index['entries']}
+        write_backup(path, data, self.index['meta'])
+
+    def import_backup(self, path):
+        """
+        Replace all entries with the contents of a JSON backup file. The
+        vault header is only replaced if the backup carries one.
+        """
+        document = read_backup(path)
+        with self.transaction():
+            for website in list(self.index['entries']):
+                self._remove(website)
+            if document['meta']:
+                self.index['meta'] = document['meta']
+            self._import_data(document['entries'])
+
+    def flush(self, timeout=None):
+        # Every commit is already durable
+        return True
+
+    def close(self):
+        self._fh.close()
+        if self.vault_lock is not None:
+            self.vault_lock.release()
@@ -0,0 +1,99 @@
+"""
+Append-only journal for incremental database persistence
+"""
+import json
+import os
+import zlib
+
+
+class Journal:
+    """
+    Log of database mutations stored next to the snapshot file.
+
+    Each line is "<crc32> <json record>". Records are either
+    {"op": "put", "key": ..., "value": ...} or {"op": "del", "key": ...},
+    so replaying a record twice leaves the data unchanged. That makes it
+    safe to crash between writing a new snapshot and truncating the log.
+    """
+
+    def __init__(self, path, compact_bytes=1024 * 1024, compact_ratio=0.5):
+        self.path = path
+        self.compact_bytes = compact_bytes
+        self.compact_ratio = compact_ratio
+
+    @staticmethod
+    def put(key, value):
+        return {'op': 'put', 'key': key, 'value': value}
+
+    @staticmethod
+    def delete(key):
+        return {'op': 'del', 'key': key}
+
+    @staticmethod
+    def encode(record):
+        payload = json.dumps(record, separators=(',', ':')).encode()
+        return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+    def append(self, records):
+        """
+        Append records in a single write and make them durable
+        """
+        chunk = b''.join(self.encode(record) for record in records)
+        if not chunk:
+            return
+        with open(self.path, 'ab') as f:
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay(self, data):
+        """
+        Apply every intact record to data. A torn or corrupt tail left by a
+        crash is dropped so later appends start from a clean line.
+        """
+        if not os.path.exists(self.path):
+            return data
+        good_offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                record = self._decode(line)
+                if record is None:
+                    break
+                if record['op'] == 'put':
+                    data[record['key']] = record['value']
+                elif record['op'] == 'del':
+                    data.pop(record['key'], None)
+                good_offset += len(line)
+        if good_offset < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_offset)
+        return data
+
+    def _decode(self, line):
+        if not line.endswith(b'\n'):
+            return None
+        checksum, _, payload = line.rstrip(b'\n').partition(b' ')
+        try:
+            if int(checksum, 16) != zlib.crc32(payload):
+                return None
+            record = json.loads(payload)
+        except ValueError:
+            return None
+        if record.get('op') not in ('put', 'del') or 'key' not in record:
+            return None
+        return record
+
+    def size(self):
+        if os.path.exists(self.path):
+            return os.path.getsize(self.path)
+        return 0
+
+    def needs_compaction(self, snapshot_size):
+        size = self.size()
+        if size >= self.compact_bytes:
+            return True
+        return snapshot_size > 0 and size >= snapshot_size * self.compact_ratio
+
+    def reset(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,80 @@
+"""
+Schema versions and upgrade steps for the JSON database format
+
+Version 0  legacy layout: {"passwords": [{"website": ..., ...}, ...]}
+Version 1  {website: entry}
+Version 2  {"schema_version": 2, "meta": {...}, "entries": {website: entry}}
+
+To change the format, bump SCHEMA_VERSION and register a function with
+@migration(previous_version) that turns a document of the previous
+version into the new one.
+"""
+
+SCHEMA_VERSION = 2
+
+MIGRATIONS = {}
+
+
+def migration(from_version):
+    def register(func):
+        MIGRATIONS[from_version] = func
+        return func
+    return register
+
+
+def schema_version(document):
+    if not isinstance(document, dict):
+        raise ValueError("Database file does not contain a JSON object")
+    if isinstance(document.get("schema_version"), int):
+        return document["schema_version"]
+    if "passwords" in document and isinstance(document["passwords"], list):
+        return 0
+    return 1
+
+
+def new_document(entries=None, meta=None):
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "meta": meta if meta is not None else {},
+        "entries": entries if entries is not None else {}
+    }
+
+
+def upgrade(document):
+    """
+    Run every migration needed to bring document to SCHEMA_VERSION
+    """
+    version = schema_version(document)
+    if version > SCHEMA_VERSION:
+        raise ValueError(
+            f"Database schema version {version} is newer than this application supports")
+    while version < SCHEMA_VERSION:
+        document = MIGRATIONS[version](document)
+        version = schema_version(document)
+    return document
+
+
+@migration(0)
+def _convert_passwords_array(document):
+    # Convert array format to dict format
+    converted_data = {}
+    for entry in document["passwords"]:
+        if "website" in entry:
+            website = entry["website"]
+            converted_data[website] = {
+                'username': entry.get('username', ''),
+                'password': entry.get('password', ''),
+                'url': entry.get('url', ''),
+                'email': entry.get('email', ''),
+                'additional_info': entry.get('additional_info', '')
+            }
+    return converted_data
+
+
+@migration(1)
+def _add_schema_envelope(document):
+    return {
+        "schema_version": 2,
+        "meta": {},
+        "entries": document
+    }
@@ -1,41 +1,590 @@
 """
 Core password manager functionality
 """
-from .database import Database
-from .encryption import Encryption
+import hmac
+import os
+from contextlib import contextmanager
+from .cache import SecretCache
+from .database import open_database, read_backup, timestamp, write_backup
+from .encryption import (LEGACY_KDF, PBKDF2, SEALED_FIELDS, Encryption, calibrate_kdf,
+                         derive_key, generate_key, is_sealed, unwrap_key, wrap_key)
+from .index import SecondaryIndex
+from .quick_unlock import QuickUnlock
+from .url_matcher import UrlMatcher, entry_host
+from .reencrypt import ReEncryption, finish_interrupted_swap
+from .session import (InvalidPasswordError, KeySession, check_master_password,
+                      key_check_value)
+from ..config.settings import Settings
 from ..utils.password_generator import generate_password
 
+# Vault header values that belong to the key setup of a vault
+HEADER_KEYS = ('kdf', 'key_check', 'wrapped_key', 'sealed_records')
+
+# Entries tried when verifying the password of a vault without a key check
+LEGACY_SAMPLE = 5
+
 
 class PasswordManager:
     def __init__(self):
-        self.db = Database()
+        settings = Settings()
+        self.db = open_database()
         self.encryption = Encryption()
+        self.session = KeySession()
+        # last_accessed updates are collected here and written in batches
+        # so that reading an entry does not rewrite the vault
+        self._access_times = {}
+        self.access_flush_count = settings.get("access_flush_count", 50)
+        # Decrypted passwords of recently opened entries
+        self.cache = SecretCache(
+            ttl=settings.get("secret_cache_ttl", 60),
+            max_items=settings.get("secret_cache_size", 256),
+            max_bytes=settings.get("secret_cache_max_bytes", 64 * 1024))
+        # Store every field of new entries in one sealed record instead of
+        # encrypting only the password
+        self.encrypt_metadata = settings.get("encrypt_metadata", False)
+        # Search index over the decrypted fields of sealed entries, which
+        # the database cannot index itself. Built on first search.
+        self._sealed = None
+        self._sealed_index = None
+        # Registrable domain index for matching page URLs to entries, also
+        # built on first use
+        self._matcher = None
+        # Optional PIN that reopens the vault after a lock without the full
+        # key derivation; it survives lock() but not close()
+        self.quick_unlock = QuickUnlock(
+            window=settings.get("quick_unlock_window", 900),
+            max_attempts=settings.get("quick_unlock_attempts", 3))
+
+    @property
+    def is_unlocked(self):
+        return self.session.is_unlocked
+
+    @property
+    def is_set_up(self):
+        """
+        Whether the vault has a master password: its header holds the key
+        check, or it is an older vault that already has entries
+        """
+        return (self.db.get_meta('key_check') is not None
+                or self.db.get_meta('wrapped_key') is not None
+                or bool(self.db.list_websites()))
+
+    def kdf_params(self):
+        """
+        KDF parameters from the vault header, or the fixed legacy ones for
+        vaults created before they were stored there
+        """
+        return self.db.get_meta('kdf') or LEGACY_KDF
+
+    def calibrate_kdf(self, algorithm=None, target_ms=None):
+        """
+        Benchmark this machine and return fresh KDF parameters that hit
+        the kdf_target_ms unlock latency
+        """
+        settings = Settings()
+        return calibrate_kdf(algorithm or settings.get("kdf_algorithm", PBKDF2),
+                             target_ms or settings.get("kdf_target_ms", 300))
+
+    def derive_master_key(self, master_password, new_vault=False):
+        """
+        Run the slow part of unlock or create_vault on its own and return
+        (kdf_params, master_key) to pass to them. It only reads the vault
+        header, so it can run on a worker thread while the GUI stays
+        responsive. With new_vault, an empty vault gets freshly calibrated
+        parameters as create_vault would choose them.
+        """
+        if new_vault and not self.db.list_websites():
+            kdf_params = self.calibrate_kdf()
+        else:
+            kdf_params = self.kdf_params()
+        return kdf_params, derive_key(master_password, kdf_params)
+
+    def create_vault(self, master_password, kdf_params=None, master_key=None):
+        """
+        Set up the master password of a new vault: a random data key
+        wrapped under a key derived with a random salt and a calibrated
+        KDF cost. A vault that already holds entries keeps its keys and is
+        just unlocked. master_key and kdf_params may come from
+        derive_master_key(master_password, new_vault=True).
+        """
+        if self.db.list_websites():
+            self.unlock(master_password, master_key)
+            return
+        self.session.set_key(generate_key())
+        self._wrap_data_key(master_password, kdf_params, master_key)
+        self.encryption.set_key(self.session.key)
+
+    def unlock(self, master_password, master_key=None):
+        """
+        Derive the master key once, unwrap the data key with it and share
+        that with the encryption layer. master_key, from
+        derive_master_key, skips the derivation. Raises
+        InvalidPasswordError for a wrong master password.
+        """
+        finish_interrupted_swap(self.db)
+        key_check = self.db.get_meta('key_check')
+        wrapped_key = self.db.get_meta('wrapped_key')
+        self.session.unlock(master_password, self.kdf_params(), key_check, wrapped_key,
+                            master_key)
+        self.encryption.set_key(self.session.key)
+        # The key check is only stored for a key that opens most of a
+        # legacy vault, not one that happens to open a stray entry
+        if key_check is None and not self._verify_legacy_key():
+            return
+        if wrapped_key is None:
+            self._wrap_data_key(master_password)
+
+    def enable_quick_unlock(self, pin):
+        """
+        Let pin reopen the vault for the next quick_unlock_window seconds.
+        Must be called while unlocked.
+        """
+        self.quick_unlock.enable(pin, self.session.key)
+
+    def unlock_with_pin(self, pin):
+        """
+        Reopen the vault with the quick unlock PIN. Raises
+        InvalidPasswordError for a wrong PIN and QuickUnlockUnavailable
+        when the master password is needed again.
+        """
+        key = self.quick_unlock.unlock(pin)
+        self.session.set_key(key)
+        self.encryption.set_key(self.session.key)
+
+    def _verify_legacy_key(self):
+        """
+        Vaults without a key check value are verified by decrypting their
+        first few entries. The password is accepted if any of them opens;
+        returns whether it opened the majority.
+        """
+        websites = self.db.list_websites()[:LEGACY_SAMPLE]
+        if not websites:
+            return True
+        opened = 0
+        for website in websites:
+            try:
+                self.encryption.decrypt(self.db.get_entry(website)['password'])
+                opened += 1
+            except Exception:
+                pass
+        if not opened:
+            self.lock()
+            raise InvalidPasswordError("Invalid master password")
+        return opened * 2 > len(websites)
+
+    def _wrap_data_key(self, master_password, kdf_params=None, master_key=None):
+        """
+        Wrap the session's data key under a key derived from
+        master_password with fresh KDF parameters and store the result in
+        the vault header in one write. For vaults that encrypted entries
+        directly with the password-derived key, this is the one-time move
+        to envelope encryption: that key becomes the data key, so no entry
+        is rewritten.
+        """
+        if master_key is None:
+            kdf_params = kdf_params or self.calibrate_kdf()
+            master_key = derive_key(master_password, kdf_params)
+        with self.db.transaction():
+            self.db.set_meta('kdf', kdf_params)
+            self.db.set_meta('key_check', key_check_value(master_key))
+            self.db.set_meta('wrapped_key', wrap_key(master_key, self.session.key))
+
+    def lock(self):
+        """
+        Forget the vault key and every cached plaintext until the next
+        unlock. A quick unlock PIN stays usable until it expires.
+        """
+        self.cache.clear()
+        self._sealed = None
+        self._sealed_index = None
+        self._matcher = None
+        self.encryption.clear()
+        self.session.lock()
+
+    def change_master_password(self, current_password, new_password):
+        """
+        Rewrap the data key under the new password. Entries are not
+        re-encrypted, so this costs the same for any vault size.
+        """
+        try:
+            self.verify_master_password(current_password)
+        except InvalidPasswordError:
+            return False
+        self._wrap_data_key(new_password)
+        return True
+
+    def verify_master_password(self, master_password):
+        """
+        Derive the master key for master_password and return it if it is
+        the vault's, otherwise raise InvalidPasswordError. Legacy vaults
+        without a key check value are checked against the unlocked data
+        key, so this needs the vault unlocked.
+        """
+        key_check = self.db.get_meta('key_check')
+        if key_check is not None:
+            return check_master_password(master_password, self.kdf_params(), key_check)
+        master_key = derive_key(master_password, self.kdf_params())
+        data_key = master_key
+        wrapped_key = self.db.get_meta('wrapped_key')
+        try:
+            if wrapped_key is not None:
+                data_key = unwrap_key(master_key, wrapped_key)
+            if hmac.compare_digest(bytes(data_key), self.session.key):
+                return master_key
+        except Exception:
+            pass
+        raise InvalidPasswordError("Invalid master password")
+
+    def rotate_data_key(self, master_password, progress=None):
+        """
+        Re-encrypt every entry under a new random data key. Vaults moved to
+        envelope encryption from the old format keep their password-derived
+        key as data key until this runs. An interrupted rotation resumes
+        when called again. Returns the websites that could not be
+        decrypted.
+        """
+        try:
+            return ReEncryption(self, master_password).run(progress)
+        finally:
+            # A PIN would otherwise still hand out the old data key
+            self.quick_unlock.discard()
+            self._sealed = None
+            self._sealed_index = None
+            self._matcher = None
+
+    def backup_needs_password(self, path):
+        """
+        True if the backup predates envelope encryption while this vault
+        uses it, so import_backup needs the backup's master password
+        """
+        return ('wrapped_key' not in read_backup(path)['meta']
+                and self.db.get_meta('wrapped_key') is not None)
+
+    def import_backup(self, path, backup_password=None):
+        """
+        Replace the vault with the contents of a backup file.
+
+        A backup with a vault header brings its own data key and master
+        password, so the vault is locked afterwards and the next unlock
+        uses the password the backup was made with. Entries of older
+        backups are encrypted directly with a key derived from the master
+        password of that time; they are re-encrypted under this vault's
+        data key, which needs backup_password, and the vault stays
+        unlocked. Returns the websites whose entries could not be
+        re-encrypted.
+        """
+        document = read_backup(path)
+        failed = []
+        if 'wrapped_key' in document['meta'] or self.db.get_meta('wrapped_key') is None:
+            source = path
+        else:
+            if backup_password is None:
+                raise ValueError("This backup needs the master password it was made with")
+            if not self.is_unlocked:
+                raise ValueError("Unlock the vault before importing this backup")
+            failed = self._reencrypt_backup(document, backup_password)
+            source = path + '.import'
+            write_backup(source, document['entries'], document['meta'])
+        self.cache.clear()
+        self.quick_unlock.discard()
+        self._sealed = None
+        self._sealed_index = None
+        self._matcher = None
+        try:
+            self.db.import_backup(source)
+        finally:
+            if source != path:
+                os.remove(source)
+        if source == path:
+            self.lock()
+        return failed
+
+    def _reencrypt_backup(self, document, backup_password):
+        """
+        Move the entries of a backup without a data key to this vault's
+        data key and give it this vault's header
+        """
+        meta = document['meta']
+        old = Encryption()
+        old.set_key(check_master_password(backup_password, meta.get('kdf') or LEGACY_KDF,
+                                          meta.get('key_check')))
+        failed = []
+        for website, entry in document['entries'].items():
+            token = entry['password']
+            try:
+                if is_sealed(token):
+                    entry['password'] = self.encryption.seal(old.unseal(token))
+                else:
+                    entry['password'] = self.encryption.encrypt(old.decrypt(token))
+            except Exception:
+                failed.append(website)
+        if document['entries'] and len(failed) == len(document['entries']):
+            raise InvalidPasswordError("Invalid master password for this backup")
+        for key in HEADER_KEYS:
+            meta.pop(key, None)
+            if self.db.get_meta(key) is not None:
+                meta[key] = self.db.get_meta(key)
+        return failed
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager that saves all changes made inside it at once.
+        add_password, update_entry_full and delete_password calls join
+        the open batch automatically.
+        """
+        try:
+            with self.db.transaction() as db:
+                yield db
+        except BaseException:
+            # The database rolled back, but the sealed and URL indexes
+            # were already updated for the changes; rebuild them on next use
+            self._sealed = None
+            self._sealed_index = None
+            self._matcher = None
+            raise
+
+    def _encrypt_fields(self, username, password, url, email, additional_info):
+        """
+        Return the username, password token, url, email and
+        additional_info to store. With encrypt_metadata all of them go
+        into one sealed record in the password slot and the plain fields
+        stay empty.
+        """
+        if not self.encrypt_metadata:
+            return (username, self.encryption.encrypt(password), url, email,
+                    additional_info)
+        if not self.db.get_meta('sealed_records'):
+            self.db.set_meta('sealed_records', True)
+        return ('', self.encryption.seal({
+            'password': password,
+            'username': username,
+            'url': url,
+            'email': email,
+            'additional_info': additional_info
+        }), '', '', '')
+
+    def _sealed_lookup(self):
+        """
+        Index over the decrypted username, email and URL of every sealed
+        entry
+        """
+        if self._sealed_index is None:
+            self._sealed = {}
+            if self.db.get_meta('sealed_records'):
+                for website in self.db.list_websites():
+                    token = self.db.get_entry(website)['password']
+                    if is_sealed(token):
+                        self._sealed[website] = self.encryption.unseal(
+                            token, ('username', 'url', 'email'))
+            self._sealed_index = SecondaryIndex(self._sealed)
+        return self._sealed_index
+
+    def _reindex_sealed(self, old_website, new_website=None, fields=None):
+        if self._sealed is None:
+            return
+        if old_website in self._sealed:
+            self._sealed_index.remove(old_website, self._sealed.pop(old_website))
+        if new_website is not None and self.encrypt_metadata:
+            self._sealed[new_website] = fields
+            self._sealed_index.add(new_website, fields)
+
+    def _url_matcher(self):
+        if self._matcher is None:
+            # Sealed entries keep their url encrypted; the sealed lookup
+            # has it decrypted already
+            self._sealed_lookup()
+            hosts = {}
+            for website in self.db.list_websites():
+                if website in self._sealed:
+                    url = self._sealed[website]['url']
+                else:
+                    url = self.db.get_entry(website).get('url', '')
+                hosts[website] = entry_host(website, url)
+            self._matcher = UrlMatcher(hosts)
+        return self._matcher
+
+    def _reindex_url(self, old_website, new_website=None, url=''):
+        if self._matcher is None:
+            return
+        self._matcher.remove(old_website)
+        if new_website is not None:
+            self._matcher.add(new_website, entry_host(new_website, url))
 
     def add_password(self, website, username, password, url='', email='', additional_info=''):
-        encrypted_password = self.encryption.encrypt(password)
-        return self.db.add_entry(website, username, encrypted_password, url, email, additional_info)
+        stored = self._encrypt_fields(username, password, url, email, additional_info)
+        self.cache.invalidate(website)
+        added = self.db.add_entry(website, *stored)
+        if added:
+            self._reindex_sealed(website, website,
+                                 {'username': username, 'url': url, 'email': email})
+            self._reindex_url(website, website, url)
+        return added
 
-    def get_password(self, website):
-        entry = self.db.get_entry(website)
-        if entry:
-            result = dict(entry)
+    def _open_entry(self, entry, fields):
+        """
+        Copy of entry with the named non-password fields of a sealed
+        record decrypted
+        """
+        result = dict(entry)
+        result['decryption_error'] = False
+        if fields and is_sealed(entry['password']):
             try:
-                result['password'] = self.encryption.decrypt(entry['password'])
-                result['decryption_error'] = False
+                result.update(self.encryption.unseal(entry['password'], fields))
             except Exception:
                 result['decryption_error'] = True
+        return result
+
+    def get_password(self, website, track_access=True):
+        entry = self.db.get_entry(website)
+        if entry:
+            result = self._open_entry(entry, SEALED_FIELDS[1:])
+            password = self.cache.get(website, entry['password'])
+            if password is None:
+                try:
+                    password = self.encryption.decrypt(entry['password'])
+                    self.cache.put(website, entry['password'], password)
+                except Exception:
+                    pass
+            if password is None:
+                result['decryption_error'] = True
+            else:
+                result['password'] = password
+            if website in self._access_times:
+                result['last_accessed'] = self._access_times[website]
+            if track_access:
+                result['last_accessed'] = self._record_access(website)
             return result
         return None
 
-    def list_websites(self):
-        return self.db.list_websites()
+    def get_passwords(self, websites, track_access=False, fields=None):
+        """
+        Like get_password for many websites at once, decrypted as one
+        batch. Returns {website: entry} and skips websites that do not
+        exist. fields names the fields the caller needs (all by default);
+        sealed records only have those decrypted, and the password is
+        left out unless it is named.
+        """
+        fields = SEALED_FIELDS if fields is None else tuple(fields)
+        entries = {}
+        misses = []
+        for website in websites:
+            entry = self.db.get_entry(website)
+            if entry:
+                result = entries[website] = self._open_entry(
+                    entry, [field for field in fields if field != 'password'])
+                if 'password' not in fields:
+                    del result['password']
+                    continue
+                password = self.cache.get(website, entry['password'])
+                if password is None:
+                    misses.append(website)
+                else:
+                    result['password'] = password
+        plaintexts = self.encryption.decrypt_many(
+            entries[website]['password'].encode() for website in misses)
+        for website, plaintext in zip(misses, plaintexts):
+            result = entries[website]
+            if plaintext is None:
+                result['decryption_error'] = True
+            else:
+                self.cache.put(website, result['password'], plaintext.decode())
+                result['password'] = plaintext.decode()
+        for website, result in entries.items():
+            if website in self._access_times:
+                result['last_accessed'] = self._access_times[website]
+            if track_access:
+                result['last_accessed'] = self._record_access(website)
+        return entries
+
+    def _record_access(self, website):
+        accessed = timestamp()
+        self._access_times[website] = accessed
+        if len(self._access_times) >= self.access_flush_count:
+            self.flush_access_times()
+        return accessed
+
+    def flush_access_times(self):
+        """
+        Write pending last_accessed times to the database in one batch
+        """
+        if self._access_times:
+            access_times, self._access_times = self._access_times, {}
+            self.db.touch_entries(access_times)
+
+    def list_websites(self, sort_by=None, reverse=False):
+        """
+        List websites, optionally ordered by 'created_at', 'updated_at' or
+        'last_accessed'. list_websites(sort_by='last_accessed', reverse=True)
+        gives the most recently used entries first.
+        """
+        if sort_by == 'last_accessed':
+            self.flush_access_times()
+        return self.db.list_websites(sort_by=sort_by, reverse=reverse)
+
+    def find_websites(self, username=None, email=None, url=None, domain=None):
+        """
+        Return the websites matching every given criterion, answered from
+        the database's secondary indexes. url matches the exact host,
+        domain also matches its subdomains. Sealed entries are matched
+        through an index of their decrypted fields.
+        """
+        lookups = [
+            (username, 'username', self.db.find_by_username),
+            (email, 'email', self.db.find_by_email),
+            (url, 'host', self.db.find_by_host),
+            (domain, 'domain', self.db.find_by_domain),
+        ]
+        result = None
+        for value, field, find in lookups:
+            if value is None:
+                continue
+            matches = set(find(value)) | self._sealed_lookup().find(field, value)
+            result = matches if result is None else result & matches
+        if result is None:
+            return []
+        return sorted(result)
+
+    def match_url(self, url, same_site=False):
+        """
+        Websites whose entries belong to url's host, best match first:
+        the same host, then parent domains of it. same_site adds other
+        hosts under the same registrable domain. Entries without a url
+        are matched by their website name when it looks like a domain.
+        """
+        return self._url_matcher().match(url, same_site)
 
     def generate_secure_password(self, length=16):
         return generate_password(length)
 
     def update_entry_full(self, old_website, new_website, username, password, url, email, additional_info):
-        encrypted_password = self.encryption.encrypt(password)
-        return self.db.update_entry_full(old_website, new_website, username, encrypted_password, url, email, additional_info)
+        stored = self._encrypt_fields(username, password, url, email, additional_info)
+        self.cache.invalidate(old_website)
+        self.cache.invalidate(new_website)
+        updated = self.db.update_entry_full(old_website, new_website, *stored)
+        if updated:
+            self._reindex_sealed(old_website, new_website,
+                                 {'username': username, 'url': url, 'email': email})
+            self._reindex_url(old_website, new_website, url)
+        return updated
 
     def delete_password(self, website):
-        return self.db.delete_entry(website)
+        self.cache.invalidate(website)
+        deleted = self.db.delete_entry(website)
+        if deleted:
+            self._reindex_sealed(website)
+            self._reindex_url(website)
+        return deleted
+
+    def flush(self, timeout=None):
+        """
+        Wait until all saved changes are durable on disk
+        """
+        self.flush_access_times()
+        return self.db.flush(timeout)
+
+    def close(self):
+        self.flush_access_times()
+        self.db.close()
+        self.quick_unlock.discard()
+        self.lock()
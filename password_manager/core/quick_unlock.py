@@ -0,0 +1,80 @@
+"""
+Quick unlock with a short PIN after a full master password unlock
+"""
+import time
+from cryptography.fernet import InvalidToken
+from .encryption import PBKDF2, derive_key, new_kdf_params, unwrap_key, wrap_key
+from .session import InvalidPasswordError
+
+
+# Deliberately far below the master password cost: a PIN has little
+# entropy anyway, and what protects it is the attempt limit and expiry
+QUICK_UNLOCK_ITERATIONS = 10000
+
+
+class QuickUnlockUnavailable(ValueError):
+    pass
+
+
+class QuickUnlock:
+    """
+    Keeps the vault data key wrapped under a key derived from a PIN, in
+    memory only, so the vault can be reopened after an auto-lock without
+    the full master password derivation.
+
+    The wrapped key is discarded after max_attempts wrong PINs in a row
+    and window seconds after it was set up, whichever comes first. Anyone
+    able to read process memory could brute-force the PIN offline, so
+    this trades some of the master password's strength for convenience
+    while the application stays open.
+    """
+
+    def __init__(self, window=900, max_attempts=3):
+        self.window = window
+        self.max_attempts = max_attempts
+        self._wrapped_key = None
+        self._kdf_params = None
+        self._expires = 0
+        self.attempts_left = 0
+
+    @property
+    def available(self):
+        if self._wrapped_key is not None and self._expires < time.monotonic():
+            self.discard()
+        return self._wrapped_key is not None
+
+    def enable(self, pin, key):
+        """
+        Wrap key under pin for the next window seconds
+        """
+        if not pin:
+            raise ValueError("PIN must not be empty")
+        self._kdf_params = new_kdf_params(PBKDF2, iterations=QUICK_UNLOCK_ITERATIONS)
+        self._wrapped_key = wrap_key(derive_key(pin, self._kdf_params), key)
+        self._expires = time.monotonic() + self.window
+        self.attempts_left = self.max_attempts
+
+    def unlock(self, pin):
+        """
+        Return the data key for pin. Raises InvalidPasswordError for a
+        wrong PIN and QuickUnlockUnavailable once quick unlock has expired
+        or run out of attempts.
+        """
+        if not self.available:
+            raise QuickUnlockUnavailable("Quick unlock is not available")
+        try:
+            key = unwrap_key(derive_key(pin, self._kdf_params), self._wrapped_key)
+        except InvalidToken:
+            self.attempts_left -= 1
+            if self.attempts_left <= 0:
+                self.discard()
+                raise QuickUnlockUnavailable("Too many wrong PINs")
+            raise InvalidPasswordError("Invalid PIN")
+        self.attempts_left = self.max_attempts
+        return key
+
+    def discard(self):
+        self._wrapped_key = None
+        self._kdf_params = None
+        self._expires = 0
+        self.attempts_left = 0
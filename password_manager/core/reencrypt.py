@@ -0,0 +1,185 @@
+"""
+Bulk re-encryption of every entry under a new data key
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from .database import write_json_atomic
+from .encryption import (SEALED_FIELDS, Encryption, generate_key, is_sealed, unwrap_key,
+                         wrap_key)
+
+
+class ReEncryption:
+    """
+    Moves every entry of a vault to a new data key.
+
+    Entries are decrypted and re-encrypted in batches on a thread pool (the
+    cryptography primitives release the GIL). Each finished batch is
+    appended to a staging file next to the vault, and a checkpoint records
+    how much of it is valid, so an interrupted run resumes where it
+    stopped. The vault itself is not touched until every entry is done;
+    the staged vault, with the new wrapped key in its header, then
+    replaces it through the backend's import_backup.
+
+    Sealed records stay sealed. With encrypt_metadata enabled, entries
+    that still keep their fields in plain text are sealed on the way.
+    """
+
+    def __init__(self, password_manager, master_password, batch_size=256, workers=None):
+        self.pm = password_manager
+        self.db = password_manager.db
+        self.master_password = master_password
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint_file = self.db.db_file + '.rekey'
+        self.staging_file = self.db.db_file + '.rekey.staged'
+        self.new = None
+        self.seal = password_manager.encrypt_metadata
+        self.failed = []
+
+    def _start(self):
+        """
+        Return the new data key and the entries already staged, picking up
+        a previous run if its checkpoint belongs to the current data key
+        """
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file, 'r') as f:
+                checkpoint = json.load(f)
+            try:
+                new_key = unwrap_key(self.pm.session.key, checkpoint['wrapped_key'])
+            except Exception:
+                new_key = None
+            if new_key is not None:
+                return new_key, self._read_staged(checkpoint['offset'])
+        new_key = generate_key()
+        self._write_checkpoint(new_key, 0)
+        with open(self.staging_file, 'wb'):
+            pass
+        return new_key, {}
+
+    def _write_checkpoint(self, new_key, offset):
+        # The new key is stored wrapped under the current one, so it is
+        # only usable by someone who can already unlock the vault
+        write_json_atomic(self.checkpoint_file, {
+            'wrapped_key': wrap_key(self.pm.session.key, new_key),
+            'offset': offset
+        })
+
+    def _read_staged(self, offset):
+        """
+        Staged records as {website: (old token, new token)}. Anything past
+        the checkpointed offset is a torn batch and is cut off.
+        """
+        staged = {}
+        with open(self.staging_file, 'r+b') as f:
+            f.truncate(offset)
+            for line in f.read().splitlines():
+                website, old_token, new_token = json.loads(line)
+                staged[website] = (old_token, new_token)
+        return staged
+
+    def run(self, progress=None):
+        """
+        Re-encrypt the vault and switch the session to the new key.
+        progress(done, total) is called after every batch. Returns the
+        websites whose password could not be decrypted; those keep their
+        old ciphertext.
+        """
+        master_key = self.pm.verify_master_password(self.master_password)
+        self.pm.flush()
+        new_key, staged = self._start()
+        self.new = Encryption()
+        self.new.set_key(new_key)
+
+        websites = self.db.list_websites()
+        todo = [website for website in websites
+                if website not in staged
+                or staged[website][0] != self.db.get_entry(website)['password']]
+        total = len(websites)
+        done = total - len(todo)
+        if progress:
+            progress(done, total)
+        with ThreadPoolExecutor(self.workers) as executor, \
+                open(self.staging_file, 'ab') as out:
+            for start in range(0, len(todo), self.batch_size):
+                batch = todo[start:start + self.batch_size]
+                entries = [self.db.get_entry(website) for website in batch]
+                tokens = [entry['password'] for entry in entries]
+                for website, old_token, new_token in zip(
+                        batch, tokens, executor.map(self._rekey, entries)):
+                    staged[website] = (old_token, new_token)
+                    out.write(json.dumps([website, old_token, new_token]).encode() + b'\n')
+                out.flush()
+                os.fsync(out.fileno())
+                self._write_checkpoint(new_key, out.tell())
+                done += len(batch)
+                if progress:
+                    progress(done, total)
+
+        self._swap(master_key, new_key, staged)
+        self.pm.session.set_key(new_key)
+        self.pm.encryption.set_key(new_key)
+        return self.failed
+
+    def _rekey(self, entry):
+        old = self.pm.encryption
+        token = entry['password']
+        try:
+            if is_sealed(token):
+                return self.new.seal(old.unseal(token))
+            if self.seal:
+                fields = {name: entry.get(name, '') for name in SEALED_FIELDS}
+                fields['password'] = old.decrypt(token)
+                return self.new.seal(fields)
+            return self.new.encrypt(old.decrypt(token))
+        except Exception:
+            return None
+
+    def _swap(self, master_key, new_key, staged):
+        """
+        Build the re-encrypted vault as a backup document and import it.
+        Writing the swap file is the commit point: if the import is
+        interrupted, finish_interrupted_swap repeats it on the next unlock.
+        """
+        export_file = self.db.db_file + '.rekey.export'
+        self.db.export_backup(export_file)
+        with open(export_file, 'r') as f:
+            document = json.load(f)
+        os.remove(export_file)
+        for website, entry in document['entries'].items():
+            old_token, new_token = staged.get(website, (None, None))
+            if entry['password'] != old_token:
+                # Added or changed after it was staged
+                new_token = self._rekey(entry)
+            if new_token is None or new_token == entry['password']:
+                self.failed.append(website)
+                new_token = entry['password']
+            elif is_sealed(new_token):
+                for name in SEALED_FIELDS[1:]:
+                    entry[name] = ''
+            entry['password'] = new_token
+        document['meta']['wrapped_key'] = wrap_key(master_key, new_key)
+        if self.seal:
+            document['meta']['sealed_records'] = True
+        write_json_atomic(swap_file(self.db), document)
+        finish_interrupted_swap(self.db)
+
+
+def swap_file(db):
+    return db.db_file + '.rekey.swap'
+
+
+def finish_interrupted_swap(db):
+    """
+    Import a re-encrypted vault whose swap was started but not finished
+    and remove the files of that run. Returns True if there was one.
+    """
+    path = swap_file(db)
+    if not os.path.exists(path):
+        return False
+    db.import_backup(path)
+    db.flush()
+    for leftover in (path, db.db_file + '.rekey', db.db_file + '.rekey.staged'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    return True
@@ -0,0 +1,98 @@
+"""
+Key session shared by everything that needs the unlocked vault key
+"""
+import hashlib
+import hmac
+from cryptography.fernet import InvalidToken
+from .encryption import derive_key, unwrap_key
+
+
+KEY_CHECK_LABEL = b'password_manager key check'
+
+
+class InvalidPasswordError(ValueError):
+    pass
+
+
+def key_check_value(key):
+    """
+    HMAC of a fixed label under the password-derived key. Stored in the
+    vault header so a wrong master password is rejected without
+    decrypting anything.
+    """
+    return hmac.new(bytes(key), KEY_CHECK_LABEL, hashlib.sha256).hexdigest()
+
+
+def check_master_password(master_password, kdf_params, key_check):
+    """
+    Derive the key for master_password and return it if it matches
+    key_check, otherwise raise InvalidPasswordError
+    """
+    return verify_master_key(derive_key(master_password, kdf_params), key_check)
+
+
+def verify_master_key(key, key_check):
+    """
+    Return an already derived master key if it matches key_check,
+    otherwise raise InvalidPasswordError
+    """
+    if key_check is not None and not hmac.compare_digest(
+            key_check_value(key), key_check):
+        raise InvalidPasswordError("Invalid master password")
+    return key
+
+
+class KeySession:
+    """
+    Holds the vault data key for the lifetime of one unlock, so the
+    expensive derivation runs once and every window and the
+    PasswordManager reuse its result.
+
+    The key is kept in a bytearray so lock() can overwrite it. Python may
+    still hold copies elsewhere (e.g. inside the Fernet object), so this is
+    best effort: it shortens how long the key stays in memory.
+    """
+
+    def __init__(self):
+        self._key = None
+
+    @property
+    def is_unlocked(self):
+        return self._key is not None
+
+    @property
+    def key(self):
+        if self._key is None:
+            raise ValueError("Vault is locked")
+        return bytes(self._key)
+
+    def unlock(self, master_password, kdf_params=None, key_check=None, wrapped_key=None,
+               master_key=None):
+        """
+        Derive the key for master_password and, for vaults using envelope
+        encryption, unwrap the data key with it. master_key skips the
+        derivation when it was already done, e.g. on a worker thread.
+        Raises InvalidPasswordError and stays locked if the password is
+        wrong.
+        """
+        if master_key is None:
+            key = check_master_password(master_password, kdf_params, key_check)
+        else:
+            key = verify_master_key(master_key, key_check)
+        if wrapped_key is not None:
+            try:
+                key = unwrap_key(key, wrapped_key)
+            except InvalidToken:
+                raise InvalidPasswordError("Invalid master password")
+        self.set_key(key)
+        return self.key
+
+    def set_key(self, key):
+        self.lock()
+        self._key = bytearray(key)
+
+    def lock(self):
+        if self._key is not None:
+            for i in range(len(self._key)):
+                self._key[i] = 0
+            self._key = None
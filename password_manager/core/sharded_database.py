@@ -0,0 +1,253 @@
+"""
+Sharded vault directory for very large credential sets
+"""
+import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from .database import (Database, load_json_vault, new_entry, read_backup,
+                       sort_websites, timestamp, write_backup, write_json_atomic)
+from .index import SecondaryIndex
+from ..config.settings import Settings
+
+
+class ShardedDatabase:
+    """
+    Spreads entries over N JSON shard files chosen by a CRC32 of the
+    website key. A mutation rewrites only the shards it touched, and all
+    shards are read in parallel on open. The shard count is fixed when the
+    directory is created and recorded in its manifest, which also holds
+    the vault header.
+    """
+
+    def __init__(self):
+        self.settings = Settings()
+        self.directory = self.settings.get(
+            "sharded_database_path", "passwords.shards")
+        self.db_file = os.path.join(self.directory, 'manifest.json')
+        # The VaultLock taken by open_database, released on close
+        self.vault_lock = None
+        self._saved = None
+        self._dirty = None
+        self.meta = {}
+        if os.path.exists(self.db_file):
+            with open(self.db_file, 'r') as f:
+                manifest = json.load(f)
+            self.shard_count = manifest['shards']
+            self.meta = manifest.get('meta', {})
+            self.shards = self._load_shards()
+        else:
+            self.shard_count = self.settings.get("shard_count", 16)
+            os.makedirs(self.directory, exist_ok=True)
+            self.shards = [{} for _ in range(self.shard_count)]
+            json_file = self.settings.get("database_path", "passwords.json")
+            if os.path.exists(json_file):
+                document = load_json_vault(json_file)
+                self.meta = document['meta']
+                self._distribute(document['entries'])
+            for shard_id in range(self.shard_count):
+                self._write_shard(shard_id)
+            self._write_manifest()
+        self.index = SecondaryIndex()
+        for shard in self.shards:
+            for website, entry in shard.items():
+                self.index.add(website, entry)
+
+    def _shard_path(self, shard_id):
+        return os.path.join(self.directory, f'shard-{shard_id:04d}.json')
+
+    def _shard_id(self, website):
+        return zlib.crc32(website.encode()) % self.shard_count
+
+    def _load_shards(self):
+        with ThreadPoolExecutor() as executor:
+            return list(executor.map(
+                lambda shard_id: Database.read_file(self._shard_path(shard_id)),
+                range(self.shard_count)))
+
+    def _write_shard(self, shard_id):
+        write_json_atomic(self._shard_path(shard_id), self.shards[shard_id])
+
+    def _write_manifest(self):
+        write_json_atomic(self.db_file, {'version': 1, 'shards': self.shard_count,
+                                         'meta': self.meta})
+
+    def get_meta(self, key, default=None):
+        return self.meta.get(key, default)
+
+    def set_meta(self, key, value):
+        """
+        Store a value in the vault header kept in the manifest. Inside a
+        transaction the manifest is written once when the block exits.
+        """
+        self.meta[key] = value
+        if self._dirty is not None:
+            self._dirty['manifest'] = True
+            return
+        self._write_manifest()
+
+    def _distribute(self, data):
+        for website, entry in data.items():
+            self.shards[self._shard_id(website)][website] = entry
+
+    def _shard_for(self, website):
+        """
+        Return the shard holding website and mark it as modified
+        """
+        shard_id = self._shard_id(website)
+        if self._saved is not None and shard_id not in self._saved:
+            self._saved[shard_id] = dict(self.shards[shard_id])
+        if self._dirty is not None:
+            self._dirty[shard_id] = True
+        return self.shards[shard_id]
+
+    def _put(self, website, entry):
+        shard = self._shard_for(website)
+        if website in shard:
+            self.index.remove(website, shard[website])
+        shard[website] = entry
+        self.index.add(website, entry)
+
+    def _remove(self, website):
+        self.index.remove(website, self._shard_for(website).pop(website))
+
+    @contextmanager
+    def transaction(self):
+        """
+        Defer shard writes until the block exits. If an exception escapes,
+        every shard touched inside the block is restored.
+        """
+        if self._saved is not None:
+            yield self
+            return
+        self._saved = {}
+        self._dirty = {}
+        saved_meta = dict(self.meta)
+        try:
+            yield self
+        except BaseException:
+            self.meta = saved_meta
+            for shard_id, shard in self._saved.items():
+                for website, entry in self.shards[shard_id].items():
+                    self.index.remove(website, entry)
+                for website, entry in shard.items():
+                    self.index.add(website, entry)
+                self.shards[shard_id] = shard
+            raise
+        else:
+            # Shards are written in the order they were first touched, so a
+            # rename writes the new name before removing the old one and a
+            # crash in between can only leave a duplicate, never lose data
+            manifest_dirty = self._dirty.pop('manifest', False)
+            for shard_id in self._dirty:
+                self._write_shard(shard_id)
+            if manifest_dirty:
+                self._write_manifest()
+        finally:
+            self._saved = None
+            self._dirty = None
+
+    def add_entry(self, website, username, encrypted_password, url='', email='', additional_info=''):
+        if self.get_entry(website) is not None:
+            return False
+        with self.transaction():
+            self._put(website, new_entry(username, encrypted_password, url, email, additional_info))
+        return True
+
+    def get_entry(self, website):
+        return self.shards[self._shard_id(website)].get(website)
+
+    def update_entry(self, website, encrypted_password):
+        entry = self.get_entry(website)
+        if entry is None:
+            return False
+        with self.transaction():
+            self._put(website, dict(entry, password=encrypted_password,
+                                    updated_at=timestamp()))
+        return True
+
+    def delete_entry(self, website):
+        if self.get_entry(website) is None:
+            return False
+        with self.transaction():
+            self._remove(website)
+        return True
+
+    def list_websites(self, sort_by=None, reverse=False):
+        if sort_by is not None:
+            return sort_websites(
+                (item for shard in self.shards for item in shard.items()),
+                sort_by, reverse)
+        websites = []
+        for shard in self.shards:
+            websites.extend(shard.keys())
+        return websites
+
+    def update_entry_full(self, old_website, new_website, username, encrypted_password, url, email, additional_info):
+        previous = self.get_entry(old_website)
+        if previous is None:
+            return False
+        if old_website != new_website and self.get_entry(new_website) is not None:
+            return False  # Don't overwrite existing
+        with self.transaction():
+            self._put(new_website, new_entry(username, encrypted_password, url, email,
+                                             additional_info, previous=previous))
+            if old_website != new_website:
+                self._remove(old_website)
+        return True
+
+    def touch_entries(self, access_times):
+        """
+        Record last_accessed times, rewriting each affected shard once
+        """
+        with self.transaction():
+            for website, accessed in access_times.items():
+                entry = self.get_entry(website)
+                if entry is not None:
+                    self._put(website, dict(entry, last_accessed=accessed))
+
+    def find_by_username(self, username):
+        return list(self.index.find('username', username))
+
+    def find_by_email(self, email):
+        return list(self.index.find('email', email))
+
+    def find_by_host(self, host):
+        return list(self.index.find('host', host))
+
+    def find_by_domain(self, domain):
+        return list(self.index.find('domain', domain))
+
+    def export_backup(self, path):
+        """
+        Write all entries to path in the JSON database format
+        """
+        data = {}
+        for shard in self.shards:
+            data.update(shard)
+        write_backup(path, data, self.meta)
+
+    def import_backup(self, path):
+        """
+        Replace all entries with the contents of a JSON backup file. The
+        vault header is only replaced if the backup carries one.
+        """
+        document = read_backup(path)
+        data = document['entries']
+        self.shards = [{} for _ in range(self.shard_count)]
+        self._distribute(data)
+        self.index.rebuild(data)
+        for shard_id in range(self.shard_count):
+            self._write_shard(shard_id)
+        if document['meta']:
+            self.meta = document['meta']
+            self._write_manifest()
+
+    def flush(self, timeout=None):
+        # Every commit is already durable
+        return True
+
+    def close(self):
+        if self.vault_lock is not None:
+            self.vault_lock.release()
@@ -0,0 +1,287 @@
+"""
+SQLite storage backend with indexed lookups
+"""
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from .database import (TIMESTAMP_FIELDS, load_json_vault, new_entry, read_backup,
+                       timestamp, write_backup)
+from ..config.settings import Settings
+from ..utils.url_utils import url_host
+
+
+FIELDS = ('username', 'password', 'url', 'email', 'additional_info') + TIMESTAMP_FIELDS
+
+
+class SQLiteDatabase:
+    """
+    Drop-in replacement for Database that keeps entries in SQLite.
+    Rows are fetched on demand, so memory use and write cost do not
+    grow with the number of stored entries.
+    """
+
+    def __init__(self):
+        self.settings = Settings()
+        self.db_file = self.settings.get("sqlite_database_path", "passwords.db")
+        # The VaultLock taken by open_database, released on close
+        self.vault_lock = None
+        self._in_transaction = False
+        json_file = self.settings.get("database_path", "passwords.json")
+        if not os.path.exists(self.db_file) and os.path.exists(json_file):
+            self._migrate(json_file)
+        self._connect(self.db_file)
+
+    def _connect(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self._create_schema()
+
+    def _migrate(self, json_file):
+        """
+        Build the database from the JSON vault in a staging file that is
+        moved into place only once the migration succeeded, so a failed
+        one is retried on the next start instead of leaving an empty vault
+        """
+        staging_file = self.db_file + '.migrating'
+        _remove_database(staging_file)
+        self._connect(staging_file)
+        try:
+            migrate_json(json_file, self)
+        except BaseException:
+            self.conn.close()
+            _remove_database(staging_file)
+            raise
+        # Closing the last connection checkpoints the WAL into the file
+        self.conn.close()
+        os.replace(staging_file, self.db_file)
+
+    def _create_schema(self):
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                website TEXT PRIMARY KEY,
+                username TEXT NOT NULL DEFAULT '',
+                password TEXT NOT NULL DEFAULT '',
+                url TEXT NOT NULL DEFAULT '',
+                email TEXT NOT NULL DEFAULT '',
+                additional_info TEXT NOT NULL DEFAULT '',
+                url_host TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS idx_entries_username ON entries(username);
+            CREATE INDEX IF NOT EXISTS idx_entries_email ON entries(email);
+            CREATE INDEX IF NOT EXISTS idx_entries_url_host ON entries(url_host);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        ''')
+        # Timestamp columns were added after the first release of this backend
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(entries)')}
+        for column in TIMESTAMP_FIELDS:
+            if column not in columns:
+                self.conn.execute(
+                    f"ALTER TABLE entries ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+            self.conn.execute(
+                f'CREATE INDEX IF NOT EXISTS idx_entries_{column} ON entries({column})')
+        self.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group mutations into one SQLite transaction that is committed when
+        the block exits and rolled back if an exception escapes
+        """
+        if self._in_transaction:
+            yield self
+            return
+        self._in_transaction = True
+        try:
+            with self.conn:
+                yield self
+        finally:
+            self._in_transaction = False
+
+    def _commit(self):
+        if not self._in_transaction:
+            self.conn.commit()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def set_meta(self, key, value):
+        """
+        Store a JSON value in the vault header table
+        """
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                          (key, json.dumps(value)))
+        self._commit()
+
+    def _all_meta(self):
+        return {row[0]: json.loads(row[1])
+                for row in self.conn.execute('SELECT key, value FROM meta')}
+
+    def _replace_meta(self, meta):
+        self.conn.execute('DELETE FROM meta')
+        self.conn.executemany('INSERT INTO meta (key, value) VALUES (?, ?)',
+                              [(key, json.dumps(value)) for key, value in meta.items()])
+
+    def _insert(self, website, entry):
+        self.conn.execute(
+            f"INSERT INTO entries (website, {', '.join(FIELDS)}, url_host) "
+            f"VALUES ({', '.join('?' * (len(FIELDS) + 2))})",
+            (website,) + tuple(entry.get(field, '') for field in FIELDS)
+            + (url_host(entry.get('url', '')),))
+
+    def add_entry(self, website, username, encrypted_password, url='', email='', additional_info=''):
+        try:
+            self._insert(website, new_entry(username, encrypted_password, url, email, additional_info))
+        except sqlite3.IntegrityError:
+            return False
+        self._commit()
+        return True
+
+    def get_entry(self, website):
+        row = self.conn.execute(
+            f"SELECT {', '.join(FIELDS)} FROM entries WHERE website = ?",
+            (website,)).fetchone()
+        if row is None:
+            return None
+        return dict(row)
+
+    def update_entry(self, website, encrypted_password):
+        cursor = self.conn.execute(
+            'UPDATE entries SET password = ?, updated_at = ? WHERE website = ?',
+            (encrypted_password, timestamp(), website))
+        if cursor.rowcount == 0:
+            return False
+        self._commit()
+        return True
+
+    def delete_entry(self, website):
+        cursor = self.conn.execute(
+            'DELETE FROM entries WHERE website = ?', (website,))
+        if cursor.rowcount == 0:
+            return False
+        self._commit()
+        return True
+
+    def list_websites(self, sort_by=None, reverse=False):
+        order = 'rowid'
+        if sort_by is not None:
+            if sort_by not in TIMESTAMP_FIELDS:
+                raise ValueError(f"Cannot sort by {sort_by!r}")
+            order = sort_by + (' DESC' if reverse else '')
+        return [row[0] for row in self.conn.execute(
+            f'SELECT website FROM entries ORDER BY {order}')]
+
+    def update_entry_full(self, old_website, new_website, username, encrypted_password, url, email, additional_info):
+        try:
+            cursor = self.conn.execute(
+                'UPDATE entries SET website = ?, username = ?, password = ?, '
+                'url = ?, email = ?, additional_info = ?, url_host = ?, '
+                'updated_at = ? WHERE website = ?',
+                (new_website, username, encrypted_password, url, email,
+                 additional_info, url_host(url), timestamp(), old_website))
+        except sqlite3.IntegrityError:
+            return False  # Don't overwrite existing
+        if cursor.rowcount == 0:
+            return False
+        self._commit()
+        return True
+
+    def touch_entries(self, access_times):
+        """
+        Record last_accessed times in a single transaction
+        """
+        with self.transaction():
+            self.conn.executemany(
+                'UPDATE entries SET last_accessed = ? WHERE website = ?',
+                [(accessed, website) for website, accessed in access_times.items()])
+
+    def find_by_username(self, username):
+        return self._find('username', username)
+
+    def find_by_email(self, email):
+        return self._find('email', email)
+
+    def find_by_host(self, host):
+        return self._find('url_host', url_host(host))
+
+    def find_by_domain(self, domain):
+        domain = url_host(domain)
+        if not domain:
+            return []
+        pattern = '%.' + domain.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return [row[0] for row in self.conn.execute(
+            "SELECT website FROM entries WHERE url_host = ? "
+            "OR url_host LIKE ? ESCAPE '\\'", (domain, pattern))]
+
+    def _find(self, column, value):
+        # column is always one of the indexed names above, never user input
+        return [row[0] for row in self.conn.execute(
+            f'SELECT website FROM entries WHERE {column} = ?', (value,))]
+
+    def export_backup(self, path):
+        """
+        Write all entries to path in the JSON database format
+        """
+        data = {}
+        for row in self.conn.execute(
+                f"SELECT website, {', '.join(FIELDS)} FROM entries ORDER BY rowid"):
+            data[row['website']] = {field: row[field] for field in FIELDS}
+        write_backup(path, data, self._all_meta())
+
+    def import_backup(self, path):
+        """
+        Replace all entries with the contents of a JSON backup file. The
+        vault header is only replaced if the backup carries one.
+        """
+        document = read_backup(path)
+        with self.conn:
+            self.conn.execute('DELETE FROM entries')
+            for website, entry in document['entries'].items():
+                self._insert(website, entry)
+            if document['meta']:
+                self._replace_meta(document['meta'])
+
+    def flush(self, timeout=None):
+        # Every commit is already durable
+        return True
+
+    def close(self):
+        self.conn.close()
+        if self.vault_lock is not None:
+            self.vault_lock.release()
+
+
+def _remove_database(path):
+    for leftover in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def migrate_json(json_file, sqlite_db):
+    """
+    Copy every entry of a JSON database (dict or legacy "passwords" array
+    layout, plus any pending journal records) and its vault header into
+    sqlite_db in a single transaction. Entries that already exist are left
+    untouched.
+    """
+    document = load_json_vault(json_file)
+    data = document['entries']
+    with sqlite_db.conn:
+        for website, entry in data.items():
+            try:
+                sqlite_db._insert(website, entry)
+            except sqlite3.IntegrityError:
+                continue
+        for key, value in document['meta'].items():
+            sqlite_db.conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)',
+                                   (key, json.dumps(value)))
+    return len(data)
@@ -0,0 +1,89 @@
+"""
+Matching page URLs to the entries that hold their credentials
+"""
+from ..utils.public_suffix import registrable_domain
+from ..utils.url_utils import host_in_domain, url_host
+
+# Match quality, best first
+EXACT_HOST = 0
+PARENT_HOST = 1
+SAME_SITE = 2
+
+
+def entry_host(website, url):
+    """
+    Host an entry belongs to: the host of its url, or its website name if
+    that looks like a domain and the url is empty
+    """
+    host = url_host(url)
+    if not host and '.' in website and ' ' not in website.strip():
+        host = url_host(website)
+    return host
+
+
+def site_of(host):
+    """
+    Key grouping hosts of one site: the registrable domain, or the host
+    itself for IP addresses and hosts the suffix list cannot split
+    """
+    return registrable_domain(host) or host
+
+
+class UrlMatcher:
+    """
+    Index from registrable domain ("example.co.uk") to the entries whose
+    host belongs to it, so a page URL is matched with one dictionary
+    lookup instead of a scan over every entry. Entries are added and
+    removed incrementally as they change.
+    """
+
+    def __init__(self, hosts=None):
+        self._sites = {}
+        self._websites = {}
+        for website, host in (hosts or {}).items():
+            self.add(website, host)
+
+    def add(self, website, host):
+        self.remove(website)
+        if not host:
+            return
+        site = site_of(host)
+        self._websites[website] = site
+        self._sites.setdefault(site, {})[website] = host
+
+    def remove(self, website):
+        site = self._websites.pop(website, None)
+        if site is None:
+            return
+        entries = self._sites.get(site)
+        if entries is not None:
+            entries.pop(website, None)
+            if not entries:
+                del self._sites[site]
+
+    def match(self, url, same_site=False):
+        """
+        Websites of the entries for url's host, best match first: the
+        same host, then entries for a parent of the host (an entry for
+        example.com matches login.example.com). With same_site, other
+        hosts of the same registrable domain follow; they may belong to
+        someone else, so never fill those in without asking.
+        """
+        host = url_host(url)
+        if not host:
+            return []
+        ranked = []
+        for website, candidate in self._sites.get(site_of(host), {}).items():
+            if candidate == host:
+                rank = EXACT_HOST
+            elif host_in_domain(host, candidate):
+                rank = PARENT_HOST
+            elif same_site:
+                rank = SAME_SITE
+            else:
+                continue
+            ranked.append((rank, website))
+        return [website for rank, website in sorted(ranked)]
+
+    def __len__(self):
+        return len(self._websites)
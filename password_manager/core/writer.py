@@ -0,0 +1,101 @@
+"""
+Background writer that keeps vault persistence off the GUI thread
+"""
+import atexit
+import threading
+import time
+
+
+class BackgroundWriter:
+    """
+    Runs write_func(payload) on a dedicated thread.
+
+    notify() hands over the latest state and returns immediately. While a
+    write is in progress further notifications are coalesced, so a burst
+    of changes results in one extra write of the newest payload. flush()
+    blocks until everything notified so far is durable. A failed write is
+    raised by the next notify() or flush(), whichever comes first.
+    """
+
+    def __init__(self, write_func, delay=0.0):
+        self.write_func = write_func
+        self.delay = delay
+        self._cond = threading.Condition()
+        self._payload = None
+        self._requested = 0
+        self._completed = 0
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name='vault-writer', daemon=True)
+        self._thread.start()
+        # Daemon threads are stopped abruptly at interpreter exit, so make
+        # sure pending writes land first
+        atexit.register(self.close)
+
+    def notify(self, payload):
+        """
+        Queue payload for writing. If an earlier write failed and no
+        flush() has reported it yet, its error is raised here, after
+        payload was queued, so the caller's save is not mistaken for a
+        success.
+        """
+        with self._cond:
+            if self._closed:
+                raise ValueError("Writer is closed")
+            self._payload = payload
+            self._requested += 1
+            self._cond.notify_all()
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            return self._requested
+
+    def flush(self, timeout=None):
+        """
+        Wait until all notified payloads have been written. Returns False on
+        timeout and re-raises the error of a failed write.
+        """
+        with self._cond:
+            target = self._requested
+            if not self._cond.wait_for(
+                    lambda: self._completed >= target, timeout):
+                return False
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            return True
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._requested > self._completed or self._closed)
+                if self._requested == self._completed:
+                    return
+            if self.delay:
+                # Give a burst of changes a moment to accumulate
+                time.sleep(self.delay)
+            with self._cond:
+                target = self._requested
+                payload, self._payload = self._payload, None
+            try:
+                self.write_func(payload)
+                error = None
+            except Exception as e:
+                error = e
+            with self._cond:
+                if error is not None:
+                    self._error = error
+                self._completed = target
+                self._cond.notify_all()
@@ -495,6 +495,8 @@ class AddPasswordWindow(QDialog):
 
         try:
             if self.parent.password_manager.add_password(website, username, password, url, email, additional_info):
+                # Wait for the write so a failure is reported here
+                self.parent.password_manager.flush()
                 QMessageBox.information(
                     self, 'Success', 'Password added successfully')
                 self.accept()
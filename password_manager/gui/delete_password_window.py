@@ -222,6 +222,8 @@ class DeletePasswordWindow(QDialog):
         if reply == QMessageBox.Yes:
             try:
                 if self.parent.password_manager.delete_password(website):
+                    # Wait for the write so a failure is reported here
+                    self.parent.password_manager.flush()
                     QMessageBox.information(
                         self, 'Success', 'Password deleted successfully')
                     self.all_websites = self.parent.password_manager.list_websites()
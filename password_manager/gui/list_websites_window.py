@@ -6,9 +6,20 @@ from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QTableWidget, QTableWidgetIte
                              QLabel, QHeaderView, QMenu, QAction, QFrame)
 from PyQt5.QtCore import Qt, QSize
 from PyQt5.QtGui import QIcon, QColor
+from datetime import datetime
 from .retrieve_password_window import RetrievePasswordWindow
 
 
+def format_timestamp(value):
+    """Show a stored UTC timestamp in local time."""
+    if not value:
+        return "N/A"
+    try:
+        return datetime.fromisoformat(value).astimezone().strftime("%Y-%m-%d %H:%M")
+    except ValueError:
+        return value
+
+
 class ListWebsitesWindow(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -106,9 +117,11 @@ class ListWebsitesWindow(QDialog):
         try:
             websites = self.parent.password_manager.list_websites()
             self.table.setRowCount(len(websites))
+            entries = self.parent.password_manager.get_passwords(
+                websites, fields=('username',))
 
             for row, website in enumerate(websites):
-                entry = self.parent.password_manager.get_password(website)
+                entry = entries.get(website)
                 if entry:
                     # Website item
                     website_item = QTableWidgetItem(website)
@@ -121,9 +134,9 @@ class ListWebsitesWindow(QDialog):
                         entry.get('username', 'N/A'))
                     self.table.setItem(row, 1, username_item)
 
-                    # Last updated (Using placeholder since the original data structure doesn't have this)
-                    # In a real implementation, you would store and retrieve actual timestamps
-                    last_updated = QTableWidgetItem("N/A")
+                    # Last updated
+                    last_updated = QTableWidgetItem(
+                        format_timestamp(entry.get('updated_at')))
                     self.table.setItem(row, 2, last_updated)
 
                     # Apply styling based on complexity or security level
@@ -2,22 +2,26 @@
 Login window for the Password Manager
 """
 from PyQt5.QtWidgets import (
-    QDialog, QVBoxLayout, QLabel, QPushButton, QMessageBox, QFrame, QSizePolicy)
+    QDialog, QVBoxLayout, QLabel, QPushButton, QMessageBox, QFrame, QSizePolicy,
+    QProgressBar, QInputDialog, QLineEdit)
 from PyQt5.QtCore import Qt
-from ..core.encryption import Encryption
 from .widgets.custom_widgets import PasswordLineEdit
+from .workers import KeyDerivationWorker
+from ..config.settings import Settings
+from ..core.quick_unlock import QuickUnlockUnavailable
+from ..core.session import InvalidPasswordError
 
 
 class LoginWindow(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.parent = parent
-        self.encryption = Encryption()
+        self.worker = None
         self.init_ui()
 
     def init_ui(self):
         self.setWindowTitle('Login')
-        self.setFixedSize(380, 230)
+        self.setFixedSize(380, 290)
         self.setStyleSheet('background: #f4f6fa;')
 
         main_layout = QVBoxLayout(self)
@@ -78,16 +82,107 @@ class LoginWindow(QDialog):
         self.login_button.clicked.connect(self.verify_password)
         card_layout.addWidget(self.login_button)
 
+        # Busy indicator shown while the key is derived
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setTextVisible(False)
+        self.progress_bar.setMaximumHeight(6)
+        self.progress_bar.hide()
+        card_layout.addWidget(self.progress_bar)
+
+        # Way out of PIN mode
+        self.switch_button = QPushButton('Use master password instead')
+        self.switch_button.setFlat(True)
+        self.switch_button.setStyleSheet('color: #1976D2; border: none;')
+        self.switch_button.clicked.connect(lambda: self.set_pin_mode(False))
+        card_layout.addWidget(self.switch_button)
+
         main_layout.addStretch()
         main_layout.addWidget(card, alignment=Qt.AlignHCenter)
         main_layout.addStretch()
 
+        # After an auto-lock a quick unlock PIN may still be valid
+        self.set_pin_mode(self.parent.password_manager.quick_unlock.available)
+
+    def set_pin_mode(self, pin_mode):
+        self.pin_mode = pin_mode
+        self.password_label.setText('PIN:' if pin_mode else 'Master Password:')
+        self.password_input.setText("")
+        self.switch_button.setVisible(pin_mode)
+
+    def set_busy(self, busy):
+        self.password_input.setEnabled(not busy)
+        self.login_button.setEnabled(not busy)
+        self.login_button.setText('Unlocking...' if busy else 'Login')
+        self.progress_bar.setVisible(busy)
+
     def verify_password(self):
+        if self.pin_mode:
+            self.verify_pin()
+            return
+        # The key derivation takes a noticeable fraction of a second by
+        # design, so it runs on a worker thread to keep the window painting
         password = self.password_input.text()
+        worker = self.worker = KeyDerivationWorker(
+            self.parent.password_manager.derive_master_key, password)
+        worker.signals.finished.connect(
+            lambda result: self.on_key_derived(worker, password, result))
+        worker.signals.failed.connect(
+            lambda error: self.on_derivation_failed(worker))
+        self.set_busy(True)
+        worker.start()
+
+    def on_key_derived(self, worker, password, result):
+        # A result that was already queued when the dialog closed is dropped
+        if worker is not self.worker:
+            return
+        self.worker = None
         try:
-            self.encryption.initialize(password)
-            self.parent.password_manager.encryption = self.encryption
-            self.accept()
+            self.parent.password_manager.unlock(password, result[1])
         except Exception as e:
-            QMessageBox.warning(self, 'Error', 'Invalid master password')
+            self.show_error()
+            return
+        self.offer_quick_unlock()
+        self.accept()
+
+    def verify_pin(self):
+        # The PIN KDF is cheap enough to run on the GUI thread
+        try:
+            self.parent.password_manager.unlock_with_pin(self.password_input.text())
+            self.accept()
+        except InvalidPasswordError:
+            attempts = self.parent.password_manager.quick_unlock.attempts_left
+            QMessageBox.warning(self, 'Error',
+                                f'Invalid PIN, {attempts} attempt(s) left')
             self.password_input.setText("")
+        except QuickUnlockUnavailable:
+            QMessageBox.warning(self, 'Error',
+                                'Please log in with your master password')
+            self.set_pin_mode(False)
+
+    def offer_quick_unlock(self):
+        if not Settings().get("quick_unlock_enabled", False):
+            return
+        pin, ok = QInputDialog.getText(
+            self, 'Quick Unlock',
+            'Choose a PIN to unlock after auto-lock (leave empty to skip):',
+            QLineEdit.Password)
+        if ok and pin:
+            self.parent.password_manager.enable_quick_unlock(pin)
+
+    def on_derivation_failed(self, worker):
+        if worker is self.worker:
+            self.worker = None
+            self.show_error()
+
+    def show_error(self):
+        self.set_busy(False)
+        QMessageBox.warning(self, 'Error', 'Invalid master password')
+        self.password_input.setText("")
+
+    def reject(self):
+        # Closing the dialog abandons a running derivation
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        super().reject()
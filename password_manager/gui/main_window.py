@@ -3,8 +3,9 @@ Main window of the Password Manager application
 """
 from PyQt5.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, QPushButton,
                              QMessageBox, QLabel, QHBoxLayout, QFrame, QSplitter,
-                             QStackedWidget, QToolButton, QScrollArea, QDialog)
-from PyQt5.QtCore import Qt, QSize
+                             QStackedWidget, QToolButton, QScrollArea, QDialog,
+                             QApplication)
+from PyQt5.QtCore import Qt, QSize, QTimer, QEvent
 from PyQt5.QtGui import QPixmap, QIcon, QColor, QPalette
 from .login_window import LoginWindow
 from .setup_window import SetupWindow
@@ -22,6 +23,17 @@ class MainWindow(QMainWindow):
         self.settings = Settings()
         self.password_manager = PasswordManager()
         self.authenticated = False  # Track authentication state
+        # Lock the vault after auto_lock_timeout seconds without input
+        self.lock_timer = QTimer(self)
+        self.lock_timer.setSingleShot(True)
+        self.lock_timer.timeout.connect(self.lock_vault)
+        # Set while a long vault operation must not be interrupted by a lock
+        self.lock_paused = False
+        # Wipe cached plaintexts once their ttl runs out, even when idle
+        self.cache_timer = QTimer(self)
+        self.cache_timer.timeout.connect(lambda: self.password_manager.cache.expire())
+        self.cache_timer.start(5000)
+        QApplication.instance().installEventFilter(self)
         self.init_ui()
         self.load_appearance_settings()  # Apply appearance settings on startup
 
@@ -312,8 +324,12 @@ class MainWindow(QMainWindow):
         main_layout.addWidget(sidebar)
         main_layout.addWidget(content_area, 1)  # Content area should expand
 
+        # Earlier versions kept the master password here in plain text
+        if self.settings.get("encryption_key"):
+            self.settings.set("encryption_key", None)
+
         # Check if first run
-        if not self.settings.get("encryption_key"):
+        if not self.password_manager.is_set_up:
             self.show_setup_window()
         else:
             self.show_login_window()
@@ -346,18 +362,53 @@ class MainWindow(QMainWindow):
         # result is QDialog.Accepted (1) if successful, QDialog.Rejected (0) if canceled
         if result == QDialog.Accepted:
             self.authenticated = True
+            self.restart_lock_timer()
         else:
             self.authenticated = False
 
+    def restart_lock_timer(self):
+        # Read through a fresh Settings so changes from the settings dialog
+        # apply straight away
+        timeout = Settings().get("auto_lock_timeout", 300)
+        if self.authenticated and timeout and not self.lock_paused:
+            self.lock_timer.start(int(timeout * 1000))
+
+    def pause_lock_timer(self):
+        self.lock_paused = True
+        self.lock_timer.stop()
+
+    def resume_lock_timer(self):
+        self.lock_paused = False
+        self.restart_lock_timer()
+
+    def eventFilter(self, obj, event):
+        if event.type() in (QEvent.KeyPress, QEvent.MouseButtonPress):
+            self.restart_lock_timer()
+        return super().eventFilter(obj, event)
+
+    def lock_vault(self):
+        """
+        Drop the vault key; the next secure action asks for the master
+        password again, or for the quick unlock PIN while that is valid
+        """
+        self.lock_timer.stop()
+        self.password_manager.lock()
+        self.authenticated = False
+
     def check_authentication(self):
         # Check if authenticated before showing any secure window
-        if not self.authenticated:
+        if not self.authenticated or not self.password_manager.is_unlocked:
             QMessageBox.warning(self, 'Authentication Required',
                                 'You must login with your master password first.')
             self.show_login_window()
             return False
         return True
 
+    def closeEvent(self, event):
+        # Wait for pending background writes and drop the vault key
+        self.password_manager.close()
+        super().closeEvent(event)
+
     def show_add_password_window(self):
         if not self.check_authentication():
             return
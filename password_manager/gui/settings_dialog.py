@@ -3,14 +3,14 @@ from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QLabel, QLineEdit, QPushButto
                              QGridLayout, QCheckBox, QComboBox, QSpinBox,
                              QGroupBox, QFontComboBox, QColorDialog, QFormLayout,
                              QRadioButton, QButtonGroup, QScrollArea, QWidget,
-                             QFileDialog)
-from PyQt5.QtCore import Qt, QSize
+                             QFileDialog, QInputDialog, QProgressDialog)
+from PyQt5.QtCore import Qt, QSize, QThread, pyqtSignal
 from PyQt5.QtGui import QIcon, QPixmap, QFont, QPalette, QColor
 import sys
 import json
 import os
-import shutil
 from datetime import datetime
+from ..core.encryption import KDF_ALGORITHMS, PBKDF2, SCRYPT, describe_kdf
 if sys.platform == "win32":
     import winreg
 
@@ -161,8 +161,18 @@ class SettingsDialog(QDialog):
         self.change_pw_btn.setIconSize(QSize(18, 18))
         self.change_pw_btn.clicked.connect(self.open_change_password_dialog)
 
+        self.rotate_key_btn = QPushButton('Re-encrypt Vault with a New Key')
+        self.rotate_key_btn.clicked.connect(self.rotate_data_key)
+
+        self.encrypt_metadata = QCheckBox(
+            "Also encrypt usernames, URLs, emails and notes")
+        self.encrypt_metadata.setToolTip(
+            "Applies to entries as they are saved. Re-encrypting the vault applies it to all entries.")
+
         password_layout.addWidget(password_info)
         password_layout.addWidget(self.change_pw_btn)
+        password_layout.addWidget(self.rotate_key_btn)
+        password_layout.addWidget(self.encrypt_metadata)
 
         # Session security
         session_group = QGroupBox("Session Security")
@@ -179,12 +189,53 @@ class SettingsDialog(QDialog):
         self.lock_on_exit = QCheckBox("Lock vault when application is closed")
         self.lock_on_exit.setChecked(True)
 
+        self.quick_unlock = QCheckBox("Unlock with a PIN after auto-lock")
+        self.quick_unlock.setToolTip(
+            "After you log in with the master password you can choose a PIN. "
+            "It reopens the vault until it expires or is entered wrong too often, "
+            "and is forgotten when the application closes.")
+        quick_unlock_layout = QHBoxLayout()
+        quick_unlock_label = QLabel("PIN stays valid for:")
+        self.quick_unlock_window = QSpinBox()
+        self.quick_unlock_window.setRange(1, 24 * 60)
+        self.quick_unlock_window.setSuffix(" min")
+        quick_unlock_layout.addWidget(quick_unlock_label)
+        quick_unlock_layout.addWidget(self.quick_unlock_window, 1)
+
         session_layout.addLayout(auto_lock_layout)
         session_layout.addWidget(self.lock_on_exit)
+        session_layout.addWidget(self.quick_unlock)
+        session_layout.addLayout(quick_unlock_layout)
+
+        # Key derivation
+        kdf_group = QGroupBox("Key Derivation")
+        kdf_layout = QFormLayout(kdf_group)
+
+        self.kdf_current_label = QLabel(
+            describe_kdf(self.parent.password_manager.kdf_params()))
+        self.kdf_algorithm_combo = QComboBox()
+        self.kdf_algorithm_combo.addItem("PBKDF2-SHA256", PBKDF2)
+        self.kdf_algorithm_combo.addItem("scrypt", SCRYPT)
+        self.kdf_target_spin = QSpinBox()
+        self.kdf_target_spin.setRange(100, 5000)
+        self.kdf_target_spin.setSingleStep(50)
+        self.kdf_target_spin.setSuffix(" ms")
+        self.kdf_target_spin.setValue(300)
+        self.kdf_calibrate_btn = QPushButton("Calibrate")
+        self.kdf_calibrate_btn.clicked.connect(self.calibrate_kdf)
+        self.kdf_result_label = QLabel("")
+        self.kdf_result_label.setWordWrap(True)
+        self.kdf_result_label.setStyleSheet("color: #7f8c8d;")
+
+        kdf_layout.addRow("Current vault:", self.kdf_current_label)
+        kdf_layout.addRow("Algorithm:", self.kdf_algorithm_combo)
+        kdf_layout.addRow("Target unlock time:", self.kdf_target_spin)
+        kdf_layout.addRow(self.kdf_calibrate_btn, self.kdf_result_label)
 
         # Add groups to the security tab
         security_layout.addWidget(password_group)
         security_layout.addWidget(session_group)
+        security_layout.addWidget(kdf_group)
         security_layout.addStretch()
 
         # Appearance tab
@@ -291,6 +342,56 @@ class SettingsDialog(QDialog):
         dlg = ChangeMasterPasswordDialog(self.parent)
         dlg.exec_()
 
+    def rotate_data_key(self):
+        """Re-encrypt every entry under a new data key on a worker thread."""
+        password, ok = QInputDialog.getText(
+            self, 'Re-encrypt Vault', 'Enter your master password:', QLineEdit.Password)
+        if not ok or not password:
+            return
+        self.rotate_progress = QProgressDialog(
+            'Re-encrypting entries...', None, 0, 0, self)
+        self.rotate_progress.setWindowTitle('Re-encrypt Vault')
+        self.rotate_progress.setWindowModality(Qt.WindowModal)
+        self.rotate_progress.setMinimumDuration(0)
+        self.rotate_thread = ReEncryptThread(self.parent.password_manager, password)
+        self.rotate_thread.progress.connect(self.on_rotate_progress)
+        self.rotate_thread.done.connect(self.on_rotate_done)
+        self.rotate_thread.error.connect(self.on_rotate_error)
+        # An auto-lock would pull the key from under the running rotation
+        self.parent.pause_lock_timer()
+        self.rotate_thread.start()
+
+    def on_rotate_progress(self, done, total):
+        self.rotate_progress.setMaximum(total)
+        self.rotate_progress.setValue(done)
+
+    def on_rotate_done(self, failed):
+        self.parent.resume_lock_timer()
+        self.rotate_progress.close()
+        if failed:
+            QMessageBox.warning(
+                self, 'Re-encrypt Vault',
+                f'The vault was re-encrypted, but {len(failed)} entries could not be '
+                f'decrypted and were left unchanged:\n{", ".join(failed[:10])}')
+        else:
+            QMessageBox.information(
+                self, 'Re-encrypt Vault', 'All entries were re-encrypted with a new key.')
+
+    def on_rotate_error(self, message):
+        self.parent.resume_lock_timer()
+        self.rotate_progress.close()
+        QMessageBox.critical(
+            self, 'Re-encrypt Vault',
+            f'Re-encryption stopped:\n{message}\n\n'
+            'Run it again to continue where it stopped.')
+
+    def calibrate_kdf(self):
+        """Benchmark the selected KDF and show the cost it would use here."""
+        params = self.parent.password_manager.calibrate_kdf(
+            self.kdf_algorithm_combo.currentData(), self.kdf_target_spin.value())
+        self.kdf_result_label.setText(
+            f"{describe_kdf(params)} on this machine. Applied to new vaults and on the next master password change.")
+
     def save_settings(self):
         # Save security settings
         auto_lock_time = self.auto_lock_combo.currentText()
@@ -325,6 +426,16 @@ class SettingsDialog(QDialog):
         # Security settings
         settings.set("auto_lock_timeout", auto_lock_seconds)
         settings.set("lock_on_exit", lock_on_exit)
+        settings.set("kdf_algorithm", self.kdf_algorithm_combo.currentData())
+        settings.set("kdf_target_ms", self.kdf_target_spin.value())
+        settings.set("encrypt_metadata", self.encrypt_metadata.isChecked())
+        self.parent.password_manager.encrypt_metadata = self.encrypt_metadata.isChecked()
+        settings.set("quick_unlock_enabled", self.quick_unlock.isChecked())
+        settings.set("quick_unlock_window", self.quick_unlock_window.value() * 60)
+        quick_unlock = self.parent.password_manager.quick_unlock
+        quick_unlock.window = self.quick_unlock_window.value() * 60
+        if not self.quick_unlock.isChecked():
+            quick_unlock.discard()
 
         # Appearance settings
         settings.set("theme", theme)
@@ -484,6 +595,11 @@ class SettingsDialog(QDialog):
             # Reset form controls to default values
             self.auto_lock_combo.setCurrentText("15 minutes")
             self.lock_on_exit.setChecked(True)
+            self.kdf_algorithm_combo.setCurrentIndex(0)
+            self.kdf_target_spin.setValue(300)
+            self.encrypt_metadata.setChecked(False)
+            self.quick_unlock.setChecked(False)
+            self.quick_unlock_window.setValue(15)
             self.light_theme.setChecked(True)
             self.font_combo.setCurrentFont(QFont("Segoe UI"))
             self.font_size.setValue(10)
@@ -493,6 +609,14 @@ class SettingsDialog(QDialog):
             settings = Settings()
             settings.set("auto_lock_timeout", 15 * 60)  # 15 minutes
             settings.set("lock_on_exit", True)
+            settings.set("kdf_algorithm", PBKDF2)
+            settings.set("kdf_target_ms", 300)
+            settings.set("encrypt_metadata", False)
+            self.parent.password_manager.encrypt_metadata = False
+            settings.set("quick_unlock_enabled", False)
+            settings.set("quick_unlock_window", 15 * 60)
+            self.parent.password_manager.quick_unlock.window = 15 * 60
+            self.parent.password_manager.quick_unlock.discard()
             settings.set("theme", "light")
             settings.set("font_family", "Segoe UI")
             settings.set("font_size", 10)
@@ -521,6 +645,14 @@ class SettingsDialog(QDialog):
         elif auto_lock_seconds == 60 * 60:
             self.auto_lock_combo.setCurrentText("1 hour")
         self.lock_on_exit.setChecked(lock_on_exit)
+        kdf_algorithm = settings.get("kdf_algorithm", PBKDF2)
+        if kdf_algorithm in KDF_ALGORITHMS:
+            self.kdf_algorithm_combo.setCurrentIndex(
+                KDF_ALGORITHMS.index(kdf_algorithm))
+        self.kdf_target_spin.setValue(settings.get("kdf_target_ms", 300))
+        self.encrypt_metadata.setChecked(settings.get("encrypt_metadata", False))
+        self.quick_unlock.setChecked(settings.get("quick_unlock_enabled", False))
+        self.quick_unlock_window.setValue(settings.get("quick_unlock_window", 900) // 60)
         theme = settings.get("theme", "light")
         font_family = settings.get("font_family", "Segoe UI")
         font_size = settings.get("font_size", 10)
@@ -551,11 +683,6 @@ class SettingsDialog(QDialog):
                 os.getcwd(), self.parent.password_manager.db.db_file)
             print(f"Database file path: {db_file}")  # Debug print
 
-            if not os.path.exists(db_file):
-                QMessageBox.critical(
-                    self, "Error", f"Database file not found at: {db_file}")
-                return
-
             # Create backup filename with timestamp
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             default_name = f"password_manager_backup_{timestamp}.json"
@@ -569,8 +696,9 @@ class SettingsDialog(QDialog):
             )
 
             if file_path:
-                # Copy the database file to the selected location
-                shutil.copy2(db_file, file_path)
+                # Write the database, including unsaved journal records,
+                # to the selected location
+                self.parent.password_manager.db.export_backup(file_path)
                 QMessageBox.information(
                     self,
                     "Success",
@@ -625,23 +753,39 @@ class SettingsDialog(QDialog):
                     os.getcwd(), self.parent.password_manager.db.db_file)
                 print(f"Database file path: {db_file}")  # Debug print
 
-                # Create a backup of current database before importing
-                if os.path.exists(db_file):
-                    backup_name = f"{db_file}.pre_import_backup"
-                    shutil.copy2(db_file, backup_name)
-
-                # Copy the backup file to the database location
-                shutil.copy2(file_path, db_file)
-
-                # Reload the database
-                self.parent.password_manager.db.load_database()
-
-                QMessageBox.information(
-                    self,
-                    "Success",
-                    "Backup successfully imported.\n"
-                    "The application will now use the restored data."
-                )
+                # Create a backup of current database before importing. The
+                # database file itself may not exist yet if every change
+                # is still in the journal.
+                backup_name = f"{db_file}.pre_import_backup"
+                self.parent.password_manager.db.export_backup(backup_name)
+
+                # Backups from before envelope encryption are re-encrypted
+                # under this vault's key, which needs their master password
+                backup_password = None
+                if self.parent.password_manager.backup_needs_password(file_path):
+                    backup_password, ok = QInputDialog.getText(
+                        self, "Import Backup",
+                        "Master password this backup was made with:",
+                        QLineEdit.Password)
+                    if not ok:
+                        return
+
+                # Replace the database with the backup contents
+                failed = self.parent.password_manager.import_backup(
+                    file_path, backup_password)
+                self.parent.password_manager.flush()
+
+                message = ("Backup successfully imported.\n"
+                           "The application will now use the restored data.")
+                if failed:
+                    message += (f"\n\n{len(failed)} entries could not be decrypted "
+                                "with that password and were imported unchanged.")
+                if not self.parent.password_manager.is_unlocked:
+                    # The backup brought its own keys
+                    self.parent.lock_vault()
+                    message += ("\n\nPlease log in again with the master password "
+                                "of the backup.")
+                QMessageBox.information(self, "Success", message)
         except Exception as e:
             QMessageBox.critical(
                 self,
@@ -650,6 +794,26 @@ class SettingsDialog(QDialog):
             )
 
 
+class ReEncryptThread(QThread):
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(list)
+    error = pyqtSignal(str)
+
+    def __init__(self, password_manager, master_password):
+        super().__init__()
+        self.password_manager = password_manager
+        self.master_password = master_password
+
+    def run(self):
+        try:
+            failed = self.password_manager.rotate_data_key(
+                self.master_password, self.progress.emit)
+        except Exception as e:
+            self.error.emit(str(e) or type(e).__name__)
+        else:
+            self.done.emit(failed)
+
+
 class ChangeMasterPasswordDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -893,19 +1057,13 @@ class ChangeMasterPasswordDialog(QDialog):
             self.confirm_input.clear()
             return
 
-        # Validate current password
+        # Validate current password against the unlocked session and
+        # switch to the new one
         try:
-            # Try to re-initialize encryption with the current password
-            self.parent.password_manager.encryption.initialize(current)
-        except Exception:
-            QMessageBox.warning(self, 'Error', 'Current password is incorrect')
-            self.current_input.clear()
-            return
-
-        # Set new password
-        try:
-            self.parent.password_manager.encryption.initialize(new)
-            self.parent.settings.set('encryption_key', new)
+            if not self.parent.password_manager.change_master_password(current, new):
+                QMessageBox.warning(self, 'Error', 'Current password is incorrect')
+                self.current_input.clear()
+                return
             QMessageBox.information(
                 self, 'Success', 'Master password changed successfully!')
             self.accept()
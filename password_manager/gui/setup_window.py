@@ -2,23 +2,21 @@
 Initial setup window for the Password Manager
 """
 from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QLabel, QLineEdit,
-                             QPushButton, QMessageBox)
+                             QPushButton, QMessageBox, QProgressBar)
 from PyQt5.QtCore import Qt
-from ..core.encryption import Encryption
-from ..config.settings import Settings
+from .workers import KeyDerivationWorker
 
 
 class SetupWindow(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.parent = parent
-        self.encryption = Encryption()
-        self.settings = Settings()
+        self.worker = None
         self.init_ui()
 
     def init_ui(self):
         self.setWindowTitle('Initial Setup')
-        self.setFixedSize(300, 200)
+        self.setFixedSize(300, 220)
 
         layout = QVBoxLayout()
 
@@ -45,8 +43,23 @@ class SetupWindow(QDialog):
         self.setup_button.clicked.connect(self.setup_password)
         layout.addWidget(self.setup_button)
 
+        # Busy indicator shown while the KDF is calibrated and run
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setTextVisible(False)
+        self.progress_bar.setMaximumHeight(6)
+        self.progress_bar.hide()
+        layout.addWidget(self.progress_bar)
+
         self.setLayout(layout)
 
+    def set_busy(self, busy):
+        self.password_input.setEnabled(not busy)
+        self.confirm_input.setEnabled(not busy)
+        self.setup_button.setEnabled(not busy)
+        self.setup_button.setText('Setting up...' if busy else 'Setup')
+        self.progress_bar.setVisible(busy)
+
     def setup_password(self):
         password = self.password_input.text()
         confirm = self.confirm_input.text()
@@ -61,12 +74,43 @@ class SetupWindow(QDialog):
             self.confirm_input.clear()
             return
 
+        # Calibrating and running the KDF happens on a worker thread so
+        # the window keeps painting
+        worker = self.worker = KeyDerivationWorker(
+            self.parent.password_manager.derive_master_key, password, True)
+        worker.signals.finished.connect(
+            lambda result: self.on_key_derived(worker, password, result))
+        worker.signals.failed.connect(
+            lambda error: self.on_derivation_failed(worker))
+        self.set_busy(True)
+        worker.start()
+
+    def on_key_derived(self, worker, password, result):
+        # A result that was already queued when the dialog closed is dropped
+        if worker is not self.worker:
+            return
+        self.worker = None
+        kdf_params, master_key = result
         try:
-            self.encryption.initialize(password)
-            self.parent.password_manager.encryption = self.encryption
-            self.settings.set("encryption_key", password)
+            self.parent.password_manager.create_vault(password, kdf_params, master_key)
             self.accept()
         except Exception as e:
-            QMessageBox.warning(self, 'Error', 'Failed to setup encryption')
-            self.password_input.clear()
-            self.confirm_input.clear()
+            self.show_error()
+
+    def on_derivation_failed(self, worker):
+        if worker is self.worker:
+            self.worker = None
+            self.show_error()
+
+    def show_error(self):
+        self.set_busy(False)
+        QMessageBox.warning(self, 'Error', 'Failed to setup encryption')
+        self.password_input.clear()
+        self.confirm_input.clear()
+
+    def reject(self):
+        # Closing the dialog abandons a running derivation
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        super().reject()
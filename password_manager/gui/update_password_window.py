@@ -282,6 +282,8 @@ class UpdatePasswordWindow(QDialog):
         try:
             if self.parent.password_manager.update_entry_full(
                     old_website, new_website, username, password, url, email, additional_info):
+                # Wait for the write so a failure is reported here
+                self.parent.password_manager.flush()
                 QMessageBox.information(
                     self, 'Success', 'Information updated successfully')
                 self.accept()
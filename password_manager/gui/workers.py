@@ -0,0 +1,48 @@
+"""
+Background workers that keep slow vault operations off the GUI thread
+"""
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+
+class WorkerSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+
+class KeyDerivationWorker(QRunnable):
+    """
+    Runs derive(*args) on the global QThreadPool and delivers the result
+    through signals.
+
+    A KDF call cannot be interrupted once it has started, so cancel()
+    takes the worker off the pool if it is still queued and otherwise
+    makes it drop the derived key instead of delivering it.
+    """
+
+    def __init__(self, derive, *args):
+        super().__init__()
+        self.derive = derive
+        self.args = args
+        self.signals = WorkerSignals()
+        self.cancelled = False
+
+    def start(self):
+        QThreadPool.globalInstance().start(self)
+
+    def cancel(self):
+        self.cancelled = True
+        QThreadPool.globalInstance().tryTake(self)
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            result = self.derive(*self.args)
+        except Exception as e:
+            if not self.cancelled:
+                self.signals.failed.emit(str(e))
+            return
+        finally:
+            self.args = None
+        if not self.cancelled:
+            self.signals.finished.emit(result)
@@ -1,14 +1,19 @@
 """
 Main entry point for the Password Manager application
 """
+from password_manager.core.database import VaultLockedError
 from password_manager.gui.main_window import MainWindow
 import sys
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtWidgets import QApplication, QMessageBox
 
 
 def main():
     app = QApplication(sys.argv)
-    window = MainWindow()
+    try:
+        window = MainWindow()
+    except VaultLockedError as e:
+        QMessageBox.critical(None, 'Password Manager', str(e))
+        sys.exit(1)
     window.show()
     sys.exit(app.exec_())
 
@@ -0,0 +1,387 @@
+"""
+Local HTTP API for autofill clients such as browser or editor extensions
+
+Run it with `python -m password_manager.server`. It listens on
+127.0.0.1 only, and every request must carry the API token as
+`Authorization: Bearer <token>`. Bodies and responses are JSON.
+
+    GET    /status                 {"unlocked": true}
+    POST   /unlock                 {"master_password": "..."}
+    POST   /lock
+    GET    /entries                ?sort=last_accessed&reverse=1
+    GET    /entries/<website>
+    POST   /entries                {"website": ..., "username": ..., "password": ..., ...}
+    PUT    /entries/<website>      fields to change, "website" to rename
+    DELETE /entries/<website>
+    GET    /lookup?url=<page url>  credentials for the page's host, best match first
+"""
+import asyncio
+import hmac
+import json
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote, urlsplit
+from .config.settings import Settings
+
+MAX_BODY = 1024 * 1024
+# Headers are read before the request is authenticated
+MAX_HEADERS = 100
+MAX_HEADER_BYTES = 64 * 1024
+ENTRY_FIELDS = ('username', 'password', 'url', 'email', 'additional_info')
+LOCAL_HOSTS = ('127.0.0.1', 'localhost')
+
+
+class HttpError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method, target, version, headers, body):
+        self.method = method
+        url = urlsplit(target)
+        self.path = url.path
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def json(self):
+        if not self.body:
+            return {}
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            raise HttpError(400, "Body is not valid JSON")
+        if not isinstance(data, dict):
+            raise HttpError(400, "Body must be a JSON object")
+        return data
+
+
+class ApiServer:
+    """
+    HTTP/1.1 server on an asyncio event loop in front of a
+    PasswordManager.
+
+    Connections are kept alive and served concurrently. Everything that
+    touches the vault runs on a single worker thread, which keeps the
+    event loop free for parsing and I/O while PasswordManager, which is
+    not thread-safe, only ever sees one call at a time.
+    """
+
+    def __init__(self, password_manager, token, host='127.0.0.1', port=None,
+                 keep_alive_timeout=30):
+        self.pm = password_manager
+        self.token = token
+        self.host = host
+        self.port = Settings().get("api_port", 8765) if port is None else port
+        self.keep_alive_timeout = keep_alive_timeout
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.server = None
+        self.routes = [
+            ('GET', '/status', False, self.status),
+            ('POST', '/unlock', False, self.unlock),
+            ('POST', '/lock', False, self.lock),
+            ('GET', '/entries', True, self.list_entries),
+            ('POST', '/entries', True, self.add_entry),
+            ('GET', '/entries/', True, self.get_entry),
+            ('PUT', '/entries/', True, self.update_entry),
+            ('DELETE', '/entries/', True, self.delete_entry),
+            ('GET', '/lookup', True, self.lookup),
+        ]
+
+    async def start(self):
+        """
+        Start listening. With port 0 a free port is picked and stored in
+        self.port.
+        """
+        self.server = await asyncio.start_server(self._serve_connection, self.host,
+                                                 self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        await self._run(self.pm.close)
+        self.executor.shutdown()
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def _run(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader),
+                                                     self.keep_alive_timeout)
+                except HttpError as e:
+                    # The stream position is unknown after a bad request
+                    writer.write(_response(e.status, {'error': str(e)}, False))
+                    await writer.drain()
+                    return
+                if request is None:
+                    return
+                status, result = await self._dispatch(request)
+                writer.write(_response(status, result, request.keep_alive))
+                await writer.drain()
+                if not request.keep_alive:
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError,
+                ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """
+        Read one request; None if the client closed the connection
+        between requests
+        """
+        line = await _readline(reader)
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise HttpError(400, "Malformed request line")
+        headers = {}
+        count = size = 0
+        while True:
+            line = await _readline(reader)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            count += 1
+            size += len(line)
+            if count > MAX_HEADERS or size > MAX_HEADER_BYTES:
+                raise HttpError(431)
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HttpError(400, "Invalid Content-Length")
+        if length > MAX_BODY:
+            raise HttpError(413)
+        body = await reader.readexactly(length) if length else b''
+        return Request(method, target, version, headers, body)
+
+    async def _dispatch(self, request):
+        try:
+            # A web page that rebinds its own host name to 127.0.0.1 still
+            # sends that name in Host
+            host = request.headers.get('host', '').rsplit(':', 1)[0].strip('[]')
+            if host not in LOCAL_HOSTS:
+                raise HttpError(403, "Unexpected Host header")
+            if not self._authorized(request):
+                raise HttpError(401)
+            handler, needs_unlock, argument = self._route(request)
+            if needs_unlock and not self.pm.is_unlocked:
+                raise HttpError(423, "Vault is locked")
+            return await handler(request, *argument)
+        except HttpError as e:
+            return e.status, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': str(e) or type(e).__name__}
+
+    def _authorized(self, request):
+        scheme, _, token = request.headers.get('authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(
+            token.strip().encode(), self.token.encode())
+
+    def _route(self, request):
+        allowed = False
+        for method, path, needs_unlock, handler in self.routes:
+            if path.endswith('/'):
+                if not request.path.startswith(path) or request.path == path:
+                    continue
+                argument = (unquote(request.path[len(path):]),)
+            elif request.path == path:
+                argument = ()
+            else:
+                continue
+            if method == request.method:
+                return handler, needs_unlock, argument
+            allowed = True
+        raise HttpError(405 if allowed else 404)
+
+    async def status(self, request):
+        return 200, {'unlocked': self.pm.is_unlocked}
+
+    async def unlock(self, request):
+        master_password = request.json().get('master_password')
+        if not isinstance(master_password, str):
+            raise HttpError(400, "master_password is required")
+        try:
+            await self._run(self.pm.unlock, master_password)
+        except ValueError as e:
+            raise HttpError(403, str(e))
+        return 200, {'unlocked': True}
+
+    async def lock(self, request):
+        await self._run(self._lock)
+        return 200, {'unlocked': False}
+
+    def _lock(self):
+        self.pm.flush()
+        self.pm.lock()
+
+    async def list_entries(self, request):
+        sort_by = request.query.get('sort')
+        reverse = request.query.get('reverse', '') not in ('', '0', 'false')
+        try:
+            websites = await self._run(self.pm.list_websites, sort_by, reverse)
+        except ValueError as e:
+            raise HttpError(400, str(e))
+        return 200, {'websites': websites}
+
+    async def get_entry(self, request, website):
+        entry = await self._run(self.pm.get_password, website)
+        if entry is None:
+            raise HttpError(404, f"No entry for {website}")
+        return 200, dict(entry, website=website)
+
+    async def add_entry(self, request):
+        data = request.json()
+        website = data.get('website')
+        if not website or not data.get('password'):
+            raise HttpError(400, "website and password are required")
+        _check_strings(data)
+        values = [data.get(field) or '' for field in ENTRY_FIELDS]
+        if not await self._run(self.pm.add_password, website, *values):
+            raise HttpError(409, f"An entry for {website} already exists")
+        return 201, {'website': website}
+
+    async def update_entry(self, request, website):
+        data = request.json()
+        _check_strings(data)
+        return 200, await self._run(self._update, website, data)
+
+    def _update(self, website, data):
+        entry = self.pm.get_password(website, False)
+        if entry is None:
+            raise HttpError(404, f"No entry for {website}")
+        if entry['decryption_error']:
+            raise HttpError(409, f"Cannot decrypt the entry for {website}")
+        # Fields left out of the body keep their current value
+        values = [data[field] if data.get(field) is not None else entry.get(field, '')
+                  for field in ENTRY_FIELDS]
+        new_website = data.get('website') or website
+        if not self.pm.update_entry_full(website, new_website, *values):
+            raise HttpError(409, f"Could not update {website}")
+        return {'website': new_website}
+
+    async def delete_entry(self, request, website):
+        if not await self._run(self.pm.delete_password, website):
+            raise HttpError(404, f"No entry for {website}")
+        return 200, {'website': website}
+
+    async def lookup(self, request):
+        url = request.query.get('url')
+        if not url:
+            raise HttpError(400, "url is required")
+        return 200, {'entries': await self._run(self._lookup, url)}
+
+    def _lookup(self, url):
+        # Never other hosts of the same site: on a shared suffix such as a
+        # hosting provider those belong to other people
+        websites = self.pm.match_url(url, same_site=False)
+        entries = self.pm.get_passwords(websites, fields=('username', 'password'))
+        return [{'website': website, 'username': entries[website].get('username', ''),
+                 'password': entries[website].get('password', '')}
+                for website in websites
+                if website in entries and not entries[website]['decryption_error']]
+
+
+async def _readline(reader):
+    try:
+        return await reader.readline()
+    except ValueError:
+        # A line longer than the stream limit
+        raise HttpError(400, "Line too long")
+
+
+def _check_strings(data):
+    for field in ('website',) + ENTRY_FIELDS:
+        if data.get(field) is not None and not isinstance(data[field], str):
+            raise HttpError(400, f"{field} must be a string")
+
+
+def _response(status, result, keep_alive):
+    body = json.dumps(result, separators=(',', ':')).encode()
+    head = [
+        f'HTTP/1.1 {status} {HTTPStatus(status).phrase}',
+        'Content-Type: application/json',
+        f'Content-Length: {len(body)}',
+        'Cache-Control: no-store',
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    if status == 401:
+        head.append('WWW-Authenticate: Bearer')
+    return ('\r\n'.join(head) + '\r\n\r\n').encode() + body
+
+
+def main():
+    import argparse
+    import getpass
+    from .core.database import VaultLockedError
+    from .core.password_manager import PasswordManager
+    from .core.session import InvalidPasswordError
+
+    parser = argparse.ArgumentParser(
+        prog='python -m password_manager.server',
+        description='Serve the vault to local autofill clients over HTTP')
+    parser.add_argument('--port', type=int, default=None,
+                        help='port on 127.0.0.1 (default: the api_port setting or 8765)')
+    args = parser.parse_args()
+
+    # Without a configured api_token every run gets a new one
+    token = Settings().get("api_token")
+    if not token:
+        token = secrets.token_urlsafe(32)
+        print(f'API token: {token}', flush=True)
+
+    try:
+        pm = PasswordManager()
+    except VaultLockedError as e:
+        raise SystemExit(str(e))
+    try:
+        pm.unlock(getpass.getpass('Master password: '))
+    except InvalidPasswordError:
+        pm.close()
+        raise SystemExit('Invalid master password')
+
+    async def run():
+        server = await ApiServer(pm, token, port=args.port).start()
+        print(f'Listening on http://127.0.0.1:{server.port}', flush=True)
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Registrable domains from the bundled public suffix list
+"""
+import encodings.idna
+import ipaddress
+import os
+
+LIST_FILE = os.path.join(os.path.dirname(__file__), 'public_suffix_list.dat')
+
+# Marker keys inside trie nodes; neither can be a DNS label
+RULE = ''
+EXCEPTION = '!'
+WILDCARD = '*'
+
+
+class PublicSuffixList:
+    """
+    Public suffix rules compiled into a trie keyed by labels from right to
+    left, so finding the suffix of a host walks at most one node per
+    label.
+
+    Each node is a dict of child labels plus RULE when a rule ends there
+    and EXCEPTION for "!" rules. A "*" rule is stored as a WILDCARD child
+    and matches any one label; rules below a wildcard are not supported.
+    Rules with Unicode labels are added in their punycode form as well,
+    so they match hosts written either way.
+    """
+
+    def __init__(self, rules=()):
+        self.root = {}
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def load(cls, path=LIST_FILE):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(line.split()[0] for line in f
+                       if line.strip() and not line.startswith('//'))
+
+    def add(self, rule):
+        rule = rule.lower()
+        exception = rule.startswith('!')
+        labels = rule.lstrip('!').split('.')
+        self._add(labels, exception)
+        ascii_labels = _to_ascii(labels)
+        if ascii_labels != labels:
+            self._add(ascii_labels, exception)
+
+    def _add(self, labels, exception):
+        node = self.root
+        for label in reversed(labels):
+            node = node.setdefault(label, {})
+        node[EXCEPTION if exception else RULE] = True
+
+    def suffix_length(self, labels):
+        """
+        Number of labels at the end of labels (a host split on dots)
+        that form its public suffix. Hosts no rule matches get the
+        default rule "*", i.e. 1.
+        """
+        node = self.root
+        length = 1
+        for depth, label in enumerate(reversed(labels), 1):
+            child = node.get(label)
+            # An exception rule always wins and drops its leftmost label
+            if child is not None and EXCEPTION in child:
+                return depth - 1
+            if WILDCARD in node:
+                length = depth
+            if child is None:
+                break
+            if RULE in child:
+                length = depth
+            node = child
+        return length
+
+    def public_suffix(self, host):
+        labels = host.split('.')
+        return '.'.join(labels[-self.suffix_length(labels):])
+
+    def registrable_domain(self, host):
+        """
+        The public suffix of host plus one label, e.g. "example.co.uk" for
+        "login.example.co.uk". Empty for hosts that are a public suffix
+        themselves, IP addresses and hosts without a dot.
+        """
+        if not host or '.' not in host or _is_ip(host):
+            return ''
+        labels = host.split('.')
+        length = self.suffix_length(labels)
+        if length >= len(labels):
+            return ''
+        return '.'.join(labels[-length - 1:])
+
+
+def _to_ascii(labels):
+    """
+    labels in their punycode form as found in URLs; unchanged if one
+    cannot be encoded
+    """
+    try:
+        return [label if label.isascii() else encodings.idna.ToASCII(label).decode('ascii')
+                for label in labels]
+    except UnicodeError:
+        return labels
+
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+_default = None
+
+
+def default_list():
+    """
+    The bundled list, compiled on first use
+    """
+    global _default
+    if _default is None:
+        _default = PublicSuffixList.load()
+    return _default
+
+
+def registrable_domain(host):
+    return default_list().registrable_domain(host)
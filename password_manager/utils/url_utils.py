@@ -0,0 +1,31 @@
+"""
+URL helpers shared by the storage backends
+"""
+from urllib.parse import urlsplit
+
+
+def url_host(url):
+    """
+    Return the normalized host of a URL: lower case, without scheme, port,
+    credentials, trailing dot or a leading "www." label
+    """
+    if not url:
+        return ''
+    url = url.strip()
+    if '://' not in url:
+        url = '//' + url
+    try:
+        host = urlsplit(url).hostname or ''
+    except ValueError:
+        return ''
+    host = host.rstrip('.')
+    if host.startswith('www.'):
+        host = host[4:]
+    return host
+
+
+def host_in_domain(host, domain):
+    """
+    True if host is domain itself or one of its subdomains
+    """
+    return bool(domain) and (host == domain or host.endswith('.' + domain))
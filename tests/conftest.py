@@ -0,0 +1,55 @@
+import json
+import pytest
+
+# Values of the storage_backend setting that the vault and db fixtures run
+# against
+BACKENDS = ('json', 'sqlite', 'indexed', 'binary', 'sharded')
+
+
+@pytest.fixture
+def configure(tmp_path, monkeypatch):
+    """
+    Run the test in an empty directory and return a function that updates
+    its config.json. Settings and the database use paths relative to the
+    working directory, so every test gets its own settings and vault.
+    """
+    monkeypatch.chdir(tmp_path)
+    settings = {"kdf_target_ms": 1, "background_writes": False}
+
+    def write_settings(**changes):
+        settings.update(changes)
+        with open(tmp_path / "config.json", "w") as f:
+            json.dump(settings, f)
+
+    write_settings()
+    return write_settings
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, configure):
+    configure(storage_backend=request.param)
+    return request.param
+
+
+@pytest.fixture
+def db(backend):
+    """
+    An empty database of every storage backend
+    """
+    from password_manager.core.database import open_database
+    db = open_database()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def vault(backend):
+    """
+    A new vault with the master password "master" on every storage
+    backend
+    """
+    from password_manager.core.password_manager import PasswordManager
+    pm = PasswordManager()
+    pm.create_vault("master")
+    yield pm
+    pm.close()
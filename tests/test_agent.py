@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import pytest
+from password_manager.agent import Agent, AgentClient, AgentError, check_private_directory
+
+
+@pytest.fixture
+def socket_dir():
+    # Unix socket paths are limited to about a hundred bytes, which
+    # pytest's tmp_path can exceed
+    directory = tempfile.mkdtemp(prefix='pm-')
+    yield directory
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@pytest.fixture
+def agent(vault, socket_dir):
+    agent = Agent(vault, os.path.join(socket_dir, 'agent.sock'), idle_timeout=0)
+    thread = threading.Thread(target=agent.serve_forever, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(agent.path):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    yield agent
+    if thread.is_alive():
+        agent.server.shutdown()
+    thread.join(10)
+
+
+def test_requests_reach_the_vault(agent):
+    with AgentClient(agent.path) as client:
+        assert client.is_running()
+        assert client.add_password('example.com', 'alice', 's3cret',
+                                   'https://login.example.com')
+        assert client.get_password('example.com')['password'] == 's3cret'
+        entries = client.get_passwords(['example.com'], ['username'])
+        assert entries['example.com']['username'] == 'alice'
+        assert 'password' not in entries['example.com']
+        assert client.list_websites() == ['example.com']
+        assert client.find_websites(username='alice') == ['example.com']
+        assert client.match_url('https://login.example.com/x') == ['example.com']
+        assert client.update_entry_full('example.com', 'example.org', 'bob', 'pw',
+                                        '', '', '')
+        assert client.delete_password('example.org')
+        assert client.list_websites() == []
+
+
+def test_locked_agent_refuses_until_unlocked(agent):
+    with AgentClient(agent.path) as client:
+        client.lock()
+        with pytest.raises(AgentError, match='locked'):
+            client.list_websites()
+        with pytest.raises(AgentError):
+            client.unlock('wrong')
+        client.unlock('master')
+        assert client.list_websites() == []
+
+
+def test_unknown_operation_is_an_error(agent):
+    with AgentClient(agent.path) as client:
+        with pytest.raises(AgentError, match='Unknown operation'):
+            client.request('export')
+        # The connection stays usable
+        assert client.is_running()
+
+
+def test_stop_shuts_the_agent_down(agent):
+    with AgentClient(agent.path) as client:
+        assert client.stop()
+    deadline = time.monotonic() + 10
+    while os.path.exists(agent.path):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert not AgentClient(agent.path).is_running()
+
+
+def test_only_private_directories_are_accepted(socket_dir):
+    check_private_directory(socket_dir)
+    os.chmod(socket_dir, 0o777)
+    with pytest.raises(AgentError):
+        check_private_directory(socket_dir)
+    with pytest.raises(AgentError):
+        AgentClient(os.path.join(socket_dir, 'agent.sock')).connect()
+    with pytest.raises(AgentError):
+        check_private_directory(os.path.join(socket_dir, 'missing'))
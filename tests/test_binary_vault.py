@@ -0,0 +1,59 @@
+import json
+import pytest
+from password_manager.core import migrations
+from password_manager.core.binary_vault import (MAGIC, BinaryVaultDatabase, main,
+                                                read_vault, write_vault)
+
+ENTRY = {'username': 'alice', 'password': 'token', 'url': '', 'email': '',
+         'additional_info': ''}
+
+
+def test_vault_file_round_trip(tmp_path):
+    path = str(tmp_path / 'vault.pmv')
+    data = {f'site{i}.com': dict(ENTRY, password=f'token{i}') for i in range(50)}
+    data['ünïcode.com'] = ENTRY
+    write_vault(path, data)
+    with open(path, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC
+    assert read_vault(path) == data
+
+
+def test_other_files_are_rejected(tmp_path):
+    path = tmp_path / 'vault.pmv'
+    path.write_bytes(b'not a vault' + b'\0' * 32)
+    with pytest.raises(ValueError):
+        read_vault(str(path))
+
+
+def test_lookups_binary_search_the_table(configure):
+    configure(storage_backend='binary')
+    write_vault('passwords.pmv', {f'site{i:03d}.com': ENTRY for i in range(200)})
+    db = BinaryVaultDatabase()
+    assert db.get_entry('site123.com') == ENTRY
+    assert db.get_entry('site999.com') is None
+    assert db.get_entry('') is None
+    db.close()
+
+
+def test_uncommitted_changes_overlay_the_file(configure):
+    configure(storage_backend='binary')
+    db = BinaryVaultDatabase()
+    with db.transaction():
+        db.add_entry('b.com', 'bob', 'token-b')
+        db.add_entry('a.com', 'alice', 'token-a')
+        assert db.list_websites() == ['a.com', 'b.com']
+        assert read_vault(db.db_file) == {}
+    assert sorted(read_vault(db.db_file)) == ['a.com', 'b.com']
+    db.close()
+
+
+def test_convert_to_and_from_json(tmp_path, capsys):
+    source = tmp_path / 'passwords.json'
+    source.write_text(json.dumps(migrations.new_document({'a.com': ENTRY},
+                                                         {'key_check': 'check'})))
+    main(['import', str(source), str(tmp_path / 'vault.pmv')])
+    main(['export', str(tmp_path / 'vault.pmv'), str(tmp_path / 'out.json')])
+    document = json.loads((tmp_path / 'out.json').read_text())
+    assert document['entries'] == {'a.com': ENTRY}
+    assert document['meta'] == {'key_check': 'check'}
+    assert 'Wrote 1 entries' in capsys.readouterr().out
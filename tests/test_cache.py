@@ -0,0 +1,102 @@
+from password_manager.core import cache as cache_module
+from password_manager.core.cache import SecretCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def fake_clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, 'monotonic', clock)
+    return clock
+
+
+def test_get_returns_what_was_put():
+    cache = SecretCache()
+    cache.put('a.com', 'token-a', 's3cret')
+    assert cache.get('a.com', 'token-a') == 's3cret'
+    assert cache.get('b.com', 'token-b') is None
+
+
+def test_changed_ciphertext_invalidates():
+    cache = SecretCache()
+    cache.put('a.com', 'token-a', 's3cret')
+    assert cache.get('a.com', 'token-a2') is None
+    assert len(cache) == 0
+
+
+def test_items_expire_after_ttl(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    cache = SecretCache(ttl=10)
+    cache.put('a.com', 'token-a', 's3cret')
+    clock.now += 10
+    assert cache.get('a.com', 'token-a') == 's3cret'
+    clock.now += 1
+    assert cache.get('a.com', 'token-a') is None
+
+
+def test_expire_wipes_every_expired_item(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    cache = SecretCache(ttl=10)
+    cache.put('a.com', 'token-a', 'aaaa')
+    cache.put('b.com', 'token-b', 'bbbb')
+    plaintext = cache._items['a.com'][1]
+    clock.now += 5
+    cache.put('c.com', 'token-c', 'cccc')
+    clock.now += 6
+    cache.expire()
+    assert list(cache._items) == ['c.com']
+    assert plaintext == bytearray(4)
+    # Any use of the cache drops expired items, not only a read of them
+    clock.now += 5
+    cache.get('a.com', 'token-a')
+    assert len(cache) == 0
+
+
+def test_item_cap_evicts_least_recently_used():
+    cache = SecretCache(max_items=2)
+    cache.put('a.com', 'token-a', 'a')
+    cache.put('b.com', 'token-b', 'b')
+    cache.get('a.com', 'token-a')
+    cache.put('c.com', 'token-c', 'c')
+    assert cache.get('b.com', 'token-b') is None
+    assert cache.get('a.com', 'token-a') == 'a'
+    assert cache.get('c.com', 'token-c') == 'c'
+
+
+def test_byte_cap_evicts_and_skips_oversized_values():
+    cache = SecretCache(max_bytes=10)
+    cache.put('a.com', 'token-a', 'x' * 6)
+    cache.put('b.com', 'token-b', 'y' * 6)
+    assert cache.get('a.com', 'token-a') is None
+    assert cache.get('b.com', 'token-b') == 'y' * 6
+    cache.put('c.com', 'token-c', 'z' * 11)
+    assert cache.get('c.com', 'token-c') is None
+    assert len(cache) == 1
+
+
+def test_disabled_cache_keeps_nothing():
+    for cache in (SecretCache(ttl=0), SecretCache(max_items=0)):
+        cache.put('a.com', 'token-a', 's3cret')
+        assert len(cache) == 0
+
+
+def test_invalidate_and_clear_wipe_plaintexts():
+    cache = SecretCache()
+    cache.put('a.com', 'token-a', 'aaaa')
+    cache.put('b.com', 'token-b', 'bbbb')
+    a, b = cache._items['a.com'][1], cache._items['b.com'][1]
+    cache.invalidate('a.com')
+    assert a == bytearray(4)
+    assert cache.get('b.com', 'token-b') == 'bbbb'
+    cache.clear()
+    assert b == bytearray(4)
+    assert len(cache) == 0
+    cache.put('c.com', 'token-c', 'c' * 16)
+    # The byte count starts over after clear()
+    assert cache._bytes == 16
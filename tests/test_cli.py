@@ -0,0 +1,104 @@
+import json
+import os
+import pytest
+from password_manager import cli
+from password_manager.core.password_manager import PasswordManager
+
+
+@pytest.fixture
+def run(backend, monkeypatch, capsys):
+    """
+    Run the CLI against a new vault with the master password "master" and
+    return (exit status, stdout, stderr)
+    """
+    pm = PasswordManager()
+    pm.create_vault('master')
+    pm.add_password('example.com', 'alice', 's3cret', 'https://login.example.com',
+                    'alice@example.com')
+    pm.close()
+    # No agent is listening here, so commands open the vault themselves
+    monkeypatch.setattr(cli.AgentClient, 'request', no_agent)
+    monkeypatch.setattr(cli.getpass, 'getpass', lambda prompt='': 'master')
+
+    def run(*argv):
+        status = cli.main(list(argv))
+        out, err = capsys.readouterr()
+        return status, out, err
+    return run
+
+
+def no_agent(self, op, **args):
+    raise cli.AgentError("No agent")
+
+
+def vault_files():
+    return {os.path.join(directory, name): os.stat(os.path.join(directory, name)).st_mtime_ns
+            for directory, _, names in os.walk('.') for name in names}
+
+
+def test_get_prints_fields(run):
+    assert run('get', 'example.com') == (0, 's3cret\n', '')
+    assert run('get', 'example.com', '--field', 'email') == (0, 'alice@example.com\n', '')
+    status, out, _ = run('--json', 'get', 'example.com')
+    entry = json.loads(out)
+    assert (entry['website'], entry['password']) == ('example.com', 's3cret')
+
+
+def test_get_does_not_rewrite_the_vault(run):
+    files = vault_files()
+    assert run('get', 'example.com')[0] == 0
+    assert run('get', 'example.com', 'example.com')[0] == 0
+    assert vault_files() == files
+
+
+def test_get_reports_missing_entries(run):
+    status, out, err = run('get', 'example.com', 'missing.com')
+    assert status == 1
+    assert out == 's3cret\n'
+    assert 'missing.com' in err
+
+
+def test_add_update_delete(run):
+    assert run('add', 'other.com', '--username', 'bob', '--password', 'pw')[0] == 0
+    assert run('add', 'other.com', '--password', 'pw')[0] == 1
+    assert run('update', 'other.com', '--rename', 'other.org', '--email', 'bob@x.org')[0] == 0
+    assert run('get', 'other.org', '--field', 'username') == (0, 'bob\n', '')
+    assert run('get', 'other.org') == (0, 'pw\n', '')
+    assert run('list') == (0, 'example.com\nother.org\n', '')
+    assert run('delete', 'other.org')[0] == 0
+    assert run('delete', 'other.org')[0] == 1
+
+
+def test_list_filters(run):
+    run('add', 'other.com', '--username', 'bob', '--password', 'pw',
+        '--url', 'https://shop.example.com')
+    assert run('list', '--username', 'bob')[1] == 'other.com\n'
+    assert run('list', '--match', 'https://login.example.com/x')[1] == 'example.com\n'
+    assert run('list', '--match', 'https://login.example.com/x', '--same-site')[1] == \
+        'example.com\nother.com\n'
+    assert run('--json', 'list', '--domain', 'example.com')[1].splitlines() == \
+        ['{"website":"example.com"}', '{"website":"other.com"}']
+
+
+def test_wrong_master_password(run, monkeypatch):
+    monkeypatch.setattr(cli.getpass, 'getpass', lambda prompt='': 'wrong')
+    assert run('list') == (1, '', 'Error: Invalid master password\n')
+
+
+def test_generate_needs_no_vault(run, monkeypatch):
+    monkeypatch.setattr(cli, 'open_vault', None)
+    status, out, _ = run('generate', '--length', '20', '--count', '3')
+    assert status == 0
+    assert [len(password) for password in out.split()] == [20, 20, 20]
+
+
+def test_vault_open_elsewhere_is_an_error(run):
+    pm = PasswordManager()
+    try:
+        status, out, err = run('list')
+        assert status == 1
+        assert 'already open' in err
+        assert run('export', 'backup.json')[0] == 1
+    finally:
+        pm.close()
+    assert run('list') == (0, 'example.com\n', '')
@@ -0,0 +1,218 @@
+import json
+import time
+import pytest
+from password_manager.core import migrations
+from password_manager.core import database
+from password_manager.core.database import VaultLockedError, open_database
+
+
+def reopen(db):
+    db.close()
+    return open_database()
+
+
+def test_add_get_delete(db):
+    assert db.add_entry('example.com', 'alice', 'token', 'https://example.com',
+                        'alice@example.com', 'note')
+    assert not db.add_entry('example.com', 'bob', 'other')
+    entry = db.get_entry('example.com')
+    assert (entry['username'], entry['password'], entry['url'], entry['email'],
+            entry['additional_info']) == ('alice', 'token', 'https://example.com',
+                                          'alice@example.com', 'note')
+    assert db.get_entry('missing.com') is None
+    assert db.delete_entry('example.com')
+    assert not db.delete_entry('example.com')
+    assert db.list_websites() == []
+
+
+def test_update_and_rename(db):
+    db.add_entry('a.com', 'alice', 'token-a')
+    db.add_entry('b.com', 'bob', 'token-b')
+    assert db.update_entry('a.com', 'token-a2')
+    assert not db.update_entry('missing.com', 'token')
+    assert db.get_entry('a.com')['password'] == 'token-a2'
+    # Renaming onto an existing website is refused
+    assert not db.update_entry_full('a.com', 'b.com', 'alice', 'x', '', '', '')
+    assert db.update_entry_full('a.com', 'c.com', 'carol', 'token-c', 'https://c.com', '', '')
+    assert sorted(db.list_websites()) == ['b.com', 'c.com']
+    assert db.get_entry('c.com')['username'] == 'carol'
+
+
+def test_changes_persist(db):
+    db.add_entry('a.com', 'alice', 'token-a')
+    db.add_entry('b.com', 'bob', 'token-b')
+    db.delete_entry('b.com')
+    db.set_meta('kdf', {'algorithm': 'test'})
+    db.flush()
+    db = reopen(db)
+    assert db.list_websites() == ['a.com']
+    assert db.get_entry('a.com')['password'] == 'token-a'
+    assert db.get_meta('kdf') == {'algorithm': 'test'}
+    assert db.get_meta('missing', 'default') == 'default'
+    db.close()
+
+
+def test_backup_round_trip(db, tmp_path):
+    db.add_entry('a.com', 'alice', 'token-a')
+    db.set_meta('key_check', 'check')
+    db.export_backup(str(tmp_path / 'backup.json'))
+    db.delete_entry('a.com')
+    db.add_entry('b.com', 'bob', 'token-b')
+    db.set_meta('key_check', 'changed')
+    db.import_backup(str(tmp_path / 'backup.json'))
+    assert db.list_websites() == ['a.com']
+    assert db.get_meta('key_check') == 'check'
+    db = reopen(db)
+    assert db.list_websites() == ['a.com']
+    db.close()
+
+
+def test_import_without_header_keeps_it(db, tmp_path):
+    db.set_meta('key_check', 'check')
+    with open(tmp_path / 'backup.json', 'w') as f:
+        json.dump({'a.com': {'username': 'alice', 'password': 'token', 'url': '',
+                             'email': '', 'additional_info': ''}}, f)
+    db.import_backup(str(tmp_path / 'backup.json'))
+    assert db.list_websites() == ['a.com']
+    assert db.get_meta('key_check') == 'check'
+
+
+def test_existing_json_vault_is_taken_over(backend):
+    entry = {'username': 'alice', 'password': 'token', 'url': '', 'email': '',
+             'additional_info': ''}
+    with open('passwords.json', 'w') as f:
+        json.dump(migrations.new_document({'a.com': entry}, {'key_check': 'check'}), f)
+    db = open_database()
+    assert db.list_websites() == ['a.com']
+    assert db.get_entry('a.com')['password'] == 'token'
+    assert db.get_meta('key_check') == 'check'
+    db.close()
+
+
+def test_unknown_sort_is_rejected(db):
+    with pytest.raises(ValueError):
+        db.list_websites(sort_by='password')
+
+
+def test_nested_transactions_commit_together(db):
+    with db.transaction():
+        db.add_entry('a.com', 'alice', 'token-a')
+        with db.transaction():
+            db.add_entry('b.com', 'bob', 'token-b')
+        db.set_meta('key_check', 'check')
+    db.flush()
+    db = reopen(db)
+    assert sorted(db.list_websites()) == ['a.com', 'b.com']
+    assert db.get_meta('key_check') == 'check'
+    db.close()
+
+
+def test_transaction_rolls_back(db):
+    db.add_entry('a.com', 'alice', 'token-a')
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.delete_entry('a.com')
+            db.add_entry('b.com', 'bob', 'token-b')
+            db.set_meta('key_check', 'check')
+            raise RuntimeError
+    assert db.list_websites() == ['a.com']
+    assert db.get_entry('b.com') is None
+    assert db.get_meta('key_check') is None
+    db.flush()
+    db = reopen(db)
+    assert db.list_websites() == ['a.com']
+    db.close()
+
+
+def found(db):
+    return {
+        'alice': sorted(db.find_by_username('alice')),
+        'mail': sorted(db.find_by_email('alice@example.com')),
+        'host': sorted(db.find_by_host('https://login.example.com/x')),
+        'domain': sorted(db.find_by_domain('example.com')),
+    }
+
+
+def test_lookups_follow_changes(db):
+    db.add_entry('a', 'alice', 'token', 'https://login.example.com', 'alice@example.com')
+    db.add_entry('b', 'alice', 'token', 'https://www.example.com')
+    db.add_entry('c', 'carol', 'token', 'https://example.org', 'alice@example.com')
+    assert found(db) == {'alice': ['a', 'b'], 'mail': ['a', 'c'], 'host': ['a'],
+                         'domain': ['a', 'b']}
+    db.update_entry_full('a', 'd', 'dave', 'token', 'https://example.net', '', '')
+    db.delete_entry('c')
+    assert found(db) == {'alice': ['b'], 'mail': [], 'host': [], 'domain': ['b']}
+    db.flush()
+    db = reopen(db)
+    assert found(db) == {'alice': ['b'], 'mail': [], 'host': [], 'domain': ['b']}
+    assert db.find_by_host('example.net') == ['d']
+    db.close()
+
+
+def test_lookups_roll_back_with_a_transaction(db):
+    db.add_entry('a', 'alice', 'token', 'https://example.com')
+    assert db.find_by_username('alice') == ['a']
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.update_entry_full('a', 'a', 'bob', 'token', 'https://example.org', '', '')
+            db.add_entry('b', 'alice', 'token')
+            raise RuntimeError
+    assert db.find_by_username('alice') == ['a']
+    assert db.find_by_username('bob') == []
+    assert db.find_by_domain('example.com') == ['a']
+
+
+def test_lookups_after_backup_import(db, tmp_path):
+    db.add_entry('a', 'alice', 'token')
+    db.export_backup(str(tmp_path / 'backup.json'))
+    db.find_by_username('alice')
+    db.update_entry_full('a', 'b', 'bob', 'token', '', '', '')
+    db.import_backup(str(tmp_path / 'backup.json'))
+    assert db.find_by_username('alice') == ['a']
+    assert db.find_by_username('bob') == []
+
+
+def test_timestamps(db):
+    db.add_entry('a.com', 'alice', 'token')
+    created = db.get_entry('a.com')
+    assert created['created_at'] == created['updated_at']
+    assert created['last_accessed'] == ''
+    time.sleep(0.005)
+    db.update_entry('a.com', 'token2')
+    time.sleep(0.005)
+    db.touch_entries({'a.com': '2030-01-01T00:00:00.000+00:00', 'missing.com': 'x'})
+    db.update_entry_full('a.com', 'b.com', 'alice', 'token3', '', '', '')
+    entry = db.get_entry('b.com')
+    assert entry['created_at'] == created['created_at']
+    assert entry['updated_at'] > created['updated_at']
+    assert entry['last_accessed'] == '2030-01-01T00:00:00.000+00:00'
+
+
+def test_sort_by_timestamps(db):
+    for website in ('a.com', 'b.com', 'c.com'):
+        db.add_entry(website, 'user', 'token')
+        time.sleep(0.005)
+    db.update_entry('a.com', 'token2')
+    db.touch_entries({'b.com': '2030-01-01T00:00:00.000+00:00'})
+    assert db.list_websites('created_at') == ['a.com', 'b.com', 'c.com']
+    assert db.list_websites('created_at', reverse=True) == ['c.com', 'b.com', 'a.com']
+    assert db.list_websites('updated_at') == ['b.com', 'c.com', 'a.com']
+    assert db.list_websites('last_accessed', reverse=True)[0] == 'b.com'
+
+
+def test_vault_is_open_in_one_place_at_a_time(db):
+    with pytest.raises(VaultLockedError):
+        open_database()
+    db = reopen(db)
+    db.close()
+
+
+def test_lock_is_released_when_opening_fails(backend, monkeypatch):
+    def fail(backend):
+        raise OSError("unreadable")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(database, '_create_backend', fail)
+        with pytest.raises(OSError):
+            open_database()
+    open_database().close()
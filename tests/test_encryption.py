@@ -0,0 +1,103 @@
+import base64
+import pytest
+from cryptography.fernet import Fernet, InvalidToken
+from password_manager.core.encryption import (RECORD_VERSION, SEALED_FIELDS,
+                                              SEALED_VERSION, Encryption, generate_key,
+                                              is_sealed, unwrap_key, wrap_key)
+
+
+def decoded(token):
+    return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+
+
+@pytest.fixture
+def encryption():
+    encryption = Encryption()
+    encryption.set_key(generate_key())
+    return encryption
+
+
+def test_record_round_trip(encryption):
+    token = encryption.encrypt('s3cret')
+    assert decoded(token)[:1] == RECORD_VERSION
+    assert encryption.decrypt(token) == 's3cret'
+
+
+def test_records_use_fresh_nonces(encryption):
+    assert encryption.encrypt('same') != encryption.encrypt('same')
+
+
+def test_record_from_another_key_is_rejected(encryption):
+    other = Encryption()
+    other.set_key(generate_key())
+    with pytest.raises(InvalidToken):
+        other.decrypt(encryption.encrypt('s3cret'))
+
+
+def test_tampered_record_is_rejected(encryption):
+    record = bytearray(decoded(encryption.encrypt('s3cret')))
+    record[-1] ^= 1
+    token = base64.urlsafe_b64encode(bytes(record)).rstrip(b'=').decode()
+    with pytest.raises(InvalidToken):
+        encryption.decrypt(token)
+
+
+def test_legacy_fernet_tokens_still_decrypt(encryption):
+    token = Fernet(encryption.key).encrypt(b'old secret').decode()
+    assert encryption.decrypt(token) == 'old secret'
+
+
+def test_locked_encryption_refuses(encryption):
+    encryption.clear()
+    with pytest.raises(ValueError):
+        encryption.encrypt('s3cret')
+
+
+def test_decrypt_many_keeps_order_and_reports_failures(encryption):
+    tokens = encryption.encrypt_many([b'a', b'b', b'c'])
+    tokens.insert(1, b'not a token')
+    assert encryption.decrypt_many(tokens) == [b'a', None, b'b', b'c']
+
+
+def test_sealed_record_round_trip(encryption):
+    fields = {'password': 'pw', 'username': 'alice', 'url': 'https://example.com',
+              'email': '', 'additional_info': 'note'}
+    token = encryption.seal(fields)
+    assert is_sealed(token)
+    assert decoded(token)[:1] == SEALED_VERSION
+    assert encryption.unseal(token) == fields
+    assert encryption.decrypt(token) == 'pw'
+
+
+def test_sealed_record_opens_single_fields(encryption):
+    token = encryption.seal({'password': 'pw', 'username': 'alice'})
+    assert encryption.unseal(token, ('username',)) == {'username': 'alice'}
+    assert encryption.unseal(token, ('email',)) == {'email': ''}
+
+
+def test_sealed_fields_cannot_be_swapped(encryption):
+    token = encryption.seal({'password': 'pw', 'username': 'alice'})
+    record = bytearray(decoded(token))
+    # Relabel the first directory entry (the password) as the username
+    record[10] = SEALED_FIELDS.index('username')
+    forged = base64.urlsafe_b64encode(bytes(record)).rstrip(b'=').decode()
+    with pytest.raises(InvalidToken):
+        encryption.unseal(forged, ('username',))
+
+
+@pytest.mark.parametrize('length', [1, 9, 10, 14, 20, 40])
+def test_truncated_sealed_record_is_invalid(encryption, length):
+    token = encryption.seal({'password': 'pw', 'username': 'alice'})
+    record = decoded(token)[:length]
+    truncated = base64.urlsafe_b64encode(record).rstrip(b'=').decode()
+    with pytest.raises(InvalidToken):
+        encryption.unseal(truncated)
+    assert encryption.decrypt_many([truncated.encode()]) == [None]
+
+
+def test_wrapped_key_round_trip():
+    wrapping_key, key = generate_key(), generate_key()
+    wrapped = wrap_key(wrapping_key, key)
+    assert unwrap_key(wrapping_key, wrapped) == key
+    with pytest.raises(InvalidToken):
+        unwrap_key(generate_key(), wrapped)
@@ -0,0 +1,57 @@
+import os
+import pytest
+from password_manager.core.indexed_database import IndexedDatabase
+
+
+@pytest.fixture
+def db(configure):
+    configure(storage_backend='indexed', vault_compact_ratio=1.0)
+    db = IndexedDatabase()
+    yield db
+    db.close()
+
+
+def test_records_are_read_on_demand(db):
+    db.add_entry('a.com', 'alice', 'token-a')
+    db.close()
+    db = IndexedDatabase()
+    # Opening reads only the index; the record body is fetched on access
+    assert db.list_websites() == ['a.com']
+    with open(db._data_path(), 'r+b') as f:
+        f.write(b'X')
+    with pytest.raises(ValueError):
+        db.get_entry('a.com')
+    db.close()
+
+
+def test_updates_append_and_compaction_reclaims(db):
+    db.add_entry('a.com', 'alice', 'x' * 1000)
+    generation = db.index['generation']
+    for i in range(100):
+        db.update_entry('a.com', f'{i:04d}' + 'x' * 1000)
+    assert db.index['generation'] > generation
+    assert not os.path.exists(db._data_path(generation))
+    assert os.path.getsize(db._data_path()) < 100 * 1000
+    db.close()
+    db = IndexedDatabase()
+    assert db.get_entry('a.com')['password'].startswith('0099')
+    db.close()
+
+
+def test_access_times_stay_in_the_index(db):
+    db.add_entry('a.com', 'alice', 'token-a')
+    size = os.path.getsize(db._data_path())
+    db.touch_entries({'a.com': '2024-01-01T00:00:00Z'})
+    assert os.path.getsize(db._data_path()) == size
+    assert db.get_entry('a.com')['last_accessed'] == '2024-01-01T00:00:00Z'
+
+
+def test_lookups_never_read_records(db):
+    db.add_entry('a.com', 'alice', 'token-a', 'https://login.example.com')
+    db.close()
+    db = IndexedDatabase()
+    with open(db._data_path(), 'r+b') as f:
+        f.write(b'X')
+    assert db.find_by_username('alice') == ['a.com']
+    assert db.find_by_domain('example.com') == ['a.com']
+    db.close()
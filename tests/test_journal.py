@@ -0,0 +1,87 @@
+import json
+import os
+from password_manager.core.database import Database
+from password_manager.core.journal import Journal
+
+
+def test_replay_applies_puts_and_deletes(tmp_path):
+    journal = Journal(str(tmp_path / 'db.journal'))
+    journal.append([Journal.put('a', 1), Journal.put('b', 2)])
+    journal.append([Journal.delete('a'), Journal.put('b', 3)])
+    assert journal.replay({'a': 0, 'c': 4}) == {'b': 3, 'c': 4}
+
+
+def test_replay_is_idempotent(tmp_path):
+    journal = Journal(str(tmp_path / 'db.journal'))
+    journal.append([Journal.put('a', 1), Journal.delete('b')])
+    data = journal.replay({'b': 2})
+    assert journal.replay(dict(data)) == data == {'a': 1}
+
+
+def test_torn_tail_is_dropped_and_truncated(tmp_path):
+    path = str(tmp_path / 'db.journal')
+    journal = Journal(path)
+    journal.append([Journal.put('a', 1)])
+    intact = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(Journal.encode(Journal.put('b', 2))[:-7])
+    assert journal.replay({}) == {'a': 1}
+    assert os.path.getsize(path) == intact
+    # Appends after the cut start on a clean line
+    journal.append([Journal.put('c', 3)])
+    assert journal.replay({}) == {'a': 1, 'c': 3}
+
+
+def test_corrupt_record_stops_replay(tmp_path):
+    path = str(tmp_path / 'db.journal')
+    journal = Journal(path)
+    journal.append([Journal.put('a', 1), Journal.put('b', 2), Journal.put('c', 3)])
+    with open(path, 'rb') as f:
+        lines = f.readlines()
+    lines[1] = lines[1].replace(b'"b"', b'"x"')
+    with open(path, 'wb') as f:
+        f.writelines(lines)
+    assert journal.replay({}) == {'a': 1}
+
+
+def test_needs_compaction(tmp_path):
+    journal = Journal(str(tmp_path / 'db.journal'), compact_bytes=1000, compact_ratio=0.5)
+    assert not journal.needs_compaction(0)
+    journal.append([Journal.put('a', 'x' * 100)])
+    assert journal.needs_compaction(200)
+    assert not journal.needs_compaction(10000)
+
+
+def test_database_recovers_journaled_changes(configure):
+    configure(journal_mode=True)
+    db = Database()
+    db.add_entry('example.com', 'alice', 'token')
+    db.update_entry('example.com', 'token2')
+    assert os.path.exists('passwords.json.journal')
+    # A new process sees the change only through the journal
+    db = Database()
+    assert db.get_entry('example.com')['password'] == 'token2'
+
+
+def test_database_recovers_from_torn_journal(configure):
+    configure(journal_mode=True)
+    db = Database()
+    db.add_entry('a.com', 'alice', 'token-a')
+    db.add_entry('b.com', 'bob', 'token-b')
+    with open('passwords.json.journal', 'rb+') as f:
+        f.truncate(os.path.getsize('passwords.json.journal') - 5)
+    db = Database()
+    assert db.list_websites() == ['a.com']
+    db.add_entry('c.com', 'carol', 'token-c')
+    assert sorted(Database().list_websites()) == ['a.com', 'c.com']
+
+
+def test_journal_is_folded_in_when_journaling_is_off(configure):
+    configure(journal_mode=True)
+    Database().add_entry('example.com', 'alice', 'token')
+    configure(journal_mode=False)
+    db = Database()
+    assert db.get_entry('example.com')['password'] == 'token'
+    assert not os.path.exists('passwords.json.journal')
+    with open('passwords.json') as f:
+        assert 'example.com' in json.load(f)['entries']
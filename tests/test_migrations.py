@@ -0,0 +1,59 @@
+import json
+import os
+import pytest
+from password_manager.core import migrations
+from password_manager.core.database import Database, read_backup
+
+ENTRY = {'username': 'alice', 'password': 'token', 'url': 'https://example.com',
+         'email': 'alice@example.com', 'additional_info': ''}
+
+
+def test_schema_version():
+    assert migrations.schema_version({'passwords': []}) == 0
+    assert migrations.schema_version({'example.com': ENTRY}) == 1
+    assert migrations.schema_version(migrations.new_document()) == migrations.SCHEMA_VERSION
+    with pytest.raises(ValueError):
+        migrations.schema_version([])
+
+
+def test_upgrade_from_passwords_array():
+    document = {'passwords': [dict(ENTRY, website='example.com'), {'username': 'orphan'}]}
+    upgraded = migrations.upgrade(document)
+    assert upgraded == migrations.new_document({'example.com': ENTRY})
+
+
+def test_upgrade_from_website_dict():
+    upgraded = migrations.upgrade({'example.com': ENTRY})
+    assert upgraded['schema_version'] == migrations.SCHEMA_VERSION
+    assert upgraded['meta'] == {}
+    assert upgraded['entries'] == {'example.com': ENTRY}
+
+
+def test_current_document_is_unchanged():
+    document = migrations.new_document({'example.com': ENTRY}, {'kdf': {}})
+    assert migrations.upgrade(document) is document
+
+
+def test_newer_version_is_rejected():
+    with pytest.raises(ValueError):
+        migrations.upgrade({'schema_version': migrations.SCHEMA_VERSION + 1,
+                            'meta': {}, 'entries': {}})
+
+
+def test_database_upgrades_file_once(configure):
+    with open('passwords.json', 'w') as f:
+        json.dump({'passwords': [dict(ENTRY, website='example.com')]}, f)
+    db = Database()
+    assert db.get_entry('example.com')['username'] == 'alice'
+    # The original is kept and the converted document replaces it
+    assert os.path.exists('passwords.json.v0.bak')
+    with open('passwords.json') as f:
+        assert migrations.schema_version(json.load(f)) == migrations.SCHEMA_VERSION
+
+
+def test_read_backup_upgrades_old_files(tmp_path):
+    path = tmp_path / 'backup.json'
+    path.write_text(json.dumps({'example.com': ENTRY}))
+    document = read_backup(str(path))
+    assert document['entries'] == {'example.com': ENTRY}
+    assert document['meta'] == {}
@@ -0,0 +1,257 @@
+import json
+import os
+import pytest
+from cryptography.fernet import Fernet
+from password_manager.core.encryption import LEGACY_KDF, derive_key, is_sealed
+from password_manager.core.password_manager import PasswordManager
+from password_manager.core.reencrypt import ReEncryption
+from password_manager.core.session import InvalidPasswordError
+
+
+def reopen(pm, password='master'):
+    pm.close()
+    pm = PasswordManager()
+    pm.unlock(password)
+    return pm
+
+
+def write_legacy_vault(entries):
+    """
+    A vault as written before the header existed: Fernet tokens under the
+    key derived from the password with the fixed legacy parameters
+    """
+    with open('passwords.json', 'w') as f:
+        json.dump({website: {'username': 'u', 'password': Fernet(key).encrypt(b'pw').decode(),
+                             'url': '', 'email': '', 'additional_info': ''}
+                   for website, key in entries}, f)
+
+
+def test_new_vault_has_an_envelope_header(vault):
+    for key in ('kdf', 'key_check', 'wrapped_key'):
+        assert vault.db.get_meta(key)
+    assert vault.is_set_up
+    assert vault.kdf_params() != LEGACY_KDF
+
+
+def test_entries_survive_reopening(vault):
+    vault.add_password('example.com', 'alice', 's3cret', 'https://example.com')
+    vault = reopen(vault)
+    entry = vault.get_password('example.com')
+    assert (entry['username'], entry['password']) == ('alice', 's3cret')
+    assert not entry['decryption_error']
+    vault.close()
+
+
+def test_wrong_password_is_rejected(vault):
+    vault.add_password('example.com', 'alice', 's3cret')
+    vault.close()
+    pm = PasswordManager()
+    with pytest.raises(InvalidPasswordError):
+        pm.unlock('wrong')
+    assert not pm.is_unlocked
+    pm.close()
+
+
+def test_lock_forgets_the_key(vault):
+    vault.add_password('example.com', 'alice', 's3cret')
+    vault.lock()
+    assert not vault.is_unlocked
+    with pytest.raises(ValueError):
+        vault.add_password('other.com', 'bob', 'pw')
+
+
+def test_change_master_password_only_rewraps(vault):
+    vault.add_password('example.com', 'alice', 's3cret')
+    token = vault.db.get_entry('example.com')['password']
+    assert not vault.change_master_password('wrong', 'new')
+    assert vault.change_master_password('master', 'new')
+    assert vault.db.get_entry('example.com')['password'] == token
+    vault = reopen(vault, 'new')
+    assert vault.get_password('example.com')['password'] == 's3cret'
+    vault.close()
+    pm = PasswordManager()
+    with pytest.raises(InvalidPasswordError):
+        pm.unlock('master')
+    pm.close()
+
+
+def test_find_websites_intersects_lookups(vault):
+    vault.add_password('a', 'alice', 'pw', 'https://login.example.com', 'alice@example.com')
+    vault.add_password('b', 'alice', 'pw', 'https://example.org', 'alice@example.com')
+    vault.add_password('c', 'bob', 'pw', 'https://shop.example.com', 'alice@example.com')
+    assert vault.find_websites(email='alice@example.com') == ['a', 'b', 'c']
+    assert vault.find_websites(username='alice', domain='example.com') == ['a']
+    assert vault.find_websites(url='shop.example.com') == ['c']
+    assert vault.find_websites() == []
+
+
+def vault_files():
+    return {os.path.join(directory, name): os.stat(os.path.join(directory, name)).st_mtime_ns
+            for directory, _, names in os.walk('.') for name in names}
+
+
+def test_reads_do_not_rewrite_the_vault(vault):
+    vault.add_password('a.com', 'alice', 'pw')
+    vault.flush()
+    files = vault_files()
+    accessed = vault.get_password('a.com')['last_accessed']
+    assert accessed
+    assert vault.get_password('a.com', track_access=False)['last_accessed'] == accessed
+    assert vault_files() == files
+    # Pending access times are written on flush
+    vault.flush()
+    assert vault.db.get_entry('a.com')['last_accessed'] == accessed
+    assert vault.list_websites('last_accessed', reverse=True) == ['a.com']
+
+
+def test_legacy_vault_moves_to_envelope_encryption(configure):
+    write_legacy_vault([('example.com', derive_key('master', LEGACY_KDF))])
+    pm = PasswordManager()
+    pm.unlock('master')
+    assert pm.db.get_meta('wrapped_key') and pm.db.get_meta('key_check')
+    pm = reopen(pm)
+    assert pm.get_password('example.com')['password'] == 'pw'
+    pm.close()
+
+
+def test_legacy_vault_rejects_wrong_password(configure):
+    write_legacy_vault([('example.com', derive_key('master', LEGACY_KDF))])
+    pm = PasswordManager()
+    with pytest.raises(InvalidPasswordError):
+        pm.unlock('wrong')
+    assert pm.db.get_meta('key_check') is None
+    pm.close()
+
+
+def test_legacy_vault_with_a_stray_first_entry(configure):
+    key = derive_key('master', LEGACY_KDF)
+    write_legacy_vault([('a.com', Fernet.generate_key()), ('b.com', key), ('c.com', key)])
+    pm = PasswordManager()
+    pm.unlock('master')
+    assert pm.db.get_meta('key_check')
+    pm.close()
+
+
+def test_legacy_key_check_needs_a_majority(configure):
+    other = Fernet.generate_key()
+    write_legacy_vault([('a.com', other), ('b.com', other),
+                        ('c.com', derive_key('master', LEGACY_KDF))])
+    pm = PasswordManager()
+    pm.unlock('master')
+    assert pm.get_password('c.com')['password'] == 'pw'
+    assert pm.db.get_meta('key_check') is None
+    pm.close()
+
+
+def test_legacy_vault_without_key_check_verifies_password_changes(configure):
+    other = Fernet.generate_key()
+    write_legacy_vault([('a.com', other), ('b.com', other),
+                        ('c.com', derive_key('master', LEGACY_KDF))])
+    pm = PasswordManager()
+    pm.unlock('master')
+    assert not pm.change_master_password('wrong', 'new')
+    assert pm.db.get_meta('key_check') is None
+    assert pm.change_master_password('master', 'new')
+    pm = reopen(pm, 'new')
+    assert pm.get_password('c.com')['password'] == 'pw'
+    pm.close()
+
+
+def test_import_of_backup_with_header_locks(vault, tmp_path):
+    vault.add_password('example.com', 'alice', 's3cret')
+    vault.db.export_backup(str(tmp_path / 'backup.json'))
+    vault.delete_password('example.com')
+    assert not vault.backup_needs_password(str(tmp_path / 'backup.json'))
+    assert vault.import_backup(str(tmp_path / 'backup.json')) == []
+    assert not vault.is_unlocked
+    vault.unlock('master')
+    assert vault.get_password('example.com')['password'] == 's3cret'
+
+
+def test_import_of_legacy_backup_reencrypts(vault, tmp_path):
+    path = str(tmp_path / 'backup.json')
+    key = derive_key('old', LEGACY_KDF)
+    with open(path, 'w') as f:
+        json.dump({'example.com': {'username': 'alice',
+                                   'password': Fernet(key).encrypt(b'pw').decode(),
+                                   'url': '', 'email': '', 'additional_info': ''}}, f)
+    assert vault.backup_needs_password(path)
+    with pytest.raises(InvalidPasswordError):
+        vault.import_backup(path, 'wrong')
+    assert vault.import_backup(path, 'old') == []
+    vault = reopen(vault)
+    assert vault.get_password('example.com')['password'] == 'pw'
+    vault.close()
+
+
+def test_rotation_resumes_after_interruption(vault):
+    for i in range(7):
+        vault.add_password(f'site{i}.com', 'user', f'pw{i}')
+    old_wrapped_key = vault.db.get_meta('wrapped_key')
+
+    def interrupt(done, total):
+        if done:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        ReEncryption(vault, 'master', batch_size=3).run(interrupt)
+    assert vault.db.get_meta('wrapped_key') == old_wrapped_key
+    calls = []
+    assert ReEncryption(vault, 'master', batch_size=3).run(
+        lambda done, total: calls.append(done)) == []
+    # Picked up after the staged batch instead of starting over
+    assert calls == [3, 6, 7]
+    assert vault.db.get_meta('wrapped_key') != old_wrapped_key
+    vault = reopen(vault)
+    assert [vault.get_password(f'site{i}.com')['password'] for i in range(7)] == \
+        [f'pw{i}' for i in range(7)]
+    vault.close()
+
+
+def test_sealed_entries(configure):
+    configure(encrypt_metadata=True)
+    pm = PasswordManager()
+    pm.create_vault('master')
+    pm.add_password('example.com', 'alice', 's3cret', 'https://login.example.com',
+                    'alice@example.com')
+    stored = pm.db.get_entry('example.com')
+    assert is_sealed(stored['password']) and stored['username'] == ''
+    pm = reopen(pm)
+    entry = pm.get_password('example.com')
+    assert (entry['username'], entry['password']) == ('alice', 's3cret')
+    assert pm.find_websites(email='alice@example.com') == ['example.com']
+    assert pm.match_url('https://login.example.com/form') == ['example.com']
+    pm.close()
+
+
+def test_batch_rolls_back_indexes(vault):
+    vault.add_password('example.com', 'alice', 'pw', 'https://example.com')
+    assert vault.match_url('https://example.com') == ['example.com']
+    with pytest.raises(RuntimeError):
+        with vault.batch():
+            vault.delete_password('example.com')
+            vault.add_password('other.com', 'bob', 'pw', 'https://other.com')
+            raise RuntimeError
+    assert vault.list_websites() == ['example.com']
+    assert vault.match_url('https://example.com') == ['example.com']
+    assert vault.match_url('https://other.com') == []
+
+
+def test_match_url_ranks_hosts(vault):
+    vault.add_password('exact', 'a', 'pw', 'https://login.example.com')
+    vault.add_password('parent', 'b', 'pw', 'https://example.com')
+    vault.add_password('sibling', 'c', 'pw', 'https://shop.example.com')
+    url = 'https://login.example.com/x'
+    assert vault.match_url(url) == ['exact', 'parent']
+    assert vault.match_url(url, same_site=True) == ['exact', 'parent', 'sibling']
+
+
+def test_match_url_respects_public_suffixes(vault):
+    vault.add_password('alice', 'a', 'pw', 'https://alice.myshopify.com')
+    assert vault.match_url('https://evil.myshopify.com', same_site=True) == []
+
+
+def test_match_url_with_punycode_hosts(vault):
+    vault.add_password('a', 'a', 'pw', 'https://a.xn--55qx5d.cn')
+    vault.add_password('b', 'b', 'pw', 'https://b.xn--55qx5d.cn')
+    assert vault.match_url('https://login.a.xn--55qx5d.cn', same_site=True) == ['a']
@@ -0,0 +1,29 @@
+import pytest
+from password_manager.utils.public_suffix import PublicSuffixList, registrable_domain
+
+
+@pytest.mark.parametrize('host, domain', [
+    ('example.com', 'example.com'),
+    ('login.example.co.uk', 'example.co.uk'),
+    ('alice.myshopify.com', 'alice.myshopify.com'),
+    ('co.uk', ''),
+    ('localhost', ''),
+    ('127.0.0.1', ''),
+    ('', ''),
+])
+def test_registrable_domain(host, domain):
+    assert registrable_domain(host) == domain
+
+
+def test_unicode_rules_match_punycode_hosts():
+    assert registrable_domain('a.xn--55qx5d.cn') == 'a.xn--55qx5d.cn'
+    assert registrable_domain('b.a.xn--55qx5d.cn') == 'a.xn--55qx5d.cn'
+    assert registrable_domain('b.a.公司.cn') == 'a.公司.cn'
+
+
+def test_wildcard_and_exception_rules():
+    rules = PublicSuffixList(['com', '*.ck', '!www.ck', '*.пример', '!www.пример'])
+    assert rules.registrable_domain('a.b.ck') == 'a.b.ck'
+    assert rules.registrable_domain('a.www.ck') == 'www.ck'
+    assert rules.registrable_domain('a.b.xn--e1afmkfd') == 'a.b.xn--e1afmkfd'
+    assert rules.registrable_domain('a.www.xn--e1afmkfd') == 'www.xn--e1afmkfd'
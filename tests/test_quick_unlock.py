@@ -0,0 +1,72 @@
+import pytest
+from password_manager.core import quick_unlock as quick_unlock_module
+from password_manager.core.encryption import generate_key
+from password_manager.core.quick_unlock import QuickUnlock, QuickUnlockUnavailable
+from password_manager.core.session import InvalidPasswordError
+
+
+def test_pin_returns_the_key():
+    key = generate_key()
+    quick = QuickUnlock()
+    assert not quick.available
+    quick.enable('1234', key)
+    assert quick.available
+    assert quick.unlock('1234') == key
+    # A successful unlock keeps it available
+    assert quick.unlock('1234') == key
+
+
+def test_empty_pin_is_refused():
+    with pytest.raises(ValueError):
+        QuickUnlock().enable('', generate_key())
+
+
+def test_wrong_pins_use_up_the_attempts():
+    key = generate_key()
+    quick = QuickUnlock(max_attempts=3)
+    quick.enable('1234', key)
+    with pytest.raises(InvalidPasswordError):
+        quick.unlock('0000')
+    # A correct PIN resets the count
+    assert quick.unlock('1234') == key
+    for _ in range(2):
+        with pytest.raises(InvalidPasswordError):
+            quick.unlock('0000')
+    with pytest.raises(QuickUnlockUnavailable):
+        quick.unlock('0000')
+    assert not quick.available
+    with pytest.raises(QuickUnlockUnavailable):
+        quick.unlock('1234')
+
+
+def test_pin_expires_after_the_window(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(quick_unlock_module.time, 'monotonic', lambda: now[0])
+    quick = QuickUnlock(window=60)
+    quick.enable('1234', generate_key())
+    now[0] += 60
+    assert quick.available
+    now[0] += 1
+    with pytest.raises(QuickUnlockUnavailable):
+        quick.unlock('1234')
+
+
+def test_vault_reopens_with_the_pin(vault):
+    vault.add_password('example.com', 'alice', 's3cret')
+    vault.enable_quick_unlock('1234')
+    vault.lock()
+    with pytest.raises(InvalidPasswordError):
+        vault.unlock_with_pin('0000')
+    assert not vault.is_unlocked
+    vault.unlock_with_pin('1234')
+    assert vault.get_password('example.com')['password'] == 's3cret'
+
+
+def test_rotation_discards_the_pin(vault):
+    vault.add_password('example.com', 'alice', 's3cret')
+    vault.enable_quick_unlock('1234')
+    vault.rotate_data_key('master')
+    assert not vault.quick_unlock.available
+    vault.lock()
+    with pytest.raises(QuickUnlockUnavailable):
+        vault.unlock_with_pin('1234')
@@ -0,0 +1,163 @@
+import asyncio
+import http.client
+import json
+import socket
+import threading
+import pytest
+from password_manager.server import ApiServer
+
+TOKEN = 'test-token'
+
+
+@pytest.fixture
+def server(vault):
+    """
+    An ApiServer on a free port, running its event loop on a thread
+    """
+    vault.add_password('example.com', 'alice', 's3cret', 'https://login.example.com')
+    loop = asyncio.new_event_loop()
+    api = ApiServer(vault, TOKEN, port=0, keep_alive_timeout=5)
+    loop.run_until_complete(api.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield api
+    asyncio.run_coroutine_threadsafe(api.close(), loop).result(10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(10)
+    loop.close()
+
+
+class Client:
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+
+    def request(self, method, path, body=None, token=TOKEN, headers=None):
+        headers = dict(headers or {})
+        if token is not None:
+            headers['Authorization'] = f'Bearer {token}'
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read())
+
+
+@pytest.fixture
+def client(server):
+    client = Client(server.port)
+    yield client
+    client.connection.close()
+
+
+def raw_request(port, data):
+    with socket.create_connection(('127.0.0.1', port), timeout=10) as sock:
+        sock.sendall(data)
+        response = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(body)
+
+
+def test_token_is_required(client):
+    assert client.request('GET', '/status', token=None)[0] == 401
+    assert client.request('GET', '/status', token='wrong')[0] == 401
+    assert client.request('GET', '/status') == (200, {'unlocked': True})
+
+
+def test_foreign_host_header_is_rejected(client):
+    status, _ = client.request('GET', '/status', headers={'Host': 'evil.example'})
+    assert status == 403
+
+
+def test_entry_crud(client):
+    assert client.request('GET', '/entries') == (200, {'websites': ['example.com']})
+    status, entry = client.request('GET', '/entries/example.com')
+    assert status == 200
+    assert (entry['username'], entry['password']) == ('alice', 's3cret')
+
+    assert client.request('POST', '/entries', {'website': 'other.com',
+                                               'password': 'pw'})[0] == 201
+    assert client.request('POST', '/entries', {'website': 'other.com',
+                                               'password': 'pw'})[0] == 409
+    assert client.request('PUT', '/entries/other.com',
+                          {'username': 'bob', 'website': 'renamed.com'}) == \
+        (200, {'website': 'renamed.com'})
+    status, entry = client.request('GET', '/entries/renamed.com')
+    assert (entry['username'], entry['password']) == ('bob', 'pw')
+
+    assert client.request('DELETE', '/entries/renamed.com')[0] == 200
+    assert client.request('GET', '/entries/renamed.com')[0] == 404
+    assert client.request('PATCH', '/entries/example.com')[0] == 405
+    assert client.request('GET', '/nowhere')[0] == 404
+
+
+def test_lookup_matches_the_page_host(client):
+    status, result = client.request('GET', '/lookup?url=https%3A%2F%2Flogin.example.com%2Fa')
+    assert status == 200
+    assert result['entries'] == [{'website': 'example.com', 'username': 'alice',
+                                  'password': 's3cret'}]
+    assert client.request('GET', '/lookup?url=https%3A%2F%2Fshop.example.com') == \
+        (200, {'entries': []})
+    assert client.request('GET', '/lookup')[0] == 400
+
+
+def test_lock_and_unlock(client):
+    assert client.request('POST', '/lock') == (200, {'unlocked': False})
+    assert client.request('GET', '/entries')[0] == 423
+    assert client.request('POST', '/unlock', {'master_password': 'wrong'})[0] == 403
+    assert client.request('POST', '/unlock', {'master_password': 'master'})[0] == 200
+    assert client.request('GET', '/entries')[0] == 200
+
+
+def test_connection_is_kept_alive(client):
+    client.request('GET', '/status')
+    sock = client.connection.sock
+    client.request('GET', '/entries')
+    assert client.connection.sock is sock
+
+
+def test_invalid_bodies(client):
+    assert client.request('POST', '/entries', [1, 2])[0] == 400
+    assert client.request('POST', '/entries', {'website': 'x.com'})[0] == 400
+    status, result = client.request('POST', '/entries', {'website': 'x.com',
+                                                         'password': 'pw', 'username': 5})
+    assert (status, result) == (400, {'error': 'username must be a string'})
+    assert client.request('PUT', '/entries/example.com', {'password': ['pw']})[0] == 400
+    assert client.request('GET', '/entries/example.com')[1]['password'] == 's3cret'
+
+
+@pytest.mark.parametrize('length', [b'-5', b'abc'])
+def test_invalid_content_length(server, length):
+    request = (b'POST /entries HTTP/1.1\r\nHost: localhost\r\n'
+               b'Authorization: Bearer ' + TOKEN.encode() + b'\r\n'
+               b'Content-Length: ' + length + b'\r\n\r\n')
+    assert raw_request(server.port, request) == (400, {'error': 'Invalid Content-Length'})
+
+
+def test_overlong_header_line(server):
+    request = b'GET /status HTTP/1.1\r\nX-Padding: ' + b'a' * 100000 + b'\r\n\r\n'
+    assert raw_request(server.port, request)[0] == 400
+
+
+def test_too_many_headers(server):
+    request = (b'GET /status HTTP/1.1\r\nHost: localhost\r\n'
+               + b''.join(b'X-Header-%d: a\r\n' % i for i in range(100)) + b'\r\n')
+    assert raw_request(server.port, request)[0] == 431
+
+
+def test_oversized_headers(server):
+    request = (b'GET /status HTTP/1.1\r\nHost: localhost\r\n'
+               + b''.join(b'X-Header-%d: %s\r\n' % (i, b'a' * 4000) for i in range(20))
+               + b'\r\n')
+    assert raw_request(server.port, request)[0] == 431
+
+
+def test_oversized_body(server):
+    request = (b'POST /entries HTTP/1.1\r\nHost: localhost\r\n'
+               b'Content-Length: 99999999\r\n\r\n')
+    assert raw_request(server.port, request)[0] == 413
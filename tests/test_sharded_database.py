@@ -0,0 +1,46 @@
+import json
+import os
+import pytest
+from password_manager.core.sharded_database import ShardedDatabase
+
+
+@pytest.fixture
+def db(configure):
+    configure(storage_backend='sharded', shard_count=4)
+    return ShardedDatabase()
+
+
+def shard_files():
+    return sorted(name for name in os.listdir('passwords.shards')
+                  if name.startswith('shard-'))
+
+
+def test_shard_count_is_fixed_by_the_manifest(db, configure):
+    assert shard_files() == [f'shard-{i:04d}.json' for i in range(4)]
+    configure(shard_count=8)
+    db = ShardedDatabase()
+    assert db.shard_count == 4
+
+
+def test_a_change_rewrites_only_its_shard(db):
+    for i in range(20):
+        db.add_entry(f'site{i}.com', 'user', f'token{i}')
+    mtimes = {name: os.stat(os.path.join('passwords.shards', name)).st_mtime_ns
+              for name in shard_files()}
+    db.update_entry('site3.com', 'changed')
+    changed = [name for name in shard_files()
+               if os.stat(os.path.join('passwords.shards', name)).st_mtime_ns != mtimes[name]]
+    assert changed == [f'shard-{db._shard_id("site3.com"):04d}.json']
+
+
+def test_entries_are_spread_and_reloaded(db):
+    for i in range(40):
+        db.add_entry(f'site{i}.com', 'user', f'token{i}')
+    sizes = []
+    for name in shard_files():
+        with open(os.path.join('passwords.shards', name)) as f:
+            sizes.append(len(json.load(f)))
+    assert sum(sizes) == 40 and max(sizes) < 40
+    db = ShardedDatabase()
+    assert sorted(db.list_websites()) == sorted(f'site{i}.com' for i in range(40))
+    assert len(db.find_by_username('user')) == 40
@@ -0,0 +1,53 @@
+import json
+import os
+import pytest
+from password_manager.core.journal import Journal
+from password_manager.core.sqlite_database import SQLiteDatabase
+
+ENTRY = {'username': 'alice', 'password': 'token', 'url': 'https://example.com',
+         'email': '', 'additional_info': ''}
+
+
+@pytest.fixture
+def sqlite_settings(configure):
+    configure(storage_backend='sqlite')
+
+
+def test_json_vault_is_migrated_with_its_journal(sqlite_settings):
+    with open('passwords.json', 'w') as f:
+        json.dump({'passwords': [dict(ENTRY, website='a.com')]}, f)
+    with open('passwords.json.journal', 'wb') as f:
+        f.write(Journal.encode(Journal.put('b.com', ENTRY)))
+    db = SQLiteDatabase()
+    assert sorted(db.list_websites()) == ['a.com', 'b.com']
+    assert db.find_by_host('example.com') == ['a.com', 'b.com']
+    db.close()
+
+
+def test_failed_migration_is_retried(sqlite_settings):
+    with open('passwords.json', 'w') as f:
+        json.dump({'a.com': ENTRY, 'b.com': 'not an entry'}, f)
+    with pytest.raises(AttributeError):
+        SQLiteDatabase()
+    # Nothing half-migrated is left for the next start to pick up
+    assert not os.path.exists('passwords.db')
+    with pytest.raises(AttributeError):
+        SQLiteDatabase()
+
+    with open('passwords.json', 'w') as f:
+        json.dump({'a.com': ENTRY, 'b.com': ENTRY}, f)
+    db = SQLiteDatabase()
+    assert sorted(db.list_websites()) == ['a.com', 'b.com']
+    db.close()
+    assert not os.path.exists('passwords.db.migrating')
+
+
+def test_migration_runs_only_once(sqlite_settings):
+    with open('passwords.json', 'w') as f:
+        json.dump({'a.com': ENTRY}, f)
+    db = SQLiteDatabase()
+    db.delete_entry('a.com')
+    db.close()
+    db = SQLiteDatabase()
+    assert db.list_websites() == []
+    db.close()
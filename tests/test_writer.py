@@ -0,0 +1,83 @@
+import threading
+import pytest
+from password_manager.core.database import Database
+from password_manager.core.writer import BackgroundWriter
+
+
+def wait_idle(writer):
+    with writer._cond:
+        assert writer._cond.wait_for(
+            lambda: writer._completed >= writer._requested, 10)
+
+
+def test_flush_waits_for_the_latest_payload():
+    written = []
+    release = threading.Event()
+
+    def write(payload):
+        release.wait(10)
+        written.append(payload)
+
+    writer = BackgroundWriter(write)
+    for payload in range(5):
+        writer.notify(payload)
+    release.set()
+    assert writer.flush(10)
+    # A burst is coalesced, but the newest payload is always written last
+    assert written[-1] == 4
+    assert len(written) <= 2
+    writer.close()
+
+
+def test_failed_write_is_raised_by_the_next_notify():
+    written = []
+
+    def write(payload):
+        if payload == 'bad':
+            raise OSError("disk full")
+        written.append(payload)
+
+    writer = BackgroundWriter(write)
+    writer.notify('bad')
+    wait_idle(writer)
+    with pytest.raises(OSError):
+        writer.notify('good')
+    # The payload that reported the error is still written
+    assert writer.flush(10)
+    assert written == ['good']
+    writer.close()
+
+
+def test_failed_write_is_raised_by_flush():
+    def write(payload):
+        raise OSError("disk full")
+
+    writer = BackgroundWriter(write)
+    writer.notify(1)
+    with pytest.raises(OSError):
+        writer.flush(10)
+    assert writer.flush(10)
+    writer.close()
+
+
+def test_notify_after_close_is_refused():
+    writer = BackgroundWriter(lambda payload: None)
+    writer.close()
+    with pytest.raises(ValueError):
+        writer.notify(1)
+
+
+def test_database_reports_a_failed_background_write(configure, tmp_path):
+    configure(background_writes=True,
+              database_path=str(tmp_path / 'missing' / 'passwords.json'))
+    db = Database()
+    db.add_entry('a.com', 'alice', 'token-a')
+    wait_idle(db.writer)
+    with pytest.raises(OSError):
+        db.add_entry('b.com', 'bob', 'token-b')
+    with pytest.raises(OSError):
+        db.flush()
+    (tmp_path / 'missing').mkdir()
+    db.add_entry('c.com', 'carol', 'token-c')
+    db.close()
+    assert sorted(Database.read_file(db.db_file)) == ['a.com', 'b.com', 'c.com']